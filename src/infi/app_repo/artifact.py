@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+from infi.gevent_utils.os import stat
+from .errors import FilenameParsingFailed
+from .filename_parser import parse_filepath
+from .utils import get_package_type
+
+
+class ParsedArtifact(object):
+    """Everything the indexers need to know about an ingested file, gathered once and passed to all of them.
+
+    package_name, package_version, platform_string, architecture and extension are parsed from the file name
+    (they are None if it could not be parsed), while platform and arch are the ones the file is ingested for.
+    package_type is 'rpm', 'deb' or None, according to the file's magic bytes."""
+
+    __slots__ = ('filepath', 'package_name', 'package_version', 'platform_string', 'architecture', 'extension',
+                 'platform', 'arch', 'size', 'inode', 'package_type')
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError("unexpected fields: {}".format(', '.join(sorted(kwargs))))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable".format(self.__class__.__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is immutable".format(self.__class__.__name__))
+
+    def _astuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, ParsedArtifact) and self._astuple() == other._astuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._astuple())
+
+    def __repr__(self):
+        return "<{} {!r}>".format(self.__class__.__name__, self.filepath)
+
+    @property
+    def is_parsed(self):
+        return self.package_name is not None
+
+    def assert_parsed(self):
+        if not self.is_parsed:
+            raise FilenameParsingFailed(self.filepath)
+
+    @classmethod
+    def from_filepath(cls, filepath, platform=None, arch=None):
+        """Parses the file name and sniffs the file.
+
+        If platform and arch are not given, they are taken from the file name, which must then be parsable"""
+        try:
+            package_name, package_version, platform_string, architecture, extension = parse_filepath(filepath)
+        except FilenameParsingFailed:
+            if platform is None and arch is None:
+                raise
+            package_name = package_version = platform_string = architecture = extension = None
+        try:
+            stat_result = stat(filepath)
+            size, inode = stat_result.st_size, stat_result.st_ino
+        except OSError:
+            size = inode = None
+        return cls(filepath=filepath, package_name=package_name, package_version=package_version,
+                   platform_string=platform_string, architecture=architecture, extension=extension,
+                   platform=platform_string if platform is None else platform,
+                   arch=architecture if arch is None else arch,
+                   size=size, inode=inode, package_type=None if inode is None else get_package_type(filepath))
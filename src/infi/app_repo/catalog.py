@@ -0,0 +1,191 @@
+"""An sqlite catalog of the packages, releases and distributions of the pretty index, so that listing them does not
+walk the directory tree"""
+from __future__ import absolute_import
+from logging import getLogger
+from infi.gevent_utils.os import path
+from infi.gevent_utils.deferred import create_threadpool_executed_func
+logger = getLogger(__name__)
+
+SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS packages (name TEXT, product_name TEXT, release_notes_url TEXT, hidden INTEGER,
+                                     PRIMARY KEY (name));
+CREATE TABLE IF NOT EXISTS releases (package TEXT, version TEXT, hidden INTEGER, mtime REAL, release_date TEXT,
+                                     PRIMARY KEY (package, version));
+CREATE TABLE IF NOT EXISTS distributions (package TEXT, version TEXT, platform TEXT, architecture TEXT, extension TEXT,
+                                          basename TEXT, hidden INTEGER, size INTEGER, mtime REAL,
+                                          PRIMARY KEY (package, version, platform, architecture, extension));
+"""
+# the columns of every table, and how many of them are its primary key
+TABLES = dict(packages=(('name', 'product_name', 'release_notes_url', 'hidden'), 1),
+              releases=(('package', 'version', 'hidden', 'mtime', 'release_date'), 2),
+              distributions=(('package', 'version', 'platform', 'architecture', 'extension', 'basename', 'hidden',
+                              'size', 'mtime'), 5))
+ORDER_BY = dict(packages='name', releases='package, version', distributions='package, version, platform, architecture, extension')
+TIMEOUT = 60  # seconds to wait for the database lock, the web server reads while the rpc server writes
+
+
+def _to_tuple(table, row):
+    columns, _ = TABLES[table]
+    return tuple(int(bool(row[column])) if column == 'hidden' else row[column] for column in columns)
+
+
+def _to_dict(table, values):
+    columns, _ = TABLES[table]
+    row = dict(zip(columns, values))
+    row['hidden'] = bool(row['hidden'])
+    return row
+
+
+def _connect(filepath):
+    import sqlite3
+    return sqlite3.connect(filepath, timeout=TIMEOUT)
+
+
+def _insert(connection, table, rows):
+    columns, _ = TABLES[table]
+    connection.executemany('INSERT OR REPLACE INTO {} VALUES ({})'.format(table, ', '.join('?' * len(columns))), rows)
+
+
+def _delete(connection, table, rows):
+    columns, key_length = TABLES[table]
+    where = ' AND '.join('{} = ?'.format(column) for column in columns[:key_length])
+    connection.executemany('DELETE FROM {} WHERE {}'.format(table, where), [row[:key_length] for row in rows])
+
+
+@create_threadpool_executed_func
+def _create(filepath):
+    """creates the tables under a temporary name, so that readers never see a database without them"""
+    from os import rename
+    connection = _connect(filepath + '.tmp')
+    try:
+        connection.executescript(SCHEMA)
+        connection.commit()
+    finally:
+        connection.close()
+    rename(filepath + '.tmp', filepath)
+
+
+@create_threadpool_executed_func
+def _add(filepath, rows_by_table):
+    connection = _connect(filepath)
+    try:
+        for table, rows in rows_by_table.items():
+            _insert(connection, table, rows)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+@create_threadpool_executed_func
+def _remove_distribution(filepath, key):
+    """removes the distribution, and its release and its package if they have no distributions left"""
+    package, version = key[:2]
+    connection = _connect(filepath)
+    try:
+        _delete(connection, 'distributions', [key])
+        connection.execute('DELETE FROM releases WHERE package = ? AND version = ? AND NOT EXISTS '
+                           '(SELECT 1 FROM distributions WHERE package = ? AND version = ?)',
+                           (package, version, package, version))
+        connection.execute('DELETE FROM packages WHERE name = ? AND NOT EXISTS (SELECT 1 FROM releases WHERE package = ?)',
+                           (package, package))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+@create_threadpool_executed_func
+def _replace(filepath, rows_by_table):
+    """:returns: the names of the packages that have rows which were added, changed or removed"""
+    changed = set()
+    connection = _connect(filepath)
+    try:
+        for table, rows in rows_by_table.items():
+            existing = set(connection.execute('SELECT * FROM {}'.format(table)))
+            stale, missing = existing.difference(rows), set(rows).difference(existing)
+            _delete(connection, table, stale)
+            _insert(connection, table, missing)
+            changed.update(row[0] for row in stale.union(missing))
+        connection.commit()
+    finally:
+        connection.close()
+    return sorted(changed)
+
+
+@create_threadpool_executed_func
+def _select(filepath, table, where=None, arguments=()):
+    connection = _connect(filepath)
+    try:
+        query = 'SELECT * FROM {}{} ORDER BY {}'.format(table, ' WHERE ' + where if where else '', ORDER_BY[table])
+        return list(connection.execute(query, arguments))
+    finally:
+        connection.close()
+
+
+def nest_distributions(releases, distributions):
+    """:returns: dict mapping the names of the packages to lists of their releases, each a copy of the release row
+              with a list of its distributions"""
+    distributions_by_release = dict()
+    for distribution in distributions:
+        distributions_by_release.setdefault((distribution['package'], distribution['version']), []).append(distribution)
+    releases_by_package = dict()
+    for release in releases:
+        release = dict(release, distributions=distributions_by_release.get((release['package'], release['version']), []))
+        releases_by_package.setdefault(release['package'], []).append(release)
+    return releases_by_package
+
+
+class Catalog(object):
+    """The rows of the catalog are dicts:
+
+    * packages: name, product_name, release_notes_url, hidden
+    * releases: package, version, hidden, mtime (of the release directory) and release_date (isoformat, or None)
+    * distributions: package, version, platform, architecture, extension, basename, hidden, size and mtime (of the file)
+
+    It is written by the rpc server only, the web server reads it as well."""
+
+    def __init__(self, filepath):
+        super(Catalog, self).__init__()
+        self.filepath = filepath
+
+    def exists(self):
+        return path.exists(self.filepath)
+
+    def create(self):
+        """Creates an empty catalog; the other methods expect it to exist"""
+        _create(self.filepath)
+
+    def add(self, packages=(), releases=(), distributions=()):
+        """Adds the rows, replacing the ones with the same keys"""
+        _add(self.filepath, dict(packages=[_to_tuple('packages', row) for row in packages],
+                                 releases=[_to_tuple('releases', row) for row in releases],
+                                 distributions=[_to_tuple('distributions', row) for row in distributions]))
+
+    def remove_distribution(self, package, version, platform, architecture, extension):
+        """Removes the distribution, and its release and its package once they have no distributions left"""
+        _remove_distribution(self.filepath, (package, version, platform, architecture, extension))
+
+    def replace(self, packages, releases, distributions):
+        """Makes the catalog hold exactly the given rows, writing only the differences.
+
+        :returns: the names of the packages whose rows were added, changed or removed"""
+        return _replace(self.filepath, dict(packages=set(_to_tuple('packages', row) for row in packages),
+                                            releases=set(_to_tuple('releases', row) for row in releases),
+                                            distributions=set(_to_tuple('distributions', row) for row in distributions)))
+
+    def get_packages(self):
+        return [_to_dict('packages', values) for values in _select(self.filepath, 'packages')]
+
+    def get_package(self, name):
+        rows = _select(self.filepath, 'packages', 'name = ?', (name, ))
+        return _to_dict('packages', rows[0]) if rows else None
+
+    def get_releases(self, package):
+        """:returns: the releases of the package, each with a list of its distributions"""
+        releases = [_to_dict('releases', values) for values in _select(self.filepath, 'releases', 'package = ?', (package, ))]
+        distributions = [_to_dict('distributions', values)
+                         for values in _select(self.filepath, 'distributions', 'package = ?', (package, ))]
+        return nest_distributions(releases, distributions).get(package, [])
+
+    def get_distributions(self):
+        return [_to_dict('distributions', values) for values in _select(self.filepath, 'distributions')]
@@ -60,6 +60,14 @@ class PropertyMixin(object):
     def packages_directory(self):
         return path.join(self.artifacts_directory, 'packages')
 
+    @property
+    def ingest_queue_filepath(self):
+        return path.join(self.base_directory, 'ingest_queue.msgpack')
+
+    @property
+    def resign_checkpoint_filepath(self):
+        return path.join(self.base_directory, 'resign_checkpoint.msgpack')
+
     @property
     def ftpserver_counters_filepath(self):
         return path.join(self.base_directory, 'ftp_download_counters.msgpack')
@@ -82,6 +90,12 @@ class Configuration(Model, PropertyMixin):
     development_mode = BooleanType(default=False)
     production_mode = BooleanType(default=True)
     indexes = ListType(StringType(), required=True, default=['main-stable', 'main-unstable'])
+    apt_pool_layout = BooleanType(default=False)  # store content-identical debs once, under <distribution>/pool
+    apt_rebuild_mode = StringType(default='native', choices=['native', 'apt-ftparchive-generate'])
+    rebuild_workers = IntType(required=False, default=None)  # the number of cpus if not set
+    sqlite_repodata_indexes = ListType(StringType(), required=True, default=[])  # yum indexes that get *.sqlite.bz2
+    resign_workers = IntType(default=20)
+    resign_io_budget = IntType(required=False, default=None)  # bytes per second re-signing may read, unlimited if not set
 
     @classmethod
     def get_default_config_file(cls):
@@ -148,6 +162,10 @@ class Configuration(Model, PropertyMixin):
         self.development_mode = True
         self.to_disk()
 
+    def get_rebuild_workers(self):
+        from multiprocessing import cpu_count
+        return self.rebuild_workers or cpu_count()
+
     def get_indexers(self, index_name):
         from .indexers import get_indexers
         return get_indexers(self, index_name)
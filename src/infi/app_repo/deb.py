@@ -0,0 +1,165 @@
+"""Generates the Packages stanzas of .deb files the way `apt-ftparchive packages` does, without forking it"""
+from __future__ import absolute_import
+from hashlib import md5, sha1, sha256, sha512
+from io import BytesIO
+from infi.gevent_utils.os import fopen
+from infi.gevent_utils.deferred import create_threadpool_executed_func
+from .utils import READ_SIZE
+from .file_cache import FileCache
+from logging import getLogger
+logger = getLogger(__name__)
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+CONTROL_MEMBER_NAMES = ('control.tar', 'control.tar.gz', 'control.tar.xz', 'control.tar.bz2')
+SIGNATURE_MEMBER_PREFIX = '_gpg'  # dpkg-sig adds _gpgbuilder, _gpgorigin and so on
+HASHES = (('MD5sum', md5), ('SHA1', sha1), ('SHA256', sha256), ('SHA512', sha512))
+
+# the order apt (>= 1.1) rewrites the fields of a Packages stanza in; fields not listed here follow, in their original order
+FIELD_ORDER = ('Package', 'Package-Type', 'Architecture', 'Subarchitecture', 'Version', 'Revision', 'Package-Revision',
+               'Package_Revision', 'Kernel-Version', 'Built-Using', 'Static-Built-Using', 'Built-For-Profiles',
+               'Auto-Built-Package', 'Multi-Arch', 'Status', 'Priority', 'Class', 'Build-Essential', 'Protected',
+               'Important', 'Essential', 'Installer-Menu-Item', 'Section', 'Source', 'Origin', 'Maintainer',
+               'Original-Maintainer', 'Bugs', 'Config-Version', 'Conffiles', 'Triggers-Awaited', 'Triggers-Pending',
+               'Installed-Size', 'Provides', 'Pre-Depends', 'Depends', 'Recommends', 'Recommended', 'Suggests',
+               'Optional', 'Conflicts', 'Breaks', 'Replaces', 'Enhances', 'Filename', 'MSDOS-Filename', 'Size',
+               'MD5sum', 'SHA1', 'SHA256', 'SHA512', 'Homepage', 'Description', 'Tag', 'Task')
+REMOVED_FIELDS = ('Status', 'Optional')
+
+
+class DebParsingFailed(Exception):
+    pass
+
+
+class _HashingReader(object):
+    def __init__(self, fd):
+        super(_HashingReader, self).__init__()
+        self._fd = fd
+        self.hashes = [(name, hash_class()) for name, hash_class in HASHES]
+        self.size = 0
+
+    def read(self, size):
+        data = self._fd.read(size)
+        for _, hash_object in self.hashes:
+            hash_object.update(data)
+        self.size += len(data)
+        return data
+
+    def skip(self, size):
+        while size > 0:
+            data = self.read(min(size, READ_SIZE))
+            if not data:
+                raise DebParsingFailed("unexpected end of file")
+            size -= len(data)
+
+
+def _extract_control_file(control_tar):
+    from tarfile import open as open_tar, TarError
+    try:
+        with open_tar(fileobj=BytesIO(control_tar), mode='r:*') as tar:
+            for member in tar.getmembers():
+                if member.name in ('control', './control'):
+                    return tar.extractfile(member).read().decode('utf-8')
+    except (TarError, EnvironmentError) as error:  # e.g. lzma is not available
+        raise DebParsingFailed(repr(error))
+    raise DebParsingFailed("control.tar has no control file")
+
+
+@create_threadpool_executed_func
+def scan_deb(filepath):
+    """Reads the control file and hashes the .deb in a single pass over it.
+
+    :returns: dict with the control file, the size and the hex digest of every hash apt-ftparchive lists"""
+    control = None
+    with fopen(filepath, 'rb') as fd:
+        reader = _HashingReader(fd)
+        if reader.read(len(AR_MAGIC)) != AR_MAGIC:
+            raise DebParsingFailed("{} is not an ar archive".format(filepath))
+        while True:
+            header = reader.read(AR_HEADER_SIZE)
+            if not header:
+                break
+            if len(header) != AR_HEADER_SIZE or header[58:60] != b'`\n':
+                raise DebParsingFailed("{} has a malformed ar header".format(filepath))
+            name, size = header[:16].decode('ascii').strip().rstrip('/'), int(header[48:58])
+            if control is None and name in CONTROL_MEMBER_NAMES:
+                control = _extract_control_file(reader.read(size))
+            else:
+                reader.skip(size)
+            reader.skip(size % 2)  # members are aligned to an even offset
+    if control is None:
+        raise DebParsingFailed("{} has no control member".format(filepath))
+    result = dict(control=control, size=reader.size)
+    result.update((name, hash_object.hexdigest()) for name, hash_object in reader.hashes)
+    return result
+
+
+@create_threadpool_executed_func
+def scan_deb_signatures(filepath):
+    """Reads the dpkg-sig members of the .deb, seeking past the others.
+
+    :returns: list of the contents of the signature members, empty if the .deb is not signed"""
+    signatures = []
+    with fopen(filepath, 'rb') as fd:
+        if fd.read(len(AR_MAGIC)) != AR_MAGIC:
+            raise DebParsingFailed("{} is not an ar archive".format(filepath))
+        while True:
+            header = fd.read(AR_HEADER_SIZE)
+            if not header:
+                break
+            if len(header) != AR_HEADER_SIZE or header[58:60] != b'`\n':
+                raise DebParsingFailed("{} has a malformed ar header".format(filepath))
+            name, size = header[:16].decode('ascii').strip().rstrip('/'), int(header[48:58])
+            if name.startswith(SIGNATURE_MEMBER_PREFIX):
+                signatures.append(fd.read(size).decode('utf-8', 'replace'))
+                fd.seek(size % 2, 1)
+            else:
+                fd.seek(size + size % 2, 1)  # members are aligned to an even offset
+    return signatures
+
+
+def _iter_fields(control):
+    """:returns: (name, value) pairs, multi-line values keep their continuation lines"""
+    name, lines = None, []
+    for line in control.rstrip('\n').split('\n'):
+        line = line.rstrip()
+        if line[:1] in (' ', '\t') and name is not None:
+            lines.append(line)
+            continue
+        if not line:
+            continue
+        if name is not None:
+            yield name, '\n'.join(lines)
+        name, _, value = line.partition(':')
+        lines = [value.strip()]
+    if name is not None:
+        yield name, '\n'.join(lines)
+
+
+def format_stanza(scan_result, filename):
+    """:param scan_result: as returned by scan_deb
+    :param filename: the path of the file relative to the root of the repository"""
+    fields = [(name, value) for name, value in _iter_fields(scan_result['control']) if name not in REMOVED_FIELDS]
+    generated = [('Filename', filename), ('Size', str(scan_result['size']))]
+    generated += [(name, scan_result[name]) for name, _ in HASHES]
+    generated_names = set(name for name, _ in generated)
+    fields = [(name, value) for name, value in fields if name not in generated_names] + generated
+    order = dict((name.lower(), index) for index, name in enumerate(FIELD_ORDER))
+    known = sorted((field for field in fields if field[0].lower() in order), key=lambda field: order[field[0].lower()])
+    unknown = [field for field in fields if field[0].lower() not in order]
+    return ''.join('{}: {}\n'.format(name, value) for name, value in known + unknown) + '\n'
+
+
+class StanzaCache(FileCache):
+    """The result of scan_deb for the debs of a directory, see format_stanza"""
+    EXCEPTIONS = (DebParsingFailed, ValueError, UnicodeDecodeError)
+
+    def compute(self, filepath, stat_result):
+        return scan_deb(filepath)
+
+    def get_stanzas(self, items):
+        """:param items: list of (filepath, filename) tuples, see format_stanza
+        :returns: 2-tuple (list of stanzas, list of the file paths that could not be parsed and have no stanza)"""
+        scan_results, failures = self.get([filepath for filepath, _ in items])
+        return [format_stanza(scan_results[filepath], filename)
+                for filepath, filename in items if filepath in scan_results], failures
@@ -25,5 +25,13 @@ class FileNeglectedByIndexers(FileRejected):
     pass
 
 
+class IndexRebuildFailed(AppRepoBaseException):
+    pass
+
+
+class ResignFailed(AppRepoBaseException):
+    pass
+
+
 class NoCredentialsException(Exception):
     pass
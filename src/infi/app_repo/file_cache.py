@@ -0,0 +1,55 @@
+"""Caches values computed from the contents of files, e.g. the parsed headers of packages"""
+from __future__ import absolute_import
+from logging import getLogger
+from infi.gevent_utils.os import stat
+logger = getLogger(__name__)
+
+
+class FileCache(object):
+    """Values computed by compute(), kept on disk and keyed by the path of the file they were computed from; a value is
+    valid as long as the size and the mtime of the file are unchanged.
+
+    Every directory of packages gets its own cache file, so that updating it costs the size of the directory, and
+    so that the ingests that hold the lock of a directory are the only writers of its cache."""
+    EXCEPTIONS = ()  # that compute() raises for files that cannot be parsed
+
+    def __init__(self, filepath):
+        from .persistent_dict import PersistentDict
+        from gevent.lock import Semaphore
+        super(FileCache, self).__init__()
+        self._entries = PersistentDict(filepath)
+        self._entries.load()
+        self._write_lock = Semaphore()  # saving serializes the entries in a thread, they must not change meanwhile
+
+    def compute(self, filepath, stat_result):
+        raise NotImplementedError()
+
+    def get(self, filepaths):
+        """:returns: 2-tuple (dict mapping the file paths to their values, list of the file paths compute failed on)"""
+        values, failures, new_entries = dict(), [], dict()
+        for filepath in filepaths:
+            stat_result = stat(filepath)
+            entry = self._entries.get(filepath)
+            if entry is None or entry['st_size'] != stat_result.st_size or entry['st_mtime'] != stat_result.st_mtime:
+                try:
+                    value = self.compute(filepath, stat_result)
+                except self.EXCEPTIONS as error:
+                    logger.debug("failed to parse {}: {!r}".format(filepath, error))
+                    failures.append(filepath)
+                    continue
+                entry = dict(value=value, st_size=stat_result.st_size, st_mtime=stat_result.st_mtime)
+                new_entries[filepath] = entry
+            values[filepath] = entry['value']
+        if new_entries:
+            with self._write_lock:
+                self._entries.update(new_entries)  # saves once
+        return values, failures
+
+    def prune(self, filepaths):
+        """Forgets all the files but the given ones"""
+        with self._write_lock:
+            stale = set(self._entries.keys()).difference(filepaths)
+            if stale:
+                for filepath in stale:
+                    del self._entries.data[filepath]
+                self._entries.save()
@@ -1,22 +1,27 @@
 from infi.gevent_utils.os import path
 from infi.app_repo.errors import FilenameParsingFailed
 from logging import getLogger
-from re import match
+from re import compile, escape
+from functools import lru_cache
+from .platforms import PLATFORM_PATTERNS, ARCHITECTURES, EXTENSIONS
 logger = getLogger(__name__)
 
 
 NAME = r"""(?P<package_name>[a-zA-Z]*[a-zA-Z\-_\.]+[0-9_]?[a-zA-Z\-_]+[a-zA-Z][0-9]{0,2})"""
 VERSION = r"""v?(?P<package_version>(?:[\d+\.]+)(?:-develop|-[0-9\.]+(?:_g[0-9a-f]{7})?|(?:(?:\.post\d+|\.post\d+\.|\.b\d+|\.post\d+\+|\.post\d+-\d+|\.\d+\.|-[0-9\.]+-[0-9\.]+|-\d+-|-develop-\d+-|~dev\d+-\d+)(?:g[a-z0-9]{7})?))?)"""
-PLATFORM = r"""(?P<platform_string>python|vmware-esx|custom|windows|aix-\d+\.\d+|solaris-\d+|linux-ubuntu-[a-z]+|linux-suse-\d+|linux-redhat-\d|linux-centos-\d|linux-rocky-\d|linux-oracle-\d|osx-\d+\.\d+|centos.el6|centos.el7|redhat.el6|redhat.el7|docker|windows-hyperv)"""
-ARCHITECTURE = r"""(?P<architecture>generic|docs|sdist|x86|x64|ppc64|ppc64le|powerpc|powerpc_bff|sparc|x86_OVF10|x86_OVF10_UPDATE_ISO|x86_OVF10_UPDATE_ZIP|x64_OVF10|x64_OVF10_UPDATE_ISO|x64_OVF10_UPDATE_ZIP|x64_dd|i686|x86_64|x64_vhd)"""
-EXTENSION = r"""(?P<extension>bin|rpm|deb|msi|pkg\.gz|tar\.gz|ova|vhd|iso|zip|img|exe||so|dll|pdb|cpp|exp|pak|bff)"""
+PLATFORM = r"""(?P<platform_string>{})""".format('|'.join(PLATFORM_PATTERNS))
+ARCHITECTURE = r"""(?P<architecture>{})""".format('|'.join(ARCHITECTURES))
+EXTENSION = r"""(?P<extension>{})""".format('|'.join(escape(extension) for extension in EXTENSIONS))
 TEMPLATE = r"""^{}.{}.{}.{}\.?{}$"""
 FILEPATH = TEMPLATE.format(NAME, VERSION, PLATFORM, ARCHITECTURE, EXTENSION)
+FILEPATH_PATTERN = compile(FILEPATH)
 PLATFORM_STRING = dict(ova='vmware-esx', img='other', zip='other')
 TRANSLATED_ARCHITECTURE = {"x86_64": "x64", "i686": "x86"}
 TRANSLATED_PLATFORM = {"centos.el6": "linux-centos-6", "centos.el7": "linux-centos-7",
                        "redhat.el6": "linux-redhat-6", "redhat.el7": "linux-redhat-7"}
 TRANSLATED_EXTENSION = {'': 'exe'}
+PARSE_CACHE_SIZE = 65536
+
 
 def translate_filepath(result_tuple):
     package_name, package_version, platform_string, architecture, extension = result_tuple
@@ -26,14 +31,40 @@ def translate_filepath(result_tuple):
             TRANSLATED_EXTENSION.get(extension, extension))
 
 
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_basename(filename):
+    """:returns: the 5-tuple, or None if the name could not be parsed"""
+    result = FILEPATH_PATTERN.match(filename)
+    if result is None:
+        return None
+    package_name, package_version, platform_string, architecture, extension = result.group(
+        'package_name', 'package_version', 'platform_string', 'architecture', 'extension')
+    return translate_filepath((package_name, package_version, PLATFORM_STRING.get(extension, platform_string),
+                               architecture, extension))
+
+
 def parse_filepath(filepath):
     """:returns: 5-tuple (package_name, package_version, platform_string, architecture, extension)"""
     filename = path.basename(filepath)
-    result = match(FILEPATH, filename)
+    result = _parse_basename(filename)
     if result is None:
         logger.error("failed to parse {}".format(filename))
         raise FilenameParsingFailed(filepath)
-    group = result.groupdict()
-    return translate_filepath((group['package_name'], group['package_version'],
-                               PLATFORM_STRING.get(group['extension'], group['platform_string']),
-                               group['architecture'], group['extension']))
+    return result
+
+
+def parse_many(filepaths):
+    """Parses a batch of file paths, logging a single line for all the ones that could not be parsed.
+
+    :returns: 2-tuple (dict mapping each parsed file path to its 5-tuple, list of the file paths that failed)"""
+    results, failures = dict(), []
+    for filepath in filepaths:
+        result = _parse_basename(path.basename(filepath))
+        if result is None:
+            failures.append(filepath)
+        else:
+            results[filepath] = result
+    if failures:
+        logger.error("failed to parse {} of {} files, first was {}".format(len(failures), len(results) + len(failures),
+                                                                          path.basename(failures[0])))
+    return results, failures
@@ -31,7 +31,8 @@ class AppRepoFtpHandler(FTPHandler):
     def on_file_received(self, filepath):
         logger.info("received {}".format(filepath))
         _, index_name, _ = filepath.rsplit(path.sep, 2)
-        self.server.rpc_client.process_filepath_by_name(index_name, filepath)
+        job_id = self.server.rpc_client.submit_filepath_by_name(index_name, filepath)
+        logger.info("submitted {} as job {}".format(filepath, job_id))
 
     @suppress_exceptions
     def on_file_sent(self, filepath):
@@ -7,10 +7,12 @@ def get_indexers(config, index_name):
     from .vmware_studio_updates import VmwareStudioUpdatesIndexer
     from .windows_hyperv import WindowsHypervIndexer
 
+    # the indexers that sign the files come first: yum swaps in the signed rpm by renaming it over the links it knows of,
+    # and the other indexers then link the signed file
     return (
         AptIndexer(config, index_name),
-        PrettyIndexer(config, index_name),
         YumIndexer(config, index_name),
+        PrettyIndexer(config, index_name),
         PythonIndexer(config, index_name),
         VmwareStudioUpdatesIndexer(config, index_name),
         PypiIndexer(config, index_name),
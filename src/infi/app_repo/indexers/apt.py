@@ -1,49 +1,224 @@
 from .base import Indexer
-from infi.app_repo.utils import ensure_directory_exists
-from infi.gevent_utils.os import path, remove, fopen
+from infi.app_repo.utils import ensure_directory_exists, read_file, write_file, iter_file_chunks
+from infi.gevent_utils.os import path, remove, rename, fopen, walk
 from infi.gevent_utils.glob import glob
 from infi.gevent_utils.deferred import create_threadpool_executed_func
+from infi.gevent_utils.safe_greenlets import safe_spawn, safe_joinall
 from infi.app_repo.utils import temporary_directory_context, log_execute_assert_success, hard_link_or_raise_exception
-from infi.app_repo.utils import is_really_deb
-
-
-KNOWN_DISTRIBUTIONS = {
-    'linux-ubuntu': {
-        'trusty': ('i386', 'amd64'),
-        'xenial': ('i386', 'amd64'),
-        'bionic': ('amd64', ),
-        'focal': ('amd64', ),
-        'jammy': ('amd64', ),
-    }
-}
+from infi.app_repo.artifact import ParsedArtifact
+from infi.app_repo.platforms import KNOWN_DISTRIBUTIONS
+from infi.app_repo.metrics import stage
+from infi.app_repo.signer import signer
+from logging import getLogger
+logger = getLogger(__name__)
 
 TRANSLATE_ARCH = {'x86': 'i386', 'x64': 'amd64', 'i386': 'i386', 'amd64': 'amd64'}
 RELEASE_FILE_HEADER = "Codename: {}\nArchitectures: {}\nComponents: main\n{}"
+RELEASE_INDEX_FILE_PATTERNS = ('Packages', 'Packages.*', 'Release', 'Contents-*')
+RELEASE_HASHES = (('MD5Sum', 'md5'), ('SHA1', 'sha1'), ('SHA256', 'sha256'), ('SHA512', 'sha512'))
+COMPACTION_INTERVAL = 100  # appends
+APT_FTPARCHIVE_GENERATE_CONFIG_HEADER = """Dir {{ ArchiveDir "{}"; CacheDir "{}"; }};
+Default {{ Packages::Compress ". gzip xz"; Contents::Compress "gzip"; FileMode 0644; }};
+"""
+APT_FTPARCHIVE_GENERATE_CONFIG_BIN_DIRECTORY = """BinDirectory "{0}" {{ Packages "{0}/Packages"; Contents "{1}"; BinCacheDB "apt_cache.db"; }};
+"""
 
 
-def write_to_packages_file(dirpath, contents, mode):
+@create_threadpool_executed_func
+def _write_compressed_packages_files(packages_filepath, chunks, append):
+    """Writes Packages.gz and Packages.xz in the same pass.
+
+    When appending, the chunks are written as a new gzip member and a new xz stream; apt reads concatenated ones
+    as a single file. Otherwise both files are written from scratch under temporary names and renamed into place"""
     import gzip
+    import lzma
+    from os import rename
+    filepaths = [packages_filepath + '.gz', packages_filepath + '.xz']
+    write_filepaths = filepaths if append else [filepath + '.tmp' for filepath in filepaths]
+    mode = 'ab' if append else 'wb'
+    with gzip.open(write_filepaths[0], mode) as gz_fd, lzma.open(write_filepaths[1], mode) as xz_fd:
+        for chunk in chunks:
+            gz_fd.write(chunk)
+            xz_fd.write(chunk)
+    if not append:
+        for src, dst in zip(write_filepaths, filepaths):
+            rename(src, dst)
+
+
+def write_to_packages_file(dirpath, contents, mode):
+    """Writes Packages, Packages.gz and Packages.xz; appending costs the size of the new contents only.
+
+    Every COMPACTION_INTERVAL appends, the compressed files are rewritten as a single member"""
     packages_filepath = path.join(dirpath, 'Packages')
+    appends_filepath = path.join(dirpath, '.Packages.appends')
+    if mode == 'a' and not contents:
+        return
     with fopen(packages_filepath, mode) as fd:
         fd.write(contents)
-    with fopen(packages_filepath, 'rb') as fd:
-        all_contents = fd.read()
-    fd = gzip.open(packages_filepath + '.gz', 'wb')
-    fd.write(all_contents)
-    fd.close()
+    appends = int(read_file(appends_filepath) or 0) + 1 if mode == 'a' and path.exists(appends_filepath) else 0
+    compressed_files_exist = path.exists(packages_filepath + '.gz') and path.exists(packages_filepath + '.xz')
+    if mode == 'a' and compressed_files_exist and 0 < appends < COMPACTION_INTERVAL:
+        _write_compressed_packages_files(packages_filepath, [contents.encode()], True)
+    else:
+        _write_compressed_packages_files(packages_filepath, iter_file_chunks(packages_filepath), False)
+        appends = 0
+    write_file(appends_filepath, str(appends))
 
 
-def apt_ftparchive(cmdline_arguments):
-    return log_execute_assert_success(['apt-ftparchive'] + cmdline_arguments).get_stdout().decode()
+@create_threadpool_executed_func
+def _hash_file(filepath, hashes=RELEASE_HASHES):
+    from hashlib import new
+    hash_objects = [(name, new(algorithm)) for name, algorithm in hashes]
+    size = 0
+    for chunk in iter_file_chunks(filepath):
+        size += len(chunk)
+        for _, hash_object in hash_objects:
+            hash_object.update(chunk)
+    return dict(((name, hash_object.hexdigest()) for name, hash_object in hash_objects), size=size)
+
+
+def _iter_release_index_files(dirpath):
+    """:returns: the paths, relative to dists/<codename>, of the files the Release file lists"""
+    from fnmatch import fnmatch
+    for filepath in glob(path.join(dirpath, '*', '*')) + glob(path.join(dirpath, '*', '*', '*')):
+        if any(fnmatch(path.basename(filepath), pattern) for pattern in RELEASE_INDEX_FILE_PATTERNS):
+            yield path.relpath(filepath, dirpath)
+
+
+def generate_release_contents(dirpath):
+    """Generates what `apt-ftparchive release` prints, rehashing only the files that changed since the last time.
+
+    The hashes are kept in a manifest in dirpath, keyed by the relative path and validated by size and mtime"""
+    from time import gmtime, strftime
+    from infi.gevent_utils.os import stat
+    from infi.app_repo.persistent_dict import PersistentDict
+    manifest = PersistentDict(path.join(dirpath, '.release_manifest.msgpack'))
+    manifest.load()
+    entries = dict()
+    for relative_path in sorted(_iter_release_index_files(dirpath)):
+        stat_result = stat(path.join(dirpath, relative_path))
+        entry = manifest.get(relative_path)
+        if entry is None or entry['st_size'] != stat_result.st_size or entry['st_mtime'] != stat_result.st_mtime:
+            entry = _hash_file(path.join(dirpath, relative_path))
+            entry.update(st_size=stat_result.st_size, st_mtime=stat_result.st_mtime)
+        entries[relative_path] = entry
+    if entries != manifest.data:
+        manifest.data = entries
+        manifest.save()
+    lines = ['Date: {}'.format(strftime('%a, %d %b %Y %H:%M:%S UTC', gmtime()))]
+    for name, _ in RELEASE_HASHES:
+        lines.append('{}:'.format(name))
+        lines.extend(' {} {:>16} {}'.format(entries[relative_path][name], entries[relative_path]['size'], relative_path)
+                     for relative_path in sorted(entries))
+    return '\n'.join(lines) + '\n'
+
+
+def remove_from_packages_file(dirpath, filenames):
+    """Removes the stanzas of the given files from Packages, Packages.gz and Packages.xz
+
+    :param filenames: paths relative to the root of the repository, as listed in the Filename fields
+    :returns: True if a stanza was removed"""
+    lines = set('Filename: {}'.format(filename) for filename in filenames)
+    stanzas = read_file(path.join(dirpath, 'Packages')).split('\n\n')
+    kept = [stanza for stanza in stanzas if stanza.strip() and not lines.intersection(stanza.split('\n'))]
+    if len(kept) == len([stanza for stanza in stanzas if stanza.strip()]):
+        return False
+    write_to_packages_file(dirpath, ''.join(stanza.strip('\n') + '\n\n' for stanza in kept), 'w')
+    return True
 
 
-def gpg(cmdline_arguments):
-    return log_execute_assert_success(['gpg'] + cmdline_arguments).get_stdout()
+class AptPool(object):
+    """Content-identical debs of a distribution are stored once, under its pool directory, and hard linked from the
+    binary-<arch> directories of every codename that publishes them.
+
+    The index maps the digest of every deb, as it was uploaded, to its file in the pool, and every hard link to it.
+    It is written by the ingests to every codename of the distribution, so they all hold the distribution's lock"""
+
+    def __init__(self, base_directory, distribution_name):
+        from infi.app_repo.persistent_dict import PersistentDict
+        from gevent.lock import Semaphore
+        super(AptPool, self).__init__()
+        self.base_directory = base_directory
+        self._index = PersistentDict(path.join(base_directory, distribution_name, 'pool_index.msgpack'))
+        self._index.load()
+        self._index.data.setdefault('digests', dict())
+        self._index.data.setdefault('references', dict())
+        self._write_lock = Semaphore()
+
+    def _relpath(self, filepath):
+        return path.relpath(filepath, self.base_directory)
+
+    def get_pool_filepath(self, digest):
+        """:returns: the path of the deb with this digest in the pool, or None"""
+        relative_path = self._index['digests'].get(digest)
+        if relative_path is None or not path.exists(path.join(self.base_directory, relative_path)):
+            return None
+        return path.join(self.base_directory, relative_path)
+
+    def add(self, digest, pool_filepath):
+        with self._write_lock:
+            self._index['digests'][digest] = self._relpath(pool_filepath)
+            self._index.save()
+    def add_reference(self, filepath, pool_filepath):
+        with self._write_lock:
+            self._index['references'][self._relpath(filepath)] = self._relpath(pool_filepath)
+            self._index.save()
+
+    def resolve(self, filepath):
+        """:returns: the file in the pool that filepath is a hard link to, or filepath if it is not in the pool"""
+        relative_path = self._index['references'].get(self._relpath(filepath))
+        return filepath if relative_path is None else path.join(self.base_directory, relative_path)
+
+    def _remove_unreferenced_files(self):
+        referenced = set(self._index['references'].values())
+        for key, relative_path in list(self._index['digests'].items()):
+            if relative_path not in referenced:
+                del self._index['digests'][key]
+                if path.exists(path.join(self.base_directory, relative_path)):
+                    remove(path.join(self.base_directory, relative_path))
+
+    def remove_reference(self, filepath):
+        """Forgets the hard link, and removes the file from the pool if nothing else links to it"""
+        with self._write_lock:
+            if self._index['references'].pop(self._relpath(filepath), None) is not None:
+                self._remove_unreferenced_files()
+                self._index.save()
+
+    def prune(self, filepaths):
+        """Forgets all the hard links but the given ones, and removes the files they no longer keep in the pool"""
+        relative_paths = set(self._relpath(filepath) for filepath in filepaths)
+        with self._write_lock:
+            for relative_path in set(self._index['references']).difference(relative_paths):
+                del self._index['references'][relative_path]
+            self._remove_unreferenced_files()
+            self._index.save()
+
+
+def generate_apt_ftparchive_config(base_directory, distribution_name):
+    """:returns: an `apt-ftparchive generate` configuration that writes the packages and contents files of all the
+    codenames and architectures of the distribution, sharing apt_cache.db"""
+    lines = [APT_FTPARCHIVE_GENERATE_CONFIG_HEADER.format(path.join(base_directory, distribution_name), base_directory)]
+    for codename, architectures in sorted(KNOWN_DISTRIBUTIONS[distribution_name].items()):
+        for arch in sorted(architectures):
+            dirpath = '/'.join(['dists', codename, 'main', 'binary-' + arch])
+            contents_filepath = '/'.join(['dists', codename, 'main', 'Contents-' + arch])
+            lines.append(APT_FTPARCHIVE_GENERATE_CONFIG_BIN_DIRECTORY.format(dirpath, contents_filepath))
+    return ''.join(lines)
+
+
+def apt_ftparchive(cmdline_arguments):
+    return log_execute_assert_success(['apt-ftparchive'] + cmdline_arguments).get_stdout().decode()
 
 
 class AptIndexer(Indexer):
     INDEX_TYPE = 'apt'
 
+    def __init__(self, *args, **kwargs):
+        super(AptIndexer, self).__init__(*args, **kwargs)
+        self._stanza_caches = dict()
+        self._pools = dict()
+        self._rebuild_progress = dict()
+
     def initialise(self):
         ensure_directory_exists(self.base_directory)
         for distribution_name, distribution_dict in KNOWN_DISTRIBUTIONS.items():
@@ -55,20 +230,88 @@ class AptIndexer(Indexer):
                         write_to_packages_file(dirpath, '', 'w')
                 self.generate_release_file_for_specific_distribution_and_version(distribution_name, version, False)
 
+    def _get_stanza_cache_filepath(self, dirpath):
+        return path.join(self.base_directory, 'stanza_cache', path.relpath(dirpath, self.base_directory) + '.msgpack')
+
+    def _get_stanza_cache(self, dirpath):
+        """:returns: the stanza cache of a directory of debs, which only the holders of its lock write"""
+        from infi.app_repo.deb import StanzaCache
+        if dirpath not in self._stanza_caches:
+            filepath = self._get_stanza_cache_filepath(dirpath)
+            ensure_directory_exists(path.dirname(filepath))
+            self._stanza_caches[dirpath] = StanzaCache(filepath)
+        return self._stanza_caches[dirpath]
+
+    def _prune_stanza_caches(self, filepaths):
+        """Forgets the debs that are not in filepaths, and removes the caches of the directories left without debs"""
+        filepaths_by_dirpath = dict()
+        for filepath in filepaths:
+            filepaths_by_dirpath.setdefault(path.dirname(filepath), []).append(filepath)
+        for dirpath, dirpath_filepaths in filepaths_by_dirpath.items():
+            self._get_stanza_cache(dirpath).prune(dirpath_filepaths)
+        caches = set(self._get_stanza_cache_filepath(dirpath) for dirpath in filepaths_by_dirpath)
+        for dirpath, _, filenames in walk(path.join(self.base_directory, 'stanza_cache')):
+            for filepath in (path.join(dirpath, filename) for filename in filenames):
+                if filepath not in caches:
+                    remove(filepath)
+
+    def _get_pool(self, distribution_name):
+        if distribution_name not in self._pools:
+            self._pools[distribution_name] = AptPool(self.base_directory, distribution_name)
+        return self._pools[distribution_name]
+
+    def _resolve(self, filepath):
+        """:returns: the file that the packages file lists for filepath, its counterpart in the pool if it has one"""
+        if not self.config.apt_pool_layout:
+            return filepath
+        distribution_name = path.relpath(filepath, self.base_directory).split(path.sep)[0]
+        return self._get_pool(distribution_name).resolve(filepath)
+
+    def _generate_packages_contents(self, distribution_name, dirpath, filepaths):
+        """:param filepaths: files inside dirpath"""
+        distribution_dirpath = path.join(self.base_directory, distribution_name)
+        # the stanza of a deb in the pool lists its path there, and is generated once for all the codenames
+        filenames = dict((self._resolve(filepath), path.relpath(self._resolve(filepath), distribution_dirpath))
+                         for filepath in filepaths)
+        items_by_dirpath = dict()
+        for filepath, filename in sorted(filenames.items()):
+            items_by_dirpath.setdefault(path.dirname(filepath), []).append((filepath, filename))
+        stanzas, unparsable = [], []
+        with stage('stanzas'):
+            for debs_dirpath, items in sorted(items_by_dirpath.items()):
+                debs_stanzas, debs_unparsable = self._get_stanza_cache(debs_dirpath).get_stanzas(items)
+                stanzas.extend(debs_stanzas)
+                unparsable.extend(debs_unparsable)
+        unparsable_by_relapath = dict()
+        for filepath in unparsable:
+            unparsable_by_relapath.setdefault(path.dirname(filenames[filepath]), []).append(filepath)
+        for relapath, filepaths in sorted(unparsable_by_relapath.items()):
+            logger.warning("generating the stanzas of {} files with apt-ftparchive".format(len(filepaths)))
+            with temporary_directory_context(change_directory=False) as tempdir:
+                for filepath in filepaths:
+                    hard_link_or_raise_exception(filepath, tempdir)
+                with stage('apt-ftparchive packages'):
+                    contents = apt_ftparchive(['packages', tempdir])
+                stanzas.append(contents.replace(tempdir, relapath))
+        return ''.join(stanzas)
+
     def deduce_dirname(self, distribution_name, codename, arch): # based on how apt likes it
         return path.join(self.base_directory, distribution_name, 'dists', codename, 'main', 'binary-%s' % TRANSLATE_ARCH[arch])
 
     def are_you_interested_in_file(self, filepath, platform, arch):
-        if not filepath.endswith('deb'):
+        return self.are_you_interested_in_artifact(ParsedArtifact.from_filepath(filepath, platform, arch))
+
+    def are_you_interested_in_artifact(self, artifact):
+        platform, arch = artifact.platform, artifact.arch
+        if not artifact.filepath.endswith('deb'):
             return False
-        if not is_really_deb(filepath):
+        if artifact.package_type != 'deb':
             return False
         distribution_name, codename = platform.rsplit('-', 1)
         return distribution_name in KNOWN_DISTRIBUTIONS and \
                codename in KNOWN_DISTRIBUTIONS[distribution_name] and \
                arch in TRANSLATE_ARCH and \
-               TRANSLATE_ARCH[arch] in KNOWN_DISTRIBUTIONS[distribution_name][codename] and \
-               is_really_deb(filepath)
+               TRANSLATE_ARCH[arch] in KNOWN_DISTRIBUTIONS[distribution_name][codename]
 
     def generate_release_file_for_specific_distribution_and_version(self, distribution, codename, force=True):
         dirpath = path.join(self.base_directory, distribution, 'dists', codename)
@@ -77,37 +320,103 @@ class AptIndexer(Indexer):
         release_gpg = release + '.gpg'
         if path.exists(release) and not force:
             return
-        # write release file
-        contents = apt_ftparchive(['release', dirpath])
-        with fopen(release, 'w') as fd:
-            available_archs = sorted(KNOWN_DISTRIBUTIONS[distribution][codename])
-            fd.write(RELEASE_FILE_HEADER.format(codename, " ".join(available_archs), contents))
-        # delete old release signature files
-        for filepath in [in_release, release_gpg]:
+        # write and sign the release file under temporary names, so clients never see a partial or unsigned one
+        filepaths = [release, in_release, release_gpg]
+        release_tmp, in_release_tmp, release_gpg_tmp = temporary_filepaths = [item + '.tmp' for item in filepaths]
+        for filepath in temporary_filepaths:
             if path.exists(filepath):
                 remove(filepath)
+        with stage('release'):
+            contents = generate_release_contents(dirpath)
+        with fopen(release_tmp, 'w') as fd:
+            available_archs = sorted(KNOWN_DISTRIBUTIONS[distribution][codename])
+            fd.write(RELEASE_FILE_HEADER.format(codename, " ".join(available_archs), contents))
         # sign release file
-        if codename == "trusty":
+        with stage('gpg'):
             # trusty doesn't support SHA256 for InRelease
-            gpg(['--clearsign', '--digest-algo', 'SHA1', '-o', in_release, release])
-        else:
-            gpg(['--clearsign', '--digest-algo', 'SHA256', '-o', in_release, release])
-        gpg(['-abs', '-o', release_gpg, release])
+            signer.sign_clear(release_tmp, in_release_tmp, 'SHA1' if codename == "trusty" else 'SHA256')
+            signer.sign_detached(release_tmp, release_gpg_tmp)
+        for src, dst in zip(temporary_filepaths, filepaths):
+            rename(src, dst)
 
-    def consume_file(self, filepath, platform, arch):
+    def get_lock_target(self, filepath, platform, arch):
+        # the Release file is per codename, so ingests to the same codename must serialize; the pool is shared by all
+        # the codenames of the distribution, so with it ingests to the same distribution must serialize
+        return platform.rsplit('-', 1)[0] if self.config.apt_pool_layout else platform
+
+    def _link_and_sign(self, filepath, platform, arch):
         from infi.app_repo.utils import sign_deb_package
         distribution_name, codename = platform.rsplit('-', 1)
         dirpath = self.deduce_dirname(distribution_name, codename, arch)
-        hard_link_or_raise_exception(filepath, dirpath)
-        sign_deb_package(filepath)
-        with temporary_directory_context() as tempdir:
-            hard_link_or_raise_exception(filepath, tempdir)
-            contents = apt_ftparchive(['packages', tempdir])
-            relapath = dirpath.replace(path.join(self.base_directory, distribution_name), '').strip(path.sep)
-            fixed_contents = contents.replace(tempdir, relapath)
-            write_to_packages_file(dirpath, fixed_contents, 'a')
+        if self.config.apt_pool_layout:
+            self._link_and_sign_in_pool(filepath, distribution_name, dirpath)
+            return dirpath
+        with stage('link'):
+            hard_link_or_raise_exception(filepath, dirpath)
+        with stage('dpkg-sig'):
+            sign_deb_package(filepath)
+        return dirpath
+
+    def _link_and_sign_in_pool(self, filepath, distribution_name, dirpath):
+        """Signs the deb only if no content-identical deb is in the distribution's pool yet; if one is, filepath is
+        replaced with a hard link to it, so the indexers that consume filepath next get the signed deb as well"""
+        from infi.app_repo.utils import sign_deb_package, hard_link_and_override
+        pool = self._get_pool(distribution_name)
+        basename = path.basename(filepath)
+        with stage('digest'):
+            digest = _hash_file(filepath, (('SHA256', 'sha256'),))['SHA256']
+        pool_filepath = pool.get_pool_filepath(digest)
+        if pool_filepath is None:
+            pool_dirpath = path.join(self.base_directory, distribution_name, 'pool', 'main', basename[0].lower())
+            ensure_directory_exists(pool_dirpath)
+            with stage('link'):
+                pool_filepath = hard_link_or_raise_exception(filepath, pool_dirpath)
+            with stage('dpkg-sig'):
+                sign_deb_package(pool_filepath)
+            pool.add(digest, pool_filepath)
+        else:
+            logger.info("{} is already in the pool as {}".format(basename, pool_filepath))
+            with stage('link'):
+                hard_link_and_override(pool_filepath, filepath + '.pooled')
+                rename(filepath + '.pooled', filepath)
+        with stage('link'):
+            dst = hard_link_or_raise_exception(pool_filepath, path.join(dirpath, basename))
+        pool.add_reference(dst, pool_filepath)
+
+    def _append_to_packages_file(self, distribution_name, dirpath, filepaths):
+        filepaths = [path.join(dirpath, path.basename(filepath)) for filepath in filepaths]
+        write_to_packages_file(dirpath, self._generate_packages_contents(distribution_name, dirpath, filepaths), 'a')
+
+    def consume_file(self, filepath, platform, arch):
+        distribution_name, codename = platform.rsplit('-', 1)
+        dirpath = self._link_and_sign(filepath, platform, arch)
+        self._append_to_packages_file(distribution_name, dirpath, [filepath])
         self.generate_release_file_for_specific_distribution_and_version(distribution_name, codename)
 
+    def consume_files(self, items):
+        failures, filepaths_by_dirpath, filepaths_by_platform = dict(), dict(), dict()
+        for filepath, platform, arch in items:
+            try:
+                dirpath = self._link_and_sign(filepath, platform, arch)
+            except Exception as error:
+                failures[filepath] = error
+                continue
+            filepaths_by_dirpath.setdefault((platform, dirpath), []).append(filepath)
+            filepaths_by_platform.setdefault(platform, []).append(filepath)
+        for (platform, dirpath), filepaths in filepaths_by_dirpath.items():
+            distribution_name, codename = platform.rsplit('-', 1)
+            try:
+                self._append_to_packages_file(distribution_name, dirpath, filepaths)
+            except Exception as error:
+                failures.update(dict.fromkeys(filepaths, error))
+        for platform, filepaths in filepaths_by_platform.items():
+            distribution_name, codename = platform.rsplit('-', 1)
+            try:
+                self.generate_release_file_for_specific_distribution_and_version(distribution_name, codename)
+            except Exception as error:
+                failures.update({filepath: error for filepath in filepaths if filepath not in failures})
+        return failures
+
     def iter_files(self):
         ensure_directory_exists(self.base_directory)
         for distribution_name, distribution_dict in KNOWN_DISTRIBUTIONS.items():
@@ -117,14 +426,85 @@ class AptIndexer(Indexer):
                     for filepath in glob(path.join(dirpath, '*.deb')):
                         yield filepath
 
-    def rebuild_index(self):
-        cache_file = path.join(self.base_directory, 'apt_cache.db')
-        for distribution_name, distribution_dict in KNOWN_DISTRIBUTIONS.items():
-            for version, architectures in distribution_dict.items():
+    def _rebuild_packages_file(self, distribution_name, codename, arch):
+        dirpath = self.deduce_dirname(distribution_name, codename, arch)
+        filepaths = glob(path.join(dirpath, '*.deb'))
+        write_to_packages_file(dirpath, self._generate_packages_contents(distribution_name, dirpath, filepaths), 'w')
+        self._rebuild_progress['done'] += 1
+        return filepaths
+
+    def _rebuild_codename(self, pool, distribution_name, codename, architectures):
+        greenlets = [pool.spawn(self._rebuild_packages_file, distribution_name, codename, arch) for arch in architectures]
+        safe_joinall(greenlets, raise_error=True)
+        # the release file lists the packages files, so it is generated only after all of them are
+        self.generate_release_file_for_specific_distribution_and_version(distribution_name, codename)
+        return [filepath for greenlet in greenlets for filepath in greenlet.get()]
+
+    def _rebuild_index_with_apt_ftparchive_generate(self):
+        """Rebuilds the packages and contents files of each distribution with a single `apt-ftparchive generate`"""
+        from infi.app_repo.errors import IndexRebuildFailed
+        if self.config.apt_pool_layout:
+            # apt-ftparchive lists the debs under the binary directories, while ingests list them in the pool
+            raise IndexRebuildFailed("the apt-ftparchive-generate rebuild mode does not support the apt pool layout")
+        self._rebuild_progress = dict(done=0, total=len(KNOWN_DISTRIBUTIONS))
+        for distribution_name, distribution_dict in sorted(KNOWN_DISTRIBUTIONS.items()):
+            config_filepath = path.join(self.base_directory, distribution_name, 'apt-ftparchive.conf')
+            write_file(config_filepath, generate_apt_ftparchive_config(self.base_directory, distribution_name))
+            with stage('apt-ftparchive generate'):
+                apt_ftparchive(['generate', config_filepath])
+            for codename, architectures in distribution_dict.items():
                 for arch in architectures:
-                    dirpath = self.deduce_dirname(distribution_name, version, arch)
-                    contents = apt_ftparchive(['packages', '--db', cache_file, dirpath])
-                    relapath = dirpath.replace(path.join(self.base_directory, distribution_name), '').strip(path.sep)
-                    fixed_contents = contents.replace(dirpath, relapath)
-                    write_to_packages_file(dirpath, fixed_contents, 'w')
-                self.generate_release_file_for_specific_distribution_and_version(distribution_name, version)
+                    # the compressed files were rewritten as a single member, there is nothing to compact
+                    write_file(path.join(self.deduce_dirname(distribution_name, codename, arch), '.Packages.appends'), '0')
+                self.generate_release_file_for_specific_distribution_and_version(distribution_name, codename)
+            self._rebuild_progress['done'] += 1
+        self._prune(list(self.iter_files()))
+
+    def _prune(self, filepaths):
+        """Forgets the pooled debs and the cached stanzas of the debs that are not in filepaths"""
+        if self.config.apt_pool_layout:
+            for distribution_name in KNOWN_DISTRIBUTIONS:
+                distribution_dirpath = path.join(self.base_directory, distribution_name)
+                self._get_pool(distribution_name).prune([filepath for filepath in filepaths
+                                                         if filepath.startswith(distribution_dirpath + path.sep)])
+        self._prune_stanza_caches(set(self._resolve(filepath) for filepath in filepaths))
+
+    def rebuild_index(self):
+        """Rebuilds the packages files of all codenames and architectures concurrently, see get_rebuild_workers"""
+        from gevent.pool import Pool
+        if self.config.apt_rebuild_mode == 'apt-ftparchive-generate':
+            return self._rebuild_index_with_apt_ftparchive_generate()
+        pool = Pool(self.config.get_rebuild_workers())
+        codenames = [(distribution_name, codename, architectures)
+                     for distribution_name, distribution_dict in KNOWN_DISTRIBUTIONS.items()
+                     for codename, architectures in distribution_dict.items()]
+        self._rebuild_progress = dict(done=0, total=sum(len(architectures) for _, _, architectures in codenames))
+        greenlets = [safe_spawn(self._rebuild_codename, pool, *item) for item in codenames]
+        safe_joinall(greenlets)
+        self._prune([filepath for greenlet in greenlets for filepath in greenlet.get()])
+
+    def delete_artifact(self, filepath):
+        """Removes the file's stanza from its packages file, and regenerates only its codename's release file"""
+        dirpath = path.dirname(filepath)
+        parts = path.relpath(dirpath, self.base_directory).split(path.sep)
+        if path.exists(filepath):
+            remove(filepath)
+        if len(parts) != 5 or parts[1] != 'dists' or parts[0] not in KNOWN_DISTRIBUTIONS or \
+           parts[2] not in KNOWN_DISTRIBUTIONS[parts[0]]:
+            return False
+        distribution_name, _, codename = parts[:3]
+        if not path.exists(path.join(dirpath, 'Packages')):
+            return False
+        # the stanza lists the deb in the pool, or in dirpath if it was indexed before the pool layout was turned on
+        distribution_dirpath = path.join(self.base_directory, distribution_name)
+        filenames = set(path.relpath(item, distribution_dirpath) for item in (filepath, self._resolve(filepath)))
+        removed = remove_from_packages_file(dirpath, filenames)
+        if self.config.apt_pool_layout:
+            self._get_pool(distribution_name).remove_reference(filepath)
+        if not removed:
+            return False
+        self.generate_release_file_for_specific_distribution_and_version(distribution_name, codename)
+        return True
+
+    def get_rebuild_progress(self):
+        return dict(self._rebuild_progress)
@@ -1,4 +1,4 @@
-from infi.gevent_utils.os import path
+from infi.gevent_utils.os import path, remove
 
 
 class Indexer(object):
@@ -16,9 +16,55 @@ class Indexer(object):
     def consume_file(self, filepath, platform, arch):
         raise NotImplementedError()
 
+    def consume_files(self, items):
+        """Consumes several files, regenerating the metadata of each affected directory only once.
+
+        :param items: list of (filepath, platform, arch) tuples
+        :returns: dict mapping each file that failed to the exception it failed with"""
+        failures = dict()
+        for filepath, platform, arch in items:
+            try:
+                self.consume_file(filepath, platform, arch)
+            except Exception as error:
+                failures[filepath] = error
+        return failures
+
+    # The artifact methods receive the ParsedArtifact that the service builds once per ingested file.
+    # By default they fall back to the file methods above; indexers that use the parsed details override them,
+    # and implement the file methods by building the artifact themselves.
+
+    def are_you_interested_in_artifact(self, artifact):
+        return self.are_you_interested_in_file(artifact.filepath, artifact.platform, artifact.arch)
+
+    def consume_artifact(self, artifact):
+        return self.consume_file(artifact.filepath, artifact.platform, artifact.arch)
+
+    def consume_artifacts(self, artifacts):
+        """Same as consume_files, for a list of ParsedArtifact objects"""
+        return self.consume_files([(artifact.filepath, artifact.platform, artifact.arch) for artifact in artifacts])
+
+    def get_lock_target_for_artifact(self, artifact):
+        return self.get_lock_target(artifact.filepath, artifact.platform, artifact.arch)
+
+    def get_lock_target(self, filepath, platform, arch):
+        """:returns: the name of the directory consume_file writes to, or None if it touches the whole index"""
+        return None
+
     def rebuild_index(self):
         raise NotImplementedError()
 
+    def delete_artifact(self, filepath):
+        """Deletes a file that iter_files returned.
+
+        :returns: True if the index was updated accordingly, False if it needs to be rebuilt"""
+        if path.exists(filepath):
+            remove(filepath)
+        return False
+
+    def get_rebuild_progress(self):
+        """:returns: dict with the number of done and total steps of the running rebuild_index, if it counts them"""
+        return dict()
+
     def initialise(self):
         raise NotImplementedError()
 
@@ -2,7 +2,7 @@ from .base import Indexer
 from infi.gevent_utils.os import path
 from infi.gevent_utils.glob import glob
 from infi.app_repo.utils import ensure_directory_exists, hard_link_or_raise_exception
-from infi.app_repo.filename_parser import parse_filepath, FilenameParsingFailed
+from infi.app_repo.artifact import ParsedArtifact
 
 
 class PypiIndexer(Indexer):
@@ -12,18 +12,20 @@ class PypiIndexer(Indexer):
         ensure_directory_exists(self.base_directory)
 
     def are_you_interested_in_file(self, filepath, platform, arch):
-        try:
-            package_name, package_version, platform_string, architecture, extension = parse_filepath(filepath)
-        except FilenameParsingFailed:
-            return False
-        return platform_string == 'python' and architecture == 'sdist'
+        return self.are_you_interested_in_artifact(ParsedArtifact.from_filepath(filepath, platform, arch))
+
+    def are_you_interested_in_artifact(self, artifact):
+        return artifact.platform_string == 'python' and artifact.architecture == 'sdist'
 
     def consume_file(self, filepath, platform, arch):
-        package_name, package_version, platform_string, architecture, extension = parse_filepath(filepath)
-        directory = path.join(self.base_directory, package_name.replace('_', '-'))
+        self.consume_artifact(ParsedArtifact.from_filepath(filepath, platform, arch))
+
+    def consume_artifact(self, artifact):
+        artifact.assert_parsed()
+        directory = path.join(self.base_directory, artifact.package_name.replace('_', '-'))
         ensure_directory_exists(directory)
-        filename = '{0}-{1}.tar.gz'.format(package_name, package_version)
-        hard_link_or_raise_exception(filepath, path.join(directory, filename))
+        filename = '{0}-{1}.tar.gz'.format(artifact.package_name, artifact.package_version)
+        hard_link_or_raise_exception(artifact.filepath, path.join(directory, filename))
 
     def iter_files(self):
         return glob(path.join(self.base_directory, '*', '*.tar.gz'))
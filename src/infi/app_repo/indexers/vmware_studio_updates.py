@@ -1,7 +1,8 @@
 from .base import Indexer
 from infi.gevent_utils.os import path, symlink, remove
 from infi.gevent_utils.glob import glob
-from infi.app_repo.filename_parser import parse_filepath, FilenameParsingFailed
+from infi.app_repo.filename_parser import parse_many
+from infi.app_repo.artifact import ParsedArtifact
 from infi.app_repo.utils import ensure_directory_exists, hard_link_or_raise_exception, log_execute_assert_success
 from infi.app_repo.utils import ensure_directory_exists
 
@@ -22,11 +23,10 @@ class VmwareStudioUpdatesIndexer(Indexer):
         self._override_updates_symlink(self.base_directory, path.join(self.base_directory, 'updates')) # legacy
 
     def are_you_interested_in_file(self, filepath, platform, arch):
-        try:
-            package_name, package_version, platform_string, architecture, extension = parse_filepath(filepath)
-        except FilenameParsingFailed:
-            return False
-        if ARCH in architecture:
+        return self.are_you_interested_in_artifact(ParsedArtifact.from_filepath(filepath, platform, arch))
+
+    def are_you_interested_in_artifact(self, artifact):
+        if artifact.is_parsed and ARCH in artifact.architecture:
             return True
         return False
 
@@ -34,8 +34,11 @@ class VmwareStudioUpdatesIndexer(Indexer):
         from pkg_resources import parse_version
         latest_update_file, latest_version = None, parse_version('0')
         update_files = [filepath for filepath in glob(path.join(dirpath, '*.zip')) if ARCH in filepath]
+        parsed, _ = parse_many(update_files)
         for filepath in update_files:
-            package_name, package_version, platform_string, architecture, extension = parse_filepath(filepath)
+            if filepath not in parsed:
+                continue
+            package_name, package_version, platform_string, architecture, extension = parsed[filepath]
             package_version = parse_version(package_version)
             if package_version > latest_version:
                 latest_version = package_version
@@ -46,10 +49,13 @@ class VmwareStudioUpdatesIndexer(Indexer):
         log_execute_assert_success(["unzip", "-qq", "-o", filepath, "-d", dirpath])
 
     def consume_file(self, filepath, platform, arch):
-        package_name, package_version, platform_string, architecture, extension = parse_filepath(filepath)
-        package_dir = path.join(self.base_directory, package_name)
+        self.consume_artifact(ParsedArtifact.from_filepath(filepath, platform, arch))
+
+    def consume_artifact(self, artifact):
+        artifact.assert_parsed()
+        package_dir = path.join(self.base_directory, artifact.package_name)
         ensure_directory_exists(package_dir)
-        final_filepath = hard_link_or_raise_exception(filepath, package_dir)
+        final_filepath = hard_link_or_raise_exception(artifact.filepath, package_dir)
         if self._get_latest_update_file_in_directory(package_dir) == final_filepath:
             self._extract_update(package_dir, final_filepath)
 
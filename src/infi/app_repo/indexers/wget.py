@@ -1,11 +1,12 @@
 
 from .base import Indexer
-from infi.gevent_utils.os import path, fopen, remove
-from infi.gevent_utils.glob import glob
-from infi.app_repo.utils import ensure_directory_exists, hard_link_or_raise_exception, write_file
-from infi.app_repo.utils import is_really_rpm, is_really_deb, log_execute_assert_success
+from infi.gevent_utils.os import path, fopen, remove, stat
+from infi.gevent_utils.deferred import create_threadpool_executed_func
+from infi.app_repo.utils import ensure_directory_exists, hard_link_or_raise_exception, write_file, read_file
 from infi.gevent_utils.json_utils import decode, encode
-from infi.app_repo.filename_parser import parse_filepath, FilenameParsingFailed
+from infi.app_repo.artifact import ParsedArtifact
+from infi.app_repo.catalog import Catalog, nest_distributions
+from infi.app_repo.metrics import stage
 from pkg_resources import parse_version
 from logbook import Logger
 logger = Logger(__name__)
@@ -25,6 +26,14 @@ PIP_UGPRADE_COMMAND = 'sudo pip install --upgrade --trusted-host /// --extra-ind
 MANUAL_COMMAND = "curl -s ///install/{0}/{1} | sudo sh -"
 SOLARIS_MANUAL_COMMAND = """curl -s ///install/{0}/{1} | su root -c "PATH=$PATH bash" -"""
 
+# base directory -> lock of the files that all the packages of the index share: packages.json and the catalog's creation
+_shared_files_locks = dict()
+
+
+def _get_shared_files_lock(base_directory):
+    from gevent.lock import RLock
+    return _shared_files_locks.setdefault(base_directory, RLock())
+
 
 def ensure_packages_json_file_exists_in_directory(dirpath):
     filepath = path.join(dirpath, 'packages.json')
@@ -39,35 +48,205 @@ def ensure_packages_json_file_exists_in_directory(dirpath):
         fd.write('[]')
 
 
+def get_distribution_relpath(distribution):
+    """:param distribution: catalog row
+    :returns: the path of the file, relative to the base directory of the index"""
+    return path.join('packages', distribution['package'], 'releases', distribution['version'],
+                     'distributions', distribution['platform'], 'architectures', distribution['architecture'],
+                     'extensions', distribution['extension'], distribution['basename'])
+
+
+def get_default_product_name(package_name):
+    return ' '.join(word.capitalize() for word in package_name.split('-')).strip()
+
+
+def _scan_tree(dirpath, prune_empty_directories):
+    """Lists the directory recursively with scandir, which tells the directories from the files without a stat call.
+    The empty directories are removed, depth first, as `find -type d -empty -delete` would remove them
+
+    :returns: dict mapping the names of the entries to 2-tuples (DirEntry, the same kind of dict for a directory, or
+              None for a file)"""
+    from os import scandir, rmdir
+    tree = dict()
+    with scandir(dirpath) as iterator:
+        entries = list(iterator)
+    for entry in entries:
+        if not entry.is_dir(follow_symlinks=False):
+            tree[entry.name] = (entry, None)
+            continue
+        children = _scan_tree(entry.path, prune_empty_directories)
+        if children or not prune_empty_directories:
+            tree[entry.name] = (entry, children)
+            continue
+        try:
+            rmdir(entry.path)
+        except OSError:
+            logger.exception("failed to remove empty directory {}".format(entry.path))
+            tree[entry.name] = (entry, children)
+    return tree
+
+
+def _iter_subdirectories(tree, name=None):
+    """:param name: if given, lists the subdirectories of this subdirectory of the tree instead
+    :returns: iterator of 2-tuples (DirEntry, tree) of the subdirectories, skipping the ones whose names start with a
+              dot"""
+    if name is not None:
+        tree = (tree.get(name) or (None, None))[1] or dict()
+    for name, (entry, children) in sorted(tree.items()):
+        if children is not None and not name.startswith('.'):
+            yield entry, children
+
+
+def _read_marker(tree, name):
+    """:returns: the contents of a file of the tree, stripped, or None if there is no such file or it is unreadable"""
+    if name not in tree:
+        return None
+    try:
+        with open(tree[name][0].path) as fd:
+            return fd.read().strip()
+    except Exception:
+        return None
+
+
+def _parse_release_date(text):
+    from dateutil.parser import parse
+    try:
+        return parse(text).date().isoformat()
+    except Exception:
+        return None
+
+
+@create_threadpool_executed_func
+def walk_packages(base_directory, prune_empty_directories=False):
+    """Walks the directory tree of a pretty index once, in a thread so the hub serves requests meanwhile.
+
+    The hidden markers and the other files next to the packages and releases are found in the directory listings, and
+    the sizes and mtimes come from the stat the entries cache, so each directory is listed once and each file or
+    release directory is stat-ed once.
+
+    Releases without distributions and packages without releases are left out, as delete_artifact removes them from
+    the catalog.
+
+    :returns: 3-tuple (packages, releases, distributions), lists of catalog rows"""
+    tree = _scan_tree(base_directory, prune_empty_directories)
+    packages, releases, distributions = [], [], []
+    for package_entry, package_tree in _iter_subdirectories(tree, 'packages'):
+        package_name = package_entry.name
+        package_releases = len(releases)
+        for release_entry, release_tree in _iter_subdirectories(package_tree, 'releases'):
+            release_distributions = len(distributions)
+            for distribution_entry, distribution_tree in _iter_subdirectories(release_tree, 'distributions'):
+                for arch_entry, arch_tree in _iter_subdirectories(distribution_tree, 'architectures'):
+                    for extension_entry, extension_tree in _iter_subdirectories(arch_tree, 'extensions'):
+                        entries = [entry for name, (entry, _) in extension_tree.items() if not name.startswith('.')]
+                        if len(entries) != 1:
+                            logger.warn("expected only one file under {}, but it is not the case".format(extension_entry.path))
+                            continue
+                        stat_result = entries[0].stat()
+                        distributions.append(dict(package=package_name,
+                                                  version=release_entry.name,
+                                                  platform=distribution_entry.name,
+                                                  architecture=arch_entry.name,
+                                                  extension=extension_entry.name,
+                                                  basename=entries[0].name,
+                                                  hidden='hidden' in distribution_tree or 'hidden' in arch_tree or \
+                                                         'hidden' in extension_tree,
+                                                  size=stat_result.st_size,
+                                                  mtime=stat_result.st_mtime))
+            if len(distributions) > release_distributions:
+                release_date = _read_marker(release_tree, 'release_date')
+                releases.append(dict(package=package_name,
+                                     version=release_entry.name,
+                                     hidden='hidden' in release_tree,
+                                     mtime=release_entry.stat().st_mtime,
+                                     release_date=_parse_release_date(release_date) if release_date else None))
+        if len(releases) > package_releases:
+            packages.append(dict(name=package_name,
+                                 hidden='hidden' in package_tree,
+                                 product_name=_read_marker(package_tree, 'product_name') or get_default_product_name(package_name),
+                                 release_notes_url=_read_marker(package_tree, 'release_notes_url')))
+    return packages, releases, distributions
+
+
 class PrettyIndexer(Indexer):
+    """Lays out the files by package, release, distribution, architecture and extension, and writes the json files the
+    home page shows.
+
+    The catalog lists what is on disk; consume_file and delete_artifact keep it up to date, reconcile resyncs it."""
     INDEX_TYPE = 'index'
 
+    def __init__(self, config, index_name):
+        super(PrettyIndexer, self).__init__(config, index_name)
+        self._catalog = None
+
     def initialise(self):
         ensure_directory_exists(self.base_directory)
         ensure_packages_json_file_exists_in_directory(self.base_directory)
 
     def are_you_interested_in_file(self, filepath, platform, arch):
-        try:
-            package_name, package_version, platform_string, architecture, extension = parse_filepath(filepath)
-        except FilenameParsingFailed:
+        return self.are_you_interested_in_artifact(ParsedArtifact.from_filepath(filepath, platform, arch))
+
+    def get_lock_target(self, filepath, platform, arch):
+        return self.get_lock_target_for_artifact(ParsedArtifact.from_filepath(filepath, platform, arch))
+
+    def get_lock_target_for_artifact(self, artifact):
+        # consume_file writes the directory and the json files of the package only, and takes a lock of its own for
+        # packages.json
+        return artifact.package_name if artifact.is_parsed else None
+
+    def are_you_interested_in_artifact(self, artifact):
+        if not artifact.is_parsed:
             return False
-        if package_name == 'python':
+        if artifact.package_name == 'python':
             return False
-        if filepath.endswith('deb') and not is_really_deb(filepath):
+        if artifact.filepath.endswith('deb') and artifact.package_type != 'deb':
             return False
-        if filepath.endswith('rpm') and not is_really_rpm(filepath):
+        if artifact.filepath.endswith('rpm') and artifact.package_type != 'rpm':
             return False
         return True
 
-    def consume_file(self, filepath, platform, arch):
-        package_name, package_version, platform_string, architecture, extension = parse_filepath(filepath)
-        platform_string = "vmware-esx" if extension == "ova" else platform_string # TODO this needs to change in our build
-        dirpath = path.join(self.base_directory, 'packages', package_name, 'releases', package_version,
-                            'distributions', platform_string, 'architectures', architecture,
-                            'extensions', extension)
+    def _link(self, artifact):
+        artifact.assert_parsed()
+        platform_string = "vmware-esx" if artifact.extension == "ova" else artifact.platform_string # TODO this needs to change in our build
+        dirpath = path.join(self.base_directory, 'packages', artifact.package_name, 'releases', artifact.package_version,
+                            'distributions', platform_string, 'architectures', artifact.architecture,
+                            'extensions', artifact.extension)
         ensure_directory_exists(dirpath)
-        hard_link_or_raise_exception(filepath, dirpath)
-        self.rebuild_index()
+        with stage('link'):
+            filepath = hard_link_or_raise_exception(artifact.filepath, dirpath)
+        package_dirpath = path.join(self.base_directory, 'packages', artifact.package_name)
+        with stage('catalog'):
+            self._get_catalog().add([self._scan_package(package_dirpath)],
+                                    [self._scan_release(artifact.package_name, path.join(package_dirpath, 'releases', artifact.package_version))],
+                                    [self._scan_distribution(artifact.package_name, artifact.package_version, filepath)])
+        return artifact.package_name
+
+    def consume_file(self, filepath, platform, arch):
+        self.consume_artifact(ParsedArtifact.from_filepath(filepath, platform, arch))
+
+    def consume_artifact(self, artifact):
+        package_name = self._link(artifact)
+        with stage('update_packages'):
+            self.update_packages([package_name])
+
+    def consume_files(self, items):
+        return self.consume_artifacts([ParsedArtifact.from_filepath(*item) for item in items])
+
+    def consume_artifacts(self, artifacts):
+        failures, package_names = dict(), dict()
+        for artifact in artifacts:
+            try:
+                package_names.setdefault(self._link(artifact), []).append(artifact.filepath)
+            except Exception as error:
+                failures[artifact.filepath] = error
+        if package_names:
+            try:
+                with stage('update_packages'):
+                    self.update_packages(list(package_names))
+            except Exception as error:
+                for filepaths in package_names.values():
+                    failures.update(dict.fromkeys(filepaths, error))
+        return failures
 
     def _normalize_url(self, dirpath):
         return dirpath.replace(self.config.artifacts_directory, '')
@@ -80,7 +259,7 @@ class PrettyIndexer(Indexer):
             with fopen(path.join(dirpath, 'product_name')) as fd:
                 return fd.read().strip()
         except:
-            return ' '.join(word.capitalize() for word in path.basename(dirpath).split('-')).strip()
+            return get_default_product_name(path.basename(dirpath))
 
     def _deduce_release_notes_url(self, dirpath):
         try:
@@ -89,15 +268,6 @@ class PrettyIndexer(Indexer):
         except:
             return None
 
-    def _iter_packages(self):
-        for package_dirpath in glob(path.join(self.base_directory, 'packages', '*')):
-            yield dict(abspath=package_dirpath,
-                       hidden=self._is_hidden(package_dirpath),
-                       product_name=self._deduce_produce_name(package_dirpath),
-                       name=path.basename(package_dirpath),
-                       release_notes_url=self._deduce_release_notes_url(package_dirpath),
-                       releases_uri=self._normalize_url(path.join(package_dirpath, 'releases.json',)))
-
     def _read_release_date_from_file(self, dirpath):
         from dateutil.parser import parse
         try:
@@ -107,40 +277,89 @@ class PrettyIndexer(Indexer):
         except:
             return None
 
-    def _iter_releases(self, package):
-        from os import stat
-        from time import ctime
+    def _scan_package(self, package_dirpath):
+        return dict(name=path.basename(package_dirpath),
+                    hidden=self._is_hidden(package_dirpath),
+                    product_name=self._deduce_produce_name(package_dirpath),
+                    release_notes_url=self._deduce_release_notes_url(package_dirpath))
+
+    def _scan_release(self, package_name, version_dirpath):
+        release_date = self._read_release_date_from_file(version_dirpath)
+        return dict(package=package_name,
+                    version=path.basename(version_dirpath),
+                    hidden=self._is_hidden(version_dirpath),
+                    mtime=stat(version_dirpath).st_mtime,
+                    release_date=release_date.isoformat() if release_date else None)
+
+    def _scan_distribution(self, package_name, version, filepath):
+        extension_dirpath = path.dirname(filepath)
+        arch_dirpath = path.dirname(path.dirname(extension_dirpath))
+        distribution_dirpath = path.dirname(path.dirname(arch_dirpath))
+        stat_result = stat(filepath)
+        return dict(package=package_name,
+                    version=version,
+                    platform=path.basename(distribution_dirpath),
+                    architecture=path.basename(arch_dirpath),
+                    extension=path.basename(extension_dirpath),
+                    basename=path.basename(filepath),
+                    hidden=self._is_hidden(distribution_dirpath) or \
+                           self._is_hidden(arch_dirpath) or \
+                           self._is_hidden(extension_dirpath),
+                    size=stat_result.st_size,
+                    mtime=stat_result.st_mtime)
+
+    def _get_catalog(self, bootstrap=True):
+        """:param bootstrap: fill the catalog from the disk if there is none, as for an index built before it had one"""
+        if self._catalog is None:
+            ensure_directory_exists(self.base_directory)
+            catalog = Catalog(path.join(self.base_directory, 'catalog.sqlite'))
+            with _get_shared_files_lock(self.base_directory):
+                if not catalog.exists():
+                    catalog.create()
+                    if bootstrap:
+                        catalog.replace(*walk_packages(self.base_directory))
+            self._catalog = catalog
+        return self._catalog
+
+    def reconcile(self):
+        """Resyncs the catalog with the directory tree, and updates the index of the packages that were out of sync;
+        necessary after files were added, removed, hidden or unhidden by hand
+
+        :returns: the names of the packages that were out of sync"""
+        package_names = self._get_catalog().replace(*walk_packages(self.base_directory))
+        if package_names:
+            logger.info("the catalog of {} was out of sync with {}".format(self.index_name, ", ".join(package_names)))
+            self.update_packages(package_names)
+        return package_names
+
+    def _get_package(self, row):
+        package_dirpath = path.join(self.base_directory, 'packages', row['name'])
+        return dict(abspath=package_dirpath,
+                    hidden=row['hidden'],
+                    product_name=row['product_name'],
+                    name=row['name'],
+                    release_notes_url=row['release_notes_url'],
+                    releases_uri=self._normalize_url(path.join(package_dirpath, 'releases.json',)))
+
+    def _get_release(self, package, row):
         from datetime import date, datetime
-        for version_dirpath in glob(path.join(package['abspath'], 'releases', '*')):
-            mod_time = stat(version_dirpath).st_mtime
-            release_date = self._read_release_date_from_file(version_dirpath) or mod_time
-            release = dict(version=path.basename(version_dirpath),
-                           hidden=self._is_hidden(version_dirpath),
-                           abspath=version_dirpath,
-                           last_modified=datetime.fromtimestamp(mod_time).isoformat() if mod_time else '',
-                           last_modified_timestamp=int(mod_time) if mod_time else None,
-                           release_date=date.fromtimestamp(release_date).isoformat() if release_date else '',
-                           )
-            yield release
-
-    def _iter_distributions(self, package, release):
-        for distribution_dirpath in glob(path.join(release['abspath'], 'distributions', '*')):
-            for arch_dirpath in glob(path.join(distribution_dirpath, 'architectures', '*')):
-                for extension_dirpath in glob(path.join(arch_dirpath, 'extensions', '*')):
-                    try:
-                        [filepath] = list(glob(path.join(extension_dirpath, '*')))
-                    except ValueError:
-                        logger.warn("expected only one file under {}, but it is not the case".format(extension_dirpath))
-                        continue
-                    distribution = dict(platform=path.basename(distribution_dirpath),
-                                        hidden=self._is_hidden(distribution_dirpath) or \
-                                               self._is_hidden(arch_dirpath) or \
-                                               self._is_hidden(extension_dirpath),
-                                        architecture=path.basename(arch_dirpath),
-                                        extension=path.basename(extension_dirpath),
-                                        filepath=self._normalize_url(filepath),
-                                        filesize=path.getsize(filepath))
-                    yield distribution
+        mod_time = row['mtime']
+        release_date = row['release_date'] or (date.fromtimestamp(mod_time).isoformat() if mod_time else '')
+        return dict(version=row['version'],
+                    hidden=row['hidden'],
+                    abspath=path.join(package['abspath'], 'releases', row['version']),
+                    last_modified=datetime.fromtimestamp(mod_time).isoformat() if mod_time else '',
+                    last_modified_timestamp=int(mod_time) if mod_time else None,
+                    release_date=release_date,
+                    )
+
+    def _get_distribution(self, row):
+        return dict(platform=row['platform'],
+                    hidden=row['hidden'],
+                    architecture=row['architecture'],
+                    extension=row['extension'],
+                    filepath=self._normalize_url(path.join(self.base_directory, get_distribution_relpath(row))),
+                    filesize=row['size'])
 
     def _get_latest_release(self, releases):
         def sort_by_version(release):
@@ -285,33 +504,90 @@ class PrettyIndexer(Indexer):
         return installation_instructions
 
     def iter_files(self):
-        for package in self._iter_packages():
-            for release in self._iter_releases(package):
-                for distribution in self._iter_distributions(package, release):
-                    yield path.join(self.config.artifacts_directory, distribution['filepath'].strip(path.sep))
+        for distribution in self._get_catalog().get_distributions():
+            yield path.join(self.base_directory, get_distribution_relpath(distribution))
+
+    def delete_artifact(self, filepath):
+        """Removes the file from the catalog, and updates the index of its package only"""
+        parts = path.relpath(filepath, self.base_directory).split(path.sep)
+        if path.exists(filepath):
+            remove(filepath)
+        if len(parts) != 11 or parts[0:10:2] != ['packages', 'releases', 'distributions', 'architectures', 'extensions']:
+            return False
+        _, package_name, _, version, _, platform, _, architecture, _, extension, _ = parts
+        self._get_catalog().remove_distribution(package_name, version, platform, architecture, extension)
+        self.update_packages([package_name])
+        return True
 
-    def rebuild_index(self):
-        packages = []
-        log_execute_assert_success(['find', self.base_directory, '-type', 'd', '-empty', '-print', '-delete'])
-        for package in self._iter_packages():
-            releases = []
-            for release in sorted(self._iter_releases(package), reverse=True, key=lambda release: parse_version(release['version'])):
-                release['distributions'] = list(self._iter_distributions(package, release))
-                if not release['distributions']:
-                    continue
-                releases.append(release)
-            write_file(path.join(package['abspath'], 'releases.json'), encode(releases, indent=4, large_object=True))
+    def _update_package(self, package, release_rows):
+        """writes releases.json and latest_release.txt of a single package, and adds the latest release details to it
+
+        :param release_rows: the catalog rows of the package's releases, with their distributions
+        :returns: True if the package has releases and belongs in packages.json"""
+        releases = []
+        for row in sorted(release_rows, reverse=True, key=lambda row: parse_version(row['version'])):
+            release = self._get_release(package, row)
+            release['distributions'] = [self._get_distribution(distribution) for distribution in row['distributions']]
+            if not release['distributions']:
+                continue
+            releases.append(release)
+        write_file(path.join(package['abspath'], 'releases.json'), encode(releases, indent=4, large_object=True))
+
+        latest_release = self._get_latest_release(releases)
+        latest_release_txt = path.join(package['abspath'], 'latest_release.txt')
+        if latest_release:
+            package['latest_version'] = latest_release['version']
+            package['latest_version_release_date'] = latest_release['release_date']
+            package['installation_instructions'] = self._get_installation_instructions(package, latest_release)
+            write_file(latest_release_txt, latest_release['version'])
+            return True
+        elif path.exists(latest_release_txt):
+            remove(latest_release_txt)
+        return False
+
+    def _write_packages_json(self, packages):
+        sorted_packages = sorted(packages, key=lambda package: package['product_name'])
+        write_file(path.join(self.base_directory, 'packages.json'), encode(sorted_packages, indent=4, large_object=True))
 
-            latest_release = self._get_latest_release(releases)
-            latest_release_txt = path.join(package['abspath'], 'latest_release.txt')
-            if latest_release:
-                package['latest_version'] = latest_release['version']
-                package['latest_version_release_date'] = latest_release['release_date']
-                package['installation_instructions'] = self._get_installation_instructions(package, latest_release)
+    def _read_packages_json(self):
+        packages = decode(read_file(path.join(self.base_directory, 'packages.json')))
+        if not isinstance(packages, list):
+            raise ValueError("packages.json does not contain a list")
+        return packages
+
+    def update_packages(self, package_names):
+        """Updates the index of the given packages only, leaving the rest of packages.json as is.
+
+        Ingests of other packages may run meanwhile, so packages.json is read and written back under a lock.
+        rebuild_index regenerates everything from scratch, and remains the way to repair the index"""
+        with _get_shared_files_lock(self.base_directory):
+            try:
+                packages = self._read_packages_json()
+            except:
+                logger.exception("failed to read packages.json, rebuilding the index")
+                with stage('rebuild_index'):
+                    return self.rebuild_index()
+            packages = [package for package in packages if package['name'] not in package_names]
+            for package_name in package_names:
+                row = self._get_catalog().get_package(package_name)
+                if row is None:
+                    continue
+                package = self._get_package(row)
+                if self._update_package(package, self._get_catalog().get_releases(package_name)):
+                    packages.append(package)
+            self._write_packages_json(packages)
 
+    def rebuild_index(self):
+        """Removes the empty directories and resyncs the catalog in a single walk of the directory tree, and
+        regenerates the index of all the packages from what the walk found"""
+        packages = []
+        with stage('walk'):
+            package_rows, release_rows, distribution_rows = walk_packages(self.base_directory, prune_empty_directories=True)
+        with stage('catalog'):
+            self._get_catalog(bootstrap=False).replace(package_rows, release_rows, distribution_rows)
+        releases_by_package = nest_distributions(release_rows, distribution_rows)
+        for row in package_rows:
+            package = self._get_package(row)
+            if self._update_package(package, releases_by_package.get(row['name'], [])):
                 packages.append(package)
-                write_file(latest_release_txt, latest_release['version'])
-            elif path.exists(latest_release_txt):
-                remove(latest_release_txt)
-        sorted_packages = sorted(packages, key=lambda package: package['product_name'])
-        write_file(path.join(self.base_directory, 'packages.json'), encode(sorted_packages, indent=4, large_object=True))
+        self._write_packages_json(packages)
@@ -1,28 +1,17 @@
 from .base import Indexer
 from infi.app_repo.utils import hard_link_or_raise_exception, ensure_directory_exists, log_execute_assert_success
-from infi.app_repo.utils import hard_link_and_override, is_really_rpm
-from infi.gevent_utils.os import path, remove
+from infi.app_repo.utils import hard_link_and_override
+from infi.app_repo.artifact import ParsedArtifact
+from infi.app_repo.platforms import KNOWN_PLATFORMS
+from infi.app_repo.metrics import stage
+from infi.app_repo.signer import signer
+from infi.gevent_utils.os import path, remove, rename, readlink, symlink
 from infi.gevent_utils.glob import glob
 from logging import getLogger
 logger = getLogger(__name__)
 
 CREATEREPO_ARGUMENTS = ['createrepo', '--simple-md-filenames', '--pretty', '--checksum=sha1', '--no-database',
-                        '--changelog-limit', '1', '--workers', '10']
-KNOWN_PLATFORMS = {
-    "linux-redhat-5": ("i686", "x86_64"),
-    "linux-redhat-6": ("i686", "x86_64"),
-    "linux-redhat-7": ("x86_64", "ppc64", "ppc64le"),
-    "linux-redhat-8": ("x86_64", "ppc64", "ppc64le"),
-    "linux-centos-5": ("i686", "x86_64"),
-    "linux-centos-6": ("i686", "x86_64"),
-    "linux-centos-7": ("x86_64", "ppc64", "ppc64le"),
-    "linux-centos-8": ("x86_64", "ppc64", "ppc64le"),
-    "linux-rocky-8": ("x86_64", "ppc64", "ppc64le"),
-    "linux-suse-10": ("i686", "x86_64"),
-    "linux-suse-11": ("i686", "x86_64", "ppc64"),
-    "linux-suse-12": ("x86_64", "ppc64le"),
-    "linux-suse-15": ("x86_64",),
-}
+                        '--changelog-limit', '1']
 
 TRANSLATE_ARCH = {'x86': 'i686', 'x64': 'x86_64', 'i686': 'i686', 'x86_64': 'x86_64',
                   'ppc64': 'ppc64', 'ppc64le': 'ppc64le'}
@@ -36,6 +25,8 @@ class YumIndexer(Indexer):
         super(YumIndexer, self).__init__(*args, **kwargs)
         self.cachedir = path.join(self.base_directory, 'cachedir')
         ensure_directory_exists(self.cachedir)
+        self._header_caches = dict()
+        self._rebuild_progress = dict()
 
     def initialise(self):
         from os import path
@@ -54,18 +45,44 @@ class YumIndexer(Indexer):
                 createrepo(dirpath)
 
     def are_you_interested_in_file(self, filepath, platform, arch):
-        return filepath.endswith('.rpm') and \
+        return self.are_you_interested_in_artifact(ParsedArtifact.from_filepath(filepath, platform, arch))
+
+    def are_you_interested_in_artifact(self, artifact):
+        platform, arch = artifact.platform, artifact.arch
+        return artifact.filepath.endswith('.rpm') and \
                platform in KNOWN_PLATFORMS and \
                arch in TRANSLATE_ARCH and \
                TRANSLATE_ARCH[arch] in KNOWN_PLATFORMS[platform] and \
-               is_really_rpm(filepath)
+               artifact.package_type == 'rpm'
 
-    def consume_file(self, filepath, platform, arch):
+    def get_lock_target(self, filepath, platform, arch):
+        return '%s-%s' % (platform, TRANSLATE_ARCH[arch])
+
+    def _link_and_sign(self, filepath, platform, arch):
         from infi.app_repo.utils import sign_rpm_package
         dirpath = path.join(self.base_directory, '%s-%s' % (platform, TRANSLATE_ARCH[arch]))
-        hard_link_or_raise_exception(filepath, dirpath)
-        sign_rpm_package(filepath)
-        self._update_index(dirpath)
+        with stage('link'):
+            linked_filepath = hard_link_or_raise_exception(filepath, dirpath)
+        with stage('rpm --addsign'):
+            sign_rpm_package(filepath, [linked_filepath])
+        return dirpath
+
+    def consume_file(self, filepath, platform, arch):
+        self._update_index(self._link_and_sign(filepath, platform, arch))
+
+    def consume_files(self, items):
+        failures, filepaths_by_dirpath = dict(), dict()
+        for filepath, platform, arch in items:
+            try:
+                filepaths_by_dirpath.setdefault(self._link_and_sign(filepath, platform, arch), []).append(filepath)
+            except Exception as error:
+                failures[filepath] = error
+        for dirpath, filepaths in filepaths_by_dirpath.items():
+            try:
+                self._update_index(dirpath)
+            except Exception as error:
+                failures.update(dict.fromkeys(filepaths, error))
+        return failures
 
     def iter_files(self):
         for platform, architectures in KNOWN_PLATFORMS.items():
@@ -75,24 +92,107 @@ class YumIndexer(Indexer):
                     yield filepath
 
     def rebuild_index(self):
-        for dirpath in glob(path.join(self.base_directory, '*')):
-            self._delete_repo_metadata(dirpath)
-            self._update_index(dirpath)
+        """Rebuilds the repodata of all the directories concurrently, see get_rebuild_workers.
+
+        A directory that fails does not stop the others, the failures are raised together at the end"""
+        from gevent.pool import Pool
+        from infi.app_repo.errors import IndexRebuildFailed
+        workers = self.config.get_rebuild_workers()
+        dirpaths = sorted(glob(path.join(self.base_directory, '*')))
+        # the workers are divided between the createrepo processes that run at the same time
+        createrepo_workers = max(1, workers // max(1, min(workers, len(dirpaths))))
+        self._rebuild_progress = dict(done=0, total=len(dirpaths), directories=dict())
+        Pool(workers).map(lambda dirpath: self._rebuild_directory(dirpath, createrepo_workers), dirpaths)
+        directories = self._rebuild_progress['directories']
+        for name, result in sorted(directories.items()):
+            logger.info("rebuilt {} in {:.3f}s{}".format(name, result['duration'], ' (failed)' if result['error'] else ''))
+        failures = dict((name, result['error']) for name, result in directories.items() if result['error'])
+        if failures:
+            raise IndexRebuildFailed("failed to rebuild {}".format(
+                ", ".join("{}: {}".format(name, error) for name, error in sorted(failures.items()))))
+
+    def _rebuild_directory(self, dirpath, createrepo_workers):
+        from time import time
+        start, error = time(), None
+        try:
+            self._rebuild_repodata(dirpath, createrepo_workers)
+        except Exception as exception:
+            logger.exception("failed to rebuild {}".format(dirpath))
+            error = repr(exception)
+        self._rebuild_progress['directories'][path.basename(dirpath)] = dict(duration=time() - start, error=error)
+        self._rebuild_progress['done'] += 1
+
+    def get_rebuild_progress(self):
+        return dict(self._rebuild_progress)
+
+    def _rebuild_repodata(self, dirpath, createrepo_workers=1, update=False):
+        """Writes and signs the repodata in repodata.new, and then swaps it in, so it is never partial or missing.
+
+        :param update: if createrepo is needed, let it reuse the current repodata and parse only the new rpms"""
+        from infi.app_repo.rpm import write_repodata
+        staging = path.join(dirpath, 'repodata.new')
+        self._delete_repo_metadata(dirpath, 'repodata.new')
+        with stage('headers'):
+            filepaths = sorted(glob(path.join(dirpath, '*.rpm')))
+            header_cache = self._get_header_cache(dirpath)
+            records, unparsable = header_cache.get_records(filepaths)
+            header_cache.prune(filepaths)
+        if unparsable:
+            logger.warning("failed to parse {} rpms in {}, generating its repodata with createrepo".format(len(unparsable), dirpath))
+            self._write_repodata_with_createrepo(dirpath, createrepo_workers, update)
+        else:
+            ensure_directory_exists(staging)
+            with stage('repodata'):
+                write_repodata(staging, records, self._get_databases_dirpath(dirpath))
+        gpg_key = path.join(self.config.packages_directory, 'gpg.key')
+        if path.exists(gpg_key):
+            hard_link_and_override(gpg_key, path.join(staging, 'repomd.xml.key'))
+        with stage('gpg'):
+            sign_repomd(dirpath, 'repodata.new')
+        swap_repodata(dirpath)
+
+    def _write_repodata_with_createrepo(self, dirpath, workers, update):
+        """Generates the repodata in repodata.new with createrepo; `createrepo --update` works on a copy of the current
+        repodata, which is served until the new one is swapped in"""
+        from infi.app_repo.utils import temporary_directory_context
+        with temporary_directory_context(change_directory=False) as tempdir, stage('createrepo'):
+            if update and self._is_repodata_exists(dirpath):
+                log_execute_assert_success(['cp', '-rL', path.join(dirpath, 'repodata'), path.join(tempdir, 'repodata')])
+                try:
+                    createrepo_update(dirpath, self.cachedir, workers, tempdir)
+                except:
+                    logger.exception("Failed to update metadata, will attempt to create it from scratch")
+                    self._delete_repo_metadata(tempdir)
+                    createrepo(dirpath, self.cachedir, tempdir, workers)
+            else:
+                createrepo(dirpath, self.cachedir, tempdir, workers)
+            log_execute_assert_success(['mv', path.join(tempdir, 'repodata'), path.join(dirpath, 'repodata.new')])
+
+    def _get_header_cache(self, dirpath):
+        """:returns: the header cache of the directory, which only the holders of its lock write"""
+        from infi.app_repo.rpm import HeaderCache
+        name = path.basename(dirpath)
+        if name not in self._header_caches:
+            ensure_directory_exists(path.join(self.cachedir, 'headers'))
+            self._header_caches[name] = HeaderCache(path.join(self.cachedir, 'headers', name + '.msgpack'))
+        return self._header_caches[name]
+
+    def _get_databases_dirpath(self, dirpath):
+        """:returns: where the sqlite databases of the directory are kept, or None if the index does not have them"""
+        if self.index_name not in self.config.sqlite_repodata_indexes:
+            return None
+        databases_dirpath = path.join(self.cachedir, 'sqlite', path.basename(dirpath))
+        ensure_directory_exists(databases_dirpath)
+        return databases_dirpath
 
     def _update_index(self, dirpath):
-        if not self._is_repodata_exists(dirpath):
-            createrepo(dirpath, self.cachedir)
-        else:
-            try:
-                createrepo_update(dirpath, self.cachedir)
-            except:
-                logger.exception("Failed to update metadata, will attempt to remove it and create it from scratch")
-                self._delete_repo_metadata(dirpath)
-                createrepo(dirpath, self.cachedir)
-        sign_repomd(dirpath)
-
-    def _delete_repo_metadata(self, dirpath):
-        repodata = path.join(dirpath, 'repodata')
+        """Writes the repodata in-process from the cached records of the rpms, parsing only the new ones.
+        If some rpm cannot be parsed, the repodata is updated by createrepo instead, with a single worker as it only
+        parses the new rpms; the workers of get_rebuild_workers are for rebuild_index"""
+        self._rebuild_repodata(dirpath, 1, update=True)
+
+    def _delete_repo_metadata(self, dirpath, repodata_dirname='repodata'):
+        repodata = path.join(dirpath, repodata_dirname)
         log_execute_assert_success(['rm', '-rf', repodata])
 
     def _is_repodata_exists(self, dirpath):
@@ -100,22 +200,53 @@ class YumIndexer(Indexer):
         return path.exists(repodata)
 
 
-def sign_repomd(dirpath):
-    repomd = path.join(dirpath, 'repodata', 'repomd.xml')
-    if path.exists('%s.asc' % repomd):
-        remove('%s.asc' % repomd)
-    log_execute_assert_success(['gpg', '-a', '--detach-sign', repomd])
-
-
-def createrepo_update(dirpath, cachedir=None):
-    arguments = CREATEREPO_ARGUMENTS + ['--update', '--skip-stat', dirpath]
+def swap_repodata(dirpath):
+    """Makes repodata.new the current repodata.
+
+    repodata is a symbolic link to the current generation, repodata.<timestamp>; it is replaced with a single rename,
+    which is atomic. The previous generation is kept, and older ones are removed"""
+    from time import time
+    from infi.gevent_utils.shutil import rmtree
+    repodata = path.join(dirpath, 'repodata')
+    generation = 'repodata.{:.0f}'.format(time() * 1000)
+    rename(path.join(dirpath, 'repodata.new'), path.join(dirpath, generation))
+    if path.lexists(repodata + '.link'):
+        remove(repodata + '.link')
+    symlink(generation, repodata + '.link')
+    previous = readlink(repodata) if path.islink(repodata) else None
+    if previous is None and path.isdir(repodata):
+        # repodata created before generations were used; a symbolic link cannot replace a directory, so it is moved
+        # away only once the link is ready, leaving the shortest window possible
+        previous = 'repodata.0'
+        rename(repodata, path.join(dirpath, previous))
+    rename(repodata + '.link', repodata)
+    for item in glob(path.join(dirpath, 'repodata.*')):
+        if path.basename(item) not in (generation, previous, 'repodata.new') and not path.islink(item):
+            rmtree(item, ignore_errors=True)
+
+
+def sign_repomd(dirpath, repodata_dirname='repodata'):
+    """Signs into a temporary file that replaces the signature, so that repomd.xml is never served without one"""
+    repomd = path.join(dirpath, repodata_dirname, 'repomd.xml')
+    if path.exists('%s.asc.tmp' % repomd):
+        remove('%s.asc.tmp' % repomd)
+    signer.sign_detached(repomd, '%s.asc.tmp' % repomd)
+    rename('%s.asc.tmp' % repomd, '%s.asc' % repomd)
+
+
+def createrepo_update(dirpath, cachedir=None, workers=1, outputdir=None):
+    arguments = CREATEREPO_ARGUMENTS + ['--workers', str(workers), '--update', '--skip-stat', dirpath]
     if cachedir:
         arguments += ['--cachedir', cachedir]
+    if outputdir:
+        arguments += ['--outputdir', outputdir]
     log_execute_assert_success(arguments)
 
 
-def createrepo(dirpath, cachedir=None):
-    arguments = CREATEREPO_ARGUMENTS + [dirpath]
+def createrepo(dirpath, cachedir=None, outputdir=None, workers=1):
+    arguments = CREATEREPO_ARGUMENTS + ['--workers', str(workers), dirpath]
     if cachedir:
         arguments += ['--cachedir', cachedir]
+    if outputdir:
+        arguments += ['--outputdir', outputdir]
     log_execute_assert_success(arguments)
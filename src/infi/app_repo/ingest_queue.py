@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+from logging import getLogger
+from time import time
+from infi.gevent_utils.os import path
+from infi.gevent_utils.safe_greenlets import safe_spawn
+from .persistent_dict import PersistentDict
+logger = getLogger(__name__)
+
+PENDING, RUNNING, DONE, REJECTED = 'pending', 'running', 'done', 'rejected'
+MAX_FINISHED_JOBS = 1000
+
+
+class IngestQueue(object):
+    """A journal of uploaded files waiting to be processed, kept on disk so they survive a restart.
+
+    Every index has a worker greenlet that is spawned when there is work to do and exits when the index's jobs are
+    drained; jobs of the same index are processed one after the other in the order they were submitted, while the
+    indexes are processed concurrently."""
+
+    def __init__(self, filepath, process_func):
+        """:param process_func: called with (index, filepath), returns True if the file was accepted"""
+        super(IngestQueue, self).__init__()
+        self.jobs = PersistentDict(filepath)
+        self.jobs.load()
+        self._process_func = process_func
+        self._workers = dict()
+        for job in self._iter_jobs(status=RUNNING):
+            # we went down in the middle of processing this job
+            self._update_job(job['job_id'], status=PENDING)
+        indexes = sorted(set(job['index'] for job in self._iter_jobs(status=PENDING)))
+        if indexes:
+            logger.info("resuming pending jobs from {}".format(filepath))
+        for index in indexes:
+            self._ensure_worker(index)
+
+    def _iter_jobs(self, index=None, status=None):
+        for job_id in sorted(self.jobs.keys()):
+            job = self.jobs[job_id]
+            if index in (None, job['index']) and status in (None, job['status']):
+                yield job
+
+    def _update_job(self, job_id, **kwargs):
+        job = dict(self.jobs[job_id])
+        job.update(kwargs)
+        self.jobs[job_id] = job
+
+    def _get_next_job_id(self):
+        return '{:010d}'.format(int(max(self.jobs.keys())) + 1 if self.jobs else 1)
+
+    def _trim_finished_jobs(self):
+        finished = [job['job_id'] for job in self._iter_jobs() if job['status'] in (DONE, REJECTED)]
+        for job_id in finished[:-MAX_FINISHED_JOBS]:
+            del self.jobs[job_id]
+
+    def _ensure_worker(self, index):
+        worker = self._workers.get(index)
+        if worker is None or worker.ready():
+            self._workers[index] = safe_spawn(self._work, index)
+
+    def _work(self, index):
+        while True:
+            job = next(self._iter_jobs(index=index, status=PENDING), None)
+            if job is None:
+                return
+            self._process_job(job)
+            self._trim_finished_jobs()
+
+    def _process_job(self, job):
+        self._update_job(job['job_id'], status=RUNNING, started=time())
+        error = None
+        if not path.exists(job['filepath']):
+            accepted, error = False, "file does not exist"
+        else:
+            try:
+                accepted = self._process_func(job['index'], job['filepath'])
+            except Exception as exception:
+                logger.exception("job {} failed".format(job['job_id']))
+                accepted, error = False, repr(exception)
+        self._update_job(job['job_id'], status=DONE if accepted else REJECTED, finished=time(), error=error)
+
+    def submit(self, index, filepath):
+        """:returns: the job ID"""
+        job_id = self._get_next_job_id()
+        self.jobs[job_id] = dict(job_id=job_id, index=index, filepath=filepath, status=PENDING,
+                                 submitted=time(), started=None, finished=None, error=None)
+        self._ensure_worker(index)
+        return job_id
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list_jobs(self, index=None, status=None):
+        return list(self._iter_jobs(index, status))
+
+    def join(self):
+        """Waits until all pending jobs are processed"""
+        while any(not worker.ready() for worker in self._workers.values()):
+            for worker in list(self._workers.values()):
+                worker.join()
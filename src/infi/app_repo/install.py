@@ -2,7 +2,7 @@ from shutil import copy, rmtree
 from infi.gevent_utils.os import path, fopen, symlink, remove
 from infi.gevent_utils.glob import glob
 from pkg_resources import resource_filename
-from .utils import log_execute_assert_success, sign_rpm_package, sign_deb_package, ensure_directory_exists, find_files
+from .utils import log_execute_assert_success, ensure_directory_exists
 from infi.gevent_utils.safe_greenlets import safe_joinall, safe_spawn_later
 
 
@@ -89,17 +89,11 @@ def _import_gpg_key_to_rpm_database():
 
 
 def sign_all_existing_deb_and_rpm_packages(config):
-    # this is necessary because we replaced the gpg key
-    from gevent.pool import Pool
-    pool = Pool(20)
-    rpms = set()
-    debs = set()
-    for index_name in config.indexes:
-        rpms |= set(find_files(path.join(config.packages_directory, index_name, 'yum'), '*.rpm'))
-        debs |= set(find_files(path.join(config.packages_directory, index_name, 'apt'), '*.deb'))
-    pool.map_async(sign_rpm_package, rpms)
-    pool.map_async(sign_deb_package, debs)
-    pool.join(raise_error=True)
+    """Signs the packages that are not signed with the current key yet; this is necessary after replacing the key.
+
+    :returns: see ResignJob.run"""
+    from .resign import ResignJob
+    return ResignJob(config).run()
 
 
 def _override_symlink(src, dst):
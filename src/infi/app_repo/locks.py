@@ -0,0 +1,108 @@
+from __future__ import absolute_import
+from gevent.lock import Semaphore, RLock
+from infi.pyutils.contexts import contextmanager
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class SharedExclusiveLock(object):
+    """A gevent-friendly readers-writer lock; waiting writers block new readers so they do not starve"""
+
+    def __init__(self):
+        super(SharedExclusiveLock, self).__init__()
+        self._turnstile = Semaphore()
+        self._exclusive = Semaphore()
+        self._readers_mutex = Semaphore()
+        self._readers = 0
+
+    def acquire_shared(self):
+        with self._turnstile:
+            pass
+        with self._readers_mutex:
+            self._readers += 1
+            if self._readers == 1:
+                self._exclusive.acquire()
+
+    def release_shared(self):
+        with self._readers_mutex:
+            self._readers -= 1
+            if self._readers == 0:
+                self._exclusive.release()
+
+    def acquire_exclusive(self):
+        self._turnstile.acquire()
+        self._exclusive.acquire()
+
+    def release_exclusive(self):
+        self._exclusive.release()
+        self._turnstile.release()
+
+    @contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield
+        finally:
+            self.release_shared()
+
+    @contextmanager
+    def exclusive(self):
+        self.acquire_exclusive()
+        try:
+            yield
+        finally:
+            self.release_exclusive()
+
+
+class LockHierarchy(object):
+    """Locks keyed by (index, index type, target directory) tuples.
+
+    Holding a key exclusively excludes its ancestors and descendants, but not its siblings: ingesting into two
+    apt codenames runs concurrently, while rebuilding the whole apt index waits for both of them.
+    An empty key locks the entire service. Keys are always acquired in sorted order to avoid deadlocks."""
+
+    def __init__(self):
+        super(LockHierarchy, self).__init__()
+        self._mutex = RLock()
+        self._locks = dict()
+
+    def _get_lock(self, key):
+        with self._mutex:
+            if key not in self._locks:
+                self._locks[key] = SharedExclusiveLock()
+            return self._locks[key]
+
+    def _iter_plan(self, keys, is_exclusive):
+        """:returns: sorted (key, is_exclusive) tuples; ancestors of the requested keys are taken shared"""
+        requested = set(tuple(key) for key in keys)
+        ancestors = set()
+        for key in requested:
+            ancestors.update(key[:length] for length in range(len(key)))
+        ancestors -= requested
+        plan = [(key, False) for key in ancestors] + [(key, is_exclusive) for key in requested]
+        return sorted(plan, key=lambda item: item[0])
+
+    @contextmanager
+    def _hold(self, keys, is_exclusive):
+        acquired = []
+        try:
+            for key, exclusive in self._iter_plan(keys, is_exclusive):
+                lock = self._get_lock(key)
+                if exclusive:
+                    lock.acquire_exclusive()
+                    acquired.append(lock.release_exclusive)
+                else:
+                    lock.acquire_shared()
+                    acquired.append(lock.release_shared)
+            yield
+        finally:
+            for release in reversed(acquired):
+                release()
+
+    def exclusive(self, *keys):
+        return self._hold(keys, True)
+
+    def shared(self, *keys):
+        """For reading: excludes only the holders of these keys or of their ancestors exclusively, e.g. a rebuild of the
+        index, and not the ingests into its targets"""
+        return self._hold(keys, False)
@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+from collections import deque
+from time import time
+from gevent.local import local
+from infi.pyutils.contexts import contextmanager
+from logging import getLogger
+logger = getLogger(__name__)
+
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)  # seconds
+SLOW_INGEST_THRESHOLD = 10  # seconds
+MAX_SLOW_INGESTS = 100
+
+
+class Histogram(object):
+    def __init__(self):
+        super(Histogram, self).__init__()
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last one is for everything above the largest bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[next((i for i, bound in enumerate(BUCKETS) if value <= bound), len(BUCKETS))] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return dict(buckets=list(BUCKETS), counts=list(self.counts), count=self.count, sum=self.sum)
+
+
+class IngestMetrics(object):
+    """Times the stages of every ingest, keeping a histogram per (index, index type, stage) in memory.
+
+    An ingest is traced from the service with the ingest() context, and anything it calls, down to the
+    indexers, wraps its stages with stage(); stages run outside of an ingest (e.g. rebuild_index) are not traced.
+    Each greenlet has its own trace, so concurrent ingests do not mix."""
+
+    def __init__(self):
+        super(IngestMetrics, self).__init__()
+        self.histograms = dict()
+        self.slow_ingests = deque(maxlen=MAX_SLOW_INGESTS)
+        self._local = local()
+
+    def _get_trace(self):
+        return getattr(self._local, 'trace', None)
+
+    def _observe(self, index, index_type, name, duration):
+        key = (index, index_type, name)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(duration)
+
+    @contextmanager
+    def ingest(self, index, filepaths):
+        if self._get_trace() is not None:  # nested, e.g. process_filepath called from a batch
+            yield
+            return
+        trace = self._local.trace = dict(index=index, filepaths=list(filepaths), started=time(), index_type='',
+                                         stages=[])
+        try:
+            yield
+        finally:
+            self._local.trace = None
+            trace['duration'] = time() - trace['started']
+            self._observe(index, '', 'total', trace['duration'])
+            if trace['duration'] >= SLOW_INGEST_THRESHOLD:
+                logger.warning("ingesting {!r} took {:.1f} seconds".format(trace['filepaths'], trace['duration']))
+                self.slow_ingests.append(trace)
+
+    @contextmanager
+    def stage(self, name, index_type=None):
+        """:param index_type: the indexer the stage belongs to; nested stages inherit it"""
+        trace = self._get_trace()
+        if trace is None:
+            yield
+            return
+        previous_index_type = trace['index_type']
+        if index_type is not None:
+            trace['index_type'] = index_type
+        start = time()
+        try:
+            yield
+        finally:
+            duration = time() - start
+            trace['stages'].append(dict(index_type=trace['index_type'], name=name, duration=duration))
+            self._observe(trace['index'], trace['index_type'], name, duration)
+            trace['index_type'] = previous_index_type
+
+    def to_dict(self):
+        histograms = [dict(index=index, index_type=index_type, stage=name, **histogram.to_dict())
+                      for (index, index_type, name), histogram in sorted(self.histograms.items())]
+        slow_ingests = [dict(index=trace['index'], filepaths=trace['filepaths'], started=trace['started'],
+                             duration=trace['duration'], stages=list(trace['stages'])) for trace in self.slow_ingests]
+        return dict(histograms=histograms, slow_ingests=slow_ingests)
+
+
+class SigningMetrics(object):
+    """Times the signing requests per kind: how long they waited in the queue and how long the signing took, and counts
+    the processes that served them, so the number of requests per process shows how well they are batched"""
+
+    def __init__(self):
+        super(SigningMetrics, self).__init__()
+        self.histograms = dict()
+        self.batches = dict()
+
+    def observe(self, kind, waited, duration):
+        for phase, value in (('wait', waited), ('sign', duration)):
+            if (kind, phase) not in self.histograms:
+                self.histograms[(kind, phase)] = Histogram()
+            self.histograms[(kind, phase)].observe(value)
+
+    def observe_batch(self, kind, batch_size):
+        batches, requests = self.batches.get(kind, (0, 0))
+        self.batches[kind] = (batches + 1, requests + batch_size)
+
+    def to_dict(self):
+        histograms = [dict(kind=kind, phase=phase, **histogram.to_dict())
+                      for (kind, phase), histogram in sorted(self.histograms.items())]
+        batches = [dict(kind=kind, batches=batches, requests=requests)
+                   for kind, (batches, requests) in sorted(self.batches.items())]
+        return dict(histograms=histograms, batches=batches)
+
+
+def _format_histogram(lines, name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram['buckets'] + ['+Inf'], histogram['counts']):
+        cumulative += count
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, cumulative))
+    lines.append('{}_sum{{{}}} {}'.format(name, labels, histogram['sum']))
+    lines.append('{}_count{{{}}} {}'.format(name, labels, histogram['count']))
+
+
+def format_metrics(metrics):
+    """:returns: the dict returned by IngestMetrics.to_dict, in the Prometheus text format, followed by the signing
+              metrics if the dict has them"""
+    lines = ['# TYPE app_repo_ingest_stage_seconds histogram']
+    for histogram in metrics['histograms']:
+        labels = 'index="{}",index_type="{}",stage="{}"'.format(histogram['index'], histogram['index_type'],
+                                                                histogram['stage'])
+        _format_histogram(lines, 'app_repo_ingest_stage_seconds', labels, histogram)
+    lines.append('# TYPE app_repo_slow_ingests gauge')
+    lines.append('app_repo_slow_ingests {}'.format(len(metrics['slow_ingests'])))
+    if 'signing' in metrics:
+        lines.append('# TYPE app_repo_signing_seconds histogram')
+        for histogram in metrics['signing']['histograms']:
+            labels = 'kind="{}",phase="{}"'.format(histogram['kind'], histogram['phase'])
+            _format_histogram(lines, 'app_repo_signing_seconds', labels, histogram)
+        for name, key in (('app_repo_signing_processes_total', 'batches'), ('app_repo_signing_requests_total', 'requests')):
+            lines.append('# TYPE {} counter'.format(name))
+            for item in metrics['signing']['batches']:
+                lines.append('{}{{kind="{}"}} {}'.format(name, item['kind'], item[key]))
+    return '\n'.join(lines) + '\n'
+
+
+ingest_metrics = IngestMetrics()
+stage = ingest_metrics.stage
+signing_metrics = SigningMetrics()
@@ -27,14 +27,14 @@ Description: Some description
 
 """
 
-def createrepo_side_effect(dirpath, cachedir=None):
+def createrepo_side_effect(dirpath, cachedir=None, outputdir=None, workers=1):
     assert path.exists(dirpath)
-    ensure_directory_exists(path.join(dirpath, 'repodata'))
-    write_file(path.join(dirpath, 'repodata', 'repomd.xml'), '')
+    ensure_directory_exists(path.join(outputdir or dirpath, 'repodata'))
+    write_file(path.join(outputdir or dirpath, 'repodata', 'repomd.xml'), '')
 
 
-def createrepo_update_side_effect(dirpath, cachedir=None):
-    assert path.exists(path.join(dirpath, 'repodata'))
+def createrepo_update_side_effect(dirpath, cachedir=None, workers=1, outputdir=None):
+    assert path.exists(path.join(outputdir or dirpath, 'repodata'))
 
 
 def setup_gpg_side_effect(config, force_resignature=False):
@@ -58,13 +58,22 @@ def apt_ftparchive_side_effect(cmdline_arguments):
     return ''
 
 
+def gpg_side_effect(cmdline_arguments):
+    if '-o' in cmdline_arguments:
+        write_file(cmdline_arguments[cmdline_arguments.index('-o') + 1], '')
+
+
 @contextmanager
 def patch_is_really_functions(is_really_deb=True, is_really_rpm=True):
-    with patch("infi.app_repo.indexers.apt.is_really_deb", new=lambda filepath: is_really_deb):
-        with patch("infi.app_repo.indexers.yum.is_really_rpm", new=lambda filepath: is_really_rpm):
-            with patch("infi.app_repo.indexers.wget.is_really_deb", new=lambda filepath: is_really_deb):
-                with patch("infi.app_repo.indexers.wget.is_really_rpm", new=lambda filepath: is_really_rpm):
-                    yield
+    def get_package_type(filepath):
+        if is_really_deb and filepath.endswith('.deb'):
+            return 'deb'
+        if is_really_rpm and filepath.endswith('.rpm'):
+            return 'rpm'
+        return None
+
+    with patch("infi.app_repo.artifact.get_package_type", new=get_package_type):
+        yield
 
 
 @contextmanager
@@ -77,7 +86,7 @@ def patch_all():
                             with patch("infi.app_repo.utils.sign_deb_package"):
                                 with patch("infi.app_repo.install._import_gpg_key_to_rpm_database"):
                                     with patch("infi.app_repo.indexers.apt.apt_ftparchive") as apt_ftparchive:
-                                        with patch("infi.app_repo.indexers.apt.gpg"):
+                                        with patch("infi.app_repo.signer.gpg") as gpg:
                                             with patch("infi.app_repo.indexers.yum.sign_repomd"):
                                                 with patch_is_really_functions():
                                                     apt_ftparchive.side_effect = apt_ftparchive_side_effect
@@ -85,6 +94,7 @@ def patch_all():
                                                     createrepo_update.side_effect = createrepo_update_side_effect
                                                     apt_ftparchive.return_value = APT_FTPARCHIVE_RETURN_VALUE
                                                     setup_gpg.side_effect = setup_gpg_side_effect
+                                                    gpg.side_effect = gpg_side_effect
                                                     yield
 
 
@@ -1,9 +1,11 @@
-from infi.gevent_utils.os import path, remove, fopen
+from infi.gevent_utils.os import path, remove, rename, fopen
 from infi.gevent_utils.deferred import create_threadpool_executed_func
 from six.moves import UserDict
 from msgpack import packb, unpackb
 from infi.rpc.base import SynchronizedMixin, synchronized
 from gevent.lock import RLock
+from logging import getLogger
+logger = getLogger(__name__)
 
 
 @create_threadpool_executed_func
@@ -14,8 +16,21 @@ def _read(filepath):
 
 @create_threadpool_executed_func
 def _write(filepath, contents):
-    with fopen(filepath, 'wb') as fd:
-        fd.write(packb(contents))
+    """Writes a temporary file next to the file and renames it over the file, so a crash, or another process writing
+    the same file, never leaves it partial"""
+    import os
+    from tempfile import mkstemp
+    fd, tempfile = mkstemp(dir=os.path.dirname(filepath), prefix=os.path.basename(filepath) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fileobj:
+            fileobj.write(packb(contents))
+            fileobj.flush()
+            os.fsync(fileobj.fileno())
+        os.chmod(tempfile, 0o644)
+        os.rename(tempfile, filepath)
+    except:
+        os.remove(tempfile)
+        raise
 
 
 class PersistentDict(UserDict, SynchronizedMixin):
@@ -26,10 +41,20 @@ class PersistentDict(UserDict, SynchronizedMixin):
 
     @synchronized
     def load(self):
-        if path.exists(self.filepath):
-            self.data = _read(self.filepath)
-        else:
-            self.data = dict()
+        """An unreadable file, e.g. one that was written before the writes were atomic, is moved aside to
+        <filepath>.corrupt and the dict starts empty"""
+        self.data = dict()
+        if not path.exists(self.filepath):
+            return
+        try:
+            data = _read(self.filepath)
+            if not isinstance(data, dict):
+                raise ValueError("{} does not contain a dict".format(self.filepath))
+        except Exception:
+            logger.exception("failed to read {}, moving it aside and starting empty".format(self.filepath))
+            rename(self.filepath, self.filepath + '.corrupt')
+            return
+        self.data = data
 
     @synchronized
     def delete(self):
@@ -0,0 +1,39 @@
+"""Platforms, architectures and extensions, shared by the file name parser and the indexers"""
+
+# platform -> architectures that the yum indexer keeps a repository for
+KNOWN_PLATFORMS = {
+    "linux-redhat-5": ("i686", "x86_64"),
+    "linux-redhat-6": ("i686", "x86_64"),
+    "linux-redhat-7": ("x86_64", "ppc64", "ppc64le"),
+    "linux-redhat-8": ("x86_64", "ppc64", "ppc64le"),
+    "linux-centos-5": ("i686", "x86_64"),
+    "linux-centos-6": ("i686", "x86_64"),
+    "linux-centos-7": ("x86_64", "ppc64", "ppc64le"),
+    "linux-centos-8": ("x86_64", "ppc64", "ppc64le"),
+    "linux-rocky-8": ("x86_64", "ppc64", "ppc64le"),
+    "linux-suse-10": ("i686", "x86_64"),
+    "linux-suse-11": ("i686", "x86_64", "ppc64"),
+    "linux-suse-12": ("x86_64", "ppc64le"),
+    "linux-suse-15": ("x86_64",),
+}
+
+# distribution -> codename -> architectures that the apt indexer keeps a repository for
+KNOWN_DISTRIBUTIONS = {
+    'linux-ubuntu': {
+        'trusty': ('i386', 'amd64'),
+        'xenial': ('i386', 'amd64'),
+        'bionic': ('amd64', ),
+        'focal': ('amd64', ),
+        'jammy': ('amd64', ),
+    }
+}
+
+# the file name parser tries these in order; platforms are regular expressions, the rest are literal names
+PLATFORM_PATTERNS = ('python', 'vmware-esx', 'custom', 'windows', r'aix-\d+\.\d+', r'solaris-\d+', 'linux-ubuntu-[a-z]+',
+                     r'linux-suse-\d+', r'linux-redhat-\d', r'linux-centos-\d', r'linux-rocky-\d', r'linux-oracle-\d',
+                     r'osx-\d+\.\d+', 'centos.el6', 'centos.el7', 'redhat.el6', 'redhat.el7', 'docker', 'windows-hyperv')
+ARCHITECTURES = ('generic', 'docs', 'sdist', 'x86', 'x64', 'ppc64', 'ppc64le', 'powerpc', 'powerpc_bff', 'sparc',
+                 'x86_OVF10', 'x86_OVF10_UPDATE_ISO', 'x86_OVF10_UPDATE_ZIP', 'x64_OVF10', 'x64_OVF10_UPDATE_ISO',
+                 'x64_OVF10_UPDATE_ZIP', 'x64_dd', 'i686', 'x86_64', 'x64_vhd')
+EXTENSIONS = ('bin', 'rpm', 'deb', 'msi', 'pkg.gz', 'tar.gz', 'ova', 'vhd', 'iso', 'zip', 'img', 'exe', '', 'so', 'dll',
+              'pdb', 'cpp', 'exp', 'pak', 'bff')
@@ -0,0 +1,156 @@
+"""Re-signs the packages of all the indexes, which is necessary after the gpg key was replaced"""
+from __future__ import absolute_import
+from logging import getLogger
+from time import time
+from infi.gevent_utils.os import path, stat
+from .persistent_dict import PersistentDict
+from .utils import find_files, sign_rpm_package, sign_deb_package
+logger = getLogger(__name__)
+
+SIGNED, SKIPPED = 'signed', 'skipped'
+COUNTS = ('total', SIGNED, SIGNED + '_bytes', SKIPPED, SKIPPED + '_bytes', 'failed')
+CHECKPOINT_INTERVAL = 100  # files
+
+
+class IoBudget(object):
+    """Spaces out the starts of reads so that on average they do not exceed a number of bytes per second"""
+
+    def __init__(self, bytes_per_second=None):
+        """:param bytes_per_second: unlimited if None"""
+        super(IoBudget, self).__init__()
+        self._bytes_per_second = bytes_per_second
+        self._available_at = time()
+
+    def consume(self, size):
+        from gevent import sleep
+        if not self._bytes_per_second:
+            return
+        now = time()
+        start = max(now, self._available_at)
+        self._available_at = start + float(size) / self._bytes_per_second
+        sleep(start - now)
+
+
+class ResignJob(object):
+    """Signs the packages that are not signed with the current key yet.
+
+    The files that are done are kept in a checkpoint on disk, so a job that was interrupted resumes where it stopped.
+    The signing forks rpm and dpkg-sig, so the workers are greenlets waiting on these processes; the I/O budget spaces
+    out the files they start on, so the web server still gets its share of the disk.
+    Every file is signed holding its (index, index type) lock, so ingests wait for a file at most, not for the job."""
+
+    def __init__(self, config, locks=None):
+        """:param locks: the LockHierarchy of the service"""
+        from gevent.lock import Semaphore
+        from .locks import LockHierarchy
+        super(ResignJob, self).__init__()
+        self.config = config
+        self.locks = LockHierarchy() if locks is None else locks
+        self.checkpoint = PersistentDict(config.resign_checkpoint_filepath)
+        self.checkpoint.load()
+        self._checkpoint_lock = Semaphore()  # saving serializes the checkpoint in a thread, it must not change meanwhile
+        self._unsaved = 0
+        self._progress = None
+
+    def is_interrupted(self):
+        """:returns: True if a job started and did not finish"""
+        return 'key_ids' in self.checkpoint
+
+    def get_progress(self):
+        """:returns: dict with whether the job is running, and the counts of every index"""
+        indexes = [dict(counts, index=index) for index, counts in sorted((self._progress or dict()).items())]
+        return dict(running=self._progress is not None, indexes=indexes)
+
+    def _iter_packages(self):
+        """:returns: iterator of 4-tuples (index, index type, filepath, sign function), listing hard-linked files once"""
+        seen = set()
+        kinds = [('yum', '*.rpm', sign_rpm_package), ('apt', '*.deb', sign_deb_package)]
+        for index in self.config.indexes:
+            for index_type, pattern, sign_func in kinds:
+                for filepath in sorted(find_files(path.join(self.config.packages_directory, index, index_type), pattern)):
+                    stat_result = stat(filepath)
+                    if (stat_result.st_dev, stat_result.st_ino) not in seen:
+                        seen.add((stat_result.st_dev, stat_result.st_ino))
+                        yield index, index_type, filepath, sign_func
+
+    def _start(self, key_ids):
+        """:returns: the files that are done, from the checkpoint if the job is resumed with the same key"""
+        if self.checkpoint.get('key_ids') == key_ids:
+            logger.info("resuming re-signing, {} files are done".format(len(self.checkpoint['done'])))
+        else:
+            with self._checkpoint_lock:
+                self.checkpoint.data = dict(key_ids=key_ids, done=dict())
+                self.checkpoint.save()
+        return self.checkpoint['done']
+
+    def _mark_done(self, filepath, status, size):
+        with self._checkpoint_lock:
+            self.checkpoint['done'][filepath] = [status, size]
+            self._unsaved += 1
+            if self._unsaved >= CHECKPOINT_INTERVAL:
+                self.checkpoint.save()
+                self._unsaved = 0
+
+    def _sign(self, index, index_type, filepath, sign_func, key_ids, budget, failures):
+        from .signatures import is_signed_by
+        counts = self._progress[index]
+        size = path.getsize(filepath)
+        status = SKIPPED
+        if not (key_ids and is_signed_by(filepath, key_ids)):
+            budget.consume(size)
+            try:
+                with self.locks.exclusive((index, index_type)):
+                    sign_func(filepath)
+            except Exception as error:
+                logger.exception("failed to sign {}".format(filepath))
+                failures[filepath] = repr(error)
+                counts['failed'] += 1
+                return
+            status = SIGNED
+        counts[status] += 1
+        counts[status + '_bytes'] += size
+        self._mark_done(filepath, status, size)
+
+    def run(self):
+        """Signs the packages with a pool of resign_workers, reading at most resign_io_budget bytes per second.
+        The checkpoint is removed once all the files are done; a file that fails is retried by the next run.
+
+        :returns: dict with the counts and the sizes of the packages that were signed and of the ones that were
+                  skipped, in total and per index"""
+        from gevent.pool import Pool
+        from .errors import ResignFailed
+        from .signatures import read_public_key_ids
+        key_ids = sorted(read_public_key_ids(path.join(path.expanduser("~"), 'gpg.key')))
+        done = self._start(key_ids)
+        packages = list(self._iter_packages())
+        self._progress = dict((index, dict.fromkeys(COUNTS, 0)) for index in self.config.indexes)
+        for index, _, filepath, _ in packages:
+            counts = self._progress[index]
+            counts['total'] += 1
+            if filepath in done:
+                status, size = done[filepath]
+                counts[status] += 1
+                counts[status + '_bytes'] += size
+        budget, failures = IoBudget(self.config.resign_io_budget), dict()
+        pool = Pool(self.config.resign_workers)
+        try:
+            for index, index_type, filepath, sign_func in packages:
+                if filepath not in done:
+                    pool.spawn(self._sign, index, index_type, filepath, sign_func, key_ids, budget, failures)
+            pool.join()
+        finally:
+            with self._checkpoint_lock:
+                self.checkpoint.save()
+            indexes = self.get_progress()['indexes']
+            self._progress = None
+        report = dict((key, sum(counts[key] for counts in indexes)) for key in COUNTS)
+        report.update(indexes=indexes)
+        logger.info("signed {signed} packages ({signed_bytes} bytes), skipped {skipped} packages already signed with the "
+                    "current key ({skipped_bytes} bytes), {failed} failed".format(**report))
+        if failures:
+            raise ResignFailed("failed to sign {}".format(
+                ", ".join("{}: {}".format(filepath, error) for filepath, error in sorted(failures.items()))))
+        with self._checkpoint_lock:
+            self.checkpoint.data = dict()
+            self.checkpoint.delete()
+        return report
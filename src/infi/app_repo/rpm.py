@@ -0,0 +1,478 @@
+"""Generates yum repodata (primary, filelists, other and repomd) the way `createrepo` does, without forking it"""
+from __future__ import absolute_import
+from hashlib import sha1
+from struct import unpack_from
+from xml.sax.saxutils import escape
+from collections import OrderedDict
+from infi.gevent_utils.os import path, fopen, rename
+from infi.gevent_utils.deferred import create_threadpool_executed_func
+from .utils import READ_SIZE, iter_file_chunks
+from .file_cache import FileCache
+from logging import getLogger
+logger = getLogger(__name__)
+
+LEAD_SIZE = 96
+LEAD_MAGIC = b'\xed\xab\xee\xdb'
+HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+HEADER_INTRO_SIZE = 16
+CHECKSUM_TYPE = 'sha'  # sha1, named the way createrepo --checksum=sha1 names it, which every yum version knows
+
+# header tags
+NAME, VERSION, RELEASE, EPOCH, SUMMARY, DESCRIPTION, BUILDTIME, BUILDHOST = 1000, 1001, 1002, 1003, 1004, 1005, 1006, 1007
+SIZE, VENDOR, LICENSE, PACKAGER, GROUP, URL, ARCH = 1009, 1011, 1014, 1015, 1016, 1020, 1022
+FILEMODES, FILEFLAGS, SOURCERPM, ARCHIVESIZE = 1030, 1037, 1044, 1046
+PROVIDENAME, REQUIREFLAGS, REQUIRENAME, REQUIREVERSION = 1047, 1048, 1049, 1050
+CONFLICTFLAGS, CONFLICTNAME, CONFLICTVERSION = 1053, 1054, 1055
+CHANGELOGTIME, CHANGELOGNAME, CHANGELOGTEXT = 1080, 1081, 1082
+OBSOLETENAME, PROVIDEFLAGS, PROVIDEVERSION, OBSOLETEFLAGS, OBSOLETEVERSION = 1090, 1112, 1113, 1114, 1115
+DIRINDEXES, BASENAMES, DIRNAMES = 1116, 1117, 1118
+SIGNATURE_PAYLOADSIZE = 1007
+SIGNATURE_DSAHEADER, SIGNATURE_RSAHEADER, SIGNATURE_PGP, SIGNATURE_GPG = 267, 268, 1002, 1005
+OPENPGP_SIGNATURE_TAGS = (SIGNATURE_RSAHEADER, SIGNATURE_DSAHEADER, SIGNATURE_PGP, SIGNATURE_GPG)
+TAGS = (NAME, VERSION, RELEASE, EPOCH, SUMMARY, DESCRIPTION, BUILDTIME, BUILDHOST, SIZE, VENDOR, LICENSE, PACKAGER,
+        GROUP, URL, ARCH, FILEMODES, FILEFLAGS, SOURCERPM, ARCHIVESIZE, PROVIDENAME, REQUIREFLAGS, REQUIRENAME,
+        REQUIREVERSION, CONFLICTFLAGS, CONFLICTNAME, CONFLICTVERSION, CHANGELOGTIME, CHANGELOGNAME, CHANGELOGTEXT,
+        OBSOLETENAME, PROVIDEFLAGS, PROVIDEVERSION, OBSOLETEFLAGS, OBSOLETEVERSION, DIRINDEXES, BASENAMES, DIRNAMES)
+
+# header types
+CHAR, INT8, INT16, INT32, INT64, STRING, BIN, STRING_ARRAY, I18NSTRING = 1, 2, 3, 4, 5, 6, 7, 8, 9
+INTEGER_FORMATS = {CHAR: 'B', INT8: 'B', INT16: 'H', INT32: 'I', INT64: 'Q'}
+
+SENSE_FLAGS = {2: 'LT', 4: 'GT', 8: 'EQ', 10: 'LE', 12: 'GE'}
+SENSE_PREREQ = 64 | 512 | 1024  # RPMSENSE_PREREQ, RPMSENSE_SCRIPT_PRE, RPMSENSE_SCRIPT_POST
+FILE_GHOST = 64
+DIRECTORY_MODE = 0o40000
+PRIMARY_FILE_PREFIXES = ('/etc/', )
+PRIMARY_FILE_NAMES = ('/usr/lib/sendmail', )
+
+REPODATA_TYPES = ('primary', 'filelists', 'other')
+REPODATA_HEADERS = dict(
+    primary='<metadata xmlns="http://linux.duke.edu/metadata/common" xmlns:rpm="http://linux.duke.edu/metadata/rpm" '
+            'packages="{}">\n',
+    filelists='<filelists xmlns="http://linux.duke.edu/metadata/filelists" packages="{}">\n',
+    other='<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="{}">\n')
+REPODATA_FOOTERS = dict(primary='</metadata>\n', filelists='</filelists>\n', other='</otherdata>\n')
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+REPOMD_HEADER = '<repomd xmlns="http://linux.duke.edu/metadata/repo" xmlns:rpm="http://linux.duke.edu/metadata/rpm">\n'
+REPOMD_DATA = """  <data type="{type}">
+    <checksum type="{checksum_type}">{checksum}</checksum>
+    <open-checksum type="{checksum_type}">{open_checksum}</open-checksum>
+    <location href="repodata/{basename}"/>
+    <timestamp>{timestamp}</timestamp>
+    <size>{size}</size>
+    <open-size>{open_size}</open-size>
+{database_version}  </data>
+"""
+
+# the sqlite databases yum loads instead of parsing the xml files, as createrepo --database writes them
+SQLITE_DATABASE_VERSION = 10
+SQLITE_SCHEMAS = dict(
+    primary="""
+CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT, name TEXT, arch TEXT, version TEXT, epoch TEXT,
+  release TEXT, summary TEXT, description TEXT, url TEXT, time_file INTEGER, time_build INTEGER, rpm_license TEXT,
+  rpm_vendor TEXT, rpm_group TEXT, rpm_buildhost TEXT, rpm_sourcerpm TEXT, rpm_header_start INTEGER,
+  rpm_header_end INTEGER, rpm_packager TEXT, size_package INTEGER, size_installed INTEGER, size_archive INTEGER,
+  location_href TEXT, location_base TEXT, checksum_type TEXT);
+CREATE TABLE files (name TEXT, type TEXT, pkgKey INTEGER);
+CREATE TABLE requires (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER,
+  pre BOOLEAN DEFAULT FALSE);
+CREATE TABLE provides (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER);
+CREATE TABLE conflicts (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER);
+CREATE TABLE obsoletes (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER);
+CREATE INDEX packagename ON packages (name);
+CREATE INDEX packageId ON packages (pkgId);
+CREATE INDEX filenames ON files (name);
+CREATE INDEX pkgfiles ON files (pkgKey);
+CREATE INDEX pkgrequires ON requires (pkgKey);
+CREATE INDEX requiresname ON requires (name);
+CREATE INDEX pkgprovides ON provides (pkgKey);
+CREATE INDEX providesname ON provides (name);
+CREATE INDEX pkgconflicts ON conflicts (pkgKey);
+CREATE INDEX pkgobsoletes ON obsoletes (pkgKey);
+CREATE TRIGGER removals AFTER DELETE ON packages BEGIN
+  DELETE FROM files WHERE pkgKey = old.pkgKey;
+  DELETE FROM requires WHERE pkgKey = old.pkgKey;
+  DELETE FROM provides WHERE pkgKey = old.pkgKey;
+  DELETE FROM conflicts WHERE pkgKey = old.pkgKey;
+  DELETE FROM obsoletes WHERE pkgKey = old.pkgKey;
+END;
+""",
+    filelists="""
+CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT);
+CREATE TABLE filelist (pkgKey INTEGER, dirname TEXT, filenames TEXT, filetypes TEXT);
+CREATE INDEX keyfile ON filelist (pkgKey);
+CREATE INDEX pkgId ON packages (pkgId);
+CREATE INDEX dirnames ON filelist (dirname);
+CREATE TRIGGER remove_filelist AFTER DELETE ON packages BEGIN
+  DELETE FROM filelist WHERE pkgKey = old.pkgKey;
+END;
+""",
+    other="""
+CREATE TABLE db_info (dbversion INTEGER, checksum TEXT);
+CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT);
+CREATE TABLE changelog (pkgKey INTEGER, author TEXT, date INTEGER, changelog TEXT);
+CREATE INDEX keychange ON changelog (pkgKey);
+CREATE INDEX pkgId ON packages (pkgId);
+CREATE TRIGGER remove_changelogs AFTER DELETE ON packages BEGIN
+  DELETE FROM changelog WHERE pkgKey = old.pkgKey;
+END;
+""")
+FILE_TYPE_CHARACTERS = dict(file='f', dir='d', ghost='g')
+
+
+class RpmParsingFailed(Exception):
+    pass
+
+
+def _read_value(store, value_type, offset, count):
+    if value_type in INTEGER_FORMATS:
+        return list(unpack_from('>{}{}'.format(count, INTEGER_FORMATS[value_type]), store, offset))
+    if value_type == BIN:
+        return store[offset:offset + count]
+    if value_type in (STRING, STRING_ARRAY, I18NSTRING):
+        values = []
+        for _ in range(count if value_type != STRING else 1):
+            end = store.index(b'\0', offset)
+            values.append(store[offset:end].decode('utf-8', 'replace'))
+            offset = end + 1
+        return values[0] if value_type == STRING else values
+    raise RpmParsingFailed("unknown header type {}".format(value_type))
+
+
+def _read_header(fd, tags):
+    """:returns: 2-tuple (dict of the values of the given tags, the size of the header)"""
+    intro = fd.read(HEADER_INTRO_SIZE)
+    if len(intro) != HEADER_INTRO_SIZE or intro[:4] != HEADER_MAGIC:
+        raise RpmParsingFailed("bad header magic")
+    index_count, store_size = unpack_from('>II', intro, 8)
+    index = fd.read(index_count * 16)
+    store = fd.read(store_size)
+    if len(index) != index_count * 16 or len(store) != store_size:
+        raise RpmParsingFailed("unexpected end of file")
+    values = dict()
+    for position in range(index_count):
+        tag, value_type, offset, count = unpack_from('>iiii', index, position * 16)
+        if tag in tags:
+            try:
+                values[tag] = _read_value(store, value_type, offset, count)
+            except (ValueError, IndexError) as error:
+                raise RpmParsingFailed("bad value of tag {}: {!r}".format(tag, error))
+    return values, HEADER_INTRO_SIZE + len(index) + store_size
+
+
+class _HashingReader(object):
+    def __init__(self, fd):
+        super(_HashingReader, self).__init__()
+        self._fd = fd
+        self.hash_object = sha1()
+        self.size = 0
+
+    def read(self, size):
+        data = self._fd.read(size)
+        self.hash_object.update(data)
+        self.size += len(data)
+        return data
+
+    def read_to_end(self):
+        for chunk in iter(lambda: self.read(READ_SIZE), b''):
+            pass
+
+
+@create_threadpool_executed_func
+def scan_rpm(filepath):
+    """Reads the headers and hashes the .rpm in a single pass over it.
+
+    :returns: dict with the header tags createrepo uses, the header range, the size and the sha1 of the file"""
+    with fopen(filepath, 'rb') as fd:
+        reader = _HashingReader(fd)
+        lead = reader.read(LEAD_SIZE)
+        if len(lead) != LEAD_SIZE or lead[:4] != LEAD_MAGIC:
+            raise RpmParsingFailed("{} is not an rpm".format(filepath))
+        signature, signature_size = _read_header(reader, (SIGNATURE_PAYLOADSIZE, ))
+        reader.read((8 - signature_size % 8) % 8)  # the signature header is padded to an 8-byte boundary
+        header_start = reader.size
+        header, header_size = _read_header(reader, TAGS)
+        reader.read_to_end()
+    if ARCHIVESIZE not in header and SIGNATURE_PAYLOADSIZE in signature:
+        header[ARCHIVESIZE] = signature[SIGNATURE_PAYLOADSIZE]
+    return dict(header=header, header_start=header_start, header_end=header_start + header_size,
+                size=reader.size, checksum=reader.hash_object.hexdigest())
+
+
+@create_threadpool_executed_func
+def scan_rpm_signatures(filepath):
+    """Reads only the lead and the signature header.
+
+    :returns: list of the OpenPGP signature packets in the signature header, empty if the rpm is not signed"""
+    with fopen(filepath, 'rb') as fd:
+        lead = fd.read(LEAD_SIZE)
+        if len(lead) != LEAD_SIZE or lead[:4] != LEAD_MAGIC:
+            raise RpmParsingFailed("{} is not an rpm".format(filepath))
+        signature, _ = _read_header(fd, OPENPGP_SIGNATURE_TAGS)
+    return [signature[tag] for tag in OPENPGP_SIGNATURE_TAGS if tag in signature]
+
+
+def _attribute(value):
+    return escape(str(value), {'"': '&quot;'})
+
+
+def _first(header, tag, default=''):
+    value = header.get(tag, default)
+    if isinstance(value, list):
+        return value[0] if value else default
+    return value
+
+
+def _parse_evr(evr):
+    epoch, _, version_release = evr.rpartition(':')
+    version, _, release = version_release.partition('-')
+    return epoch or '0', version, release
+
+
+def _format_version(header):
+    return '<version epoch="{}" ver="{}" rel="{}"/>'.format(_first(header, EPOCH, 0), _attribute(_first(header, VERSION)),
+                                                          _attribute(_first(header, RELEASE)))
+
+
+def _get_entries(header, name_tag, flags_tag, version_tag):
+    """:returns: list of [name, flags, epoch, version, release, pre], the version fields are None if not versioned"""
+    names = header.get(name_tag, [])
+    flags = header.get(flags_tag, [0] * len(names))
+    versions = header.get(version_tag, [''] * len(names))
+    entries, seen = [], set()
+    for name, flag, version in zip(names, flags, versions):
+        if name.startswith('rpmlib(') or (name, flag, version) in seen:
+            continue
+        seen.add((name, flag, version))
+        if flag & 0xf in SENSE_FLAGS and version:
+            epoch, ver, rel = _parse_evr(version)
+            entries.append([name, SENSE_FLAGS[flag & 0xf], epoch, ver, rel or None, bool(flag & SENSE_PREREQ)])
+        else:
+            entries.append([name, None, None, None, None, bool(flag & SENSE_PREREQ)])
+    return entries
+
+
+def _format_entries(element, entries):
+    lines = []
+    for name, flags, epoch, version, release, pre in entries:
+        attributes = ['name="{}"'.format(_attribute(name))]
+        if flags is not None:
+            attributes.append('flags="{}" epoch="{}" ver="{}"'.format(flags, _attribute(epoch), _attribute(version)))
+            if release:
+                attributes.append('rel="{}"'.format(_attribute(release)))
+        if element == 'requires' and pre:
+            attributes.append('pre="1"')
+        lines.append('      <rpm:entry {}/>\n'.format(' '.join(attributes)))
+    if not lines:
+        return ''
+    return '    <rpm:{0}>\n{1}    </rpm:{0}>\n'.format(element, ''.join(lines))
+
+
+def _get_filelist(files):
+    """:returns: list of [dirname, basenames joined by /, file type characters], as the filelists database keeps them"""
+    filelist = OrderedDict()
+    for filepath, file_type in files:
+        dirname, _, basename = filepath.rpartition('/')
+        item = filelist.setdefault(dirname or '/', [[], []])
+        item[0].append(basename)
+        item[1].append(FILE_TYPE_CHARACTERS[file_type])
+    return [[dirname, '/'.join(basenames), ''.join(types)] for dirname, (basenames, types) in filelist.items()]
+
+
+def _iter_files(header):
+    """:returns: (filepath, type) pairs, type is 'file', 'dir' or 'ghost'"""
+    dirnames, basenames, dirindexes = header.get(DIRNAMES, []), header.get(BASENAMES, []), header.get(DIRINDEXES, [])
+    modes = header.get(FILEMODES, [0] * len(basenames))
+    flags = header.get(FILEFLAGS, [0] * len(basenames))
+    for basename, dirindex, mode, flag in zip(basenames, dirindexes, modes, flags):
+        if flag & FILE_GHOST:
+            yield dirnames[dirindex] + basename, 'ghost'
+        elif mode & 0o170000 == DIRECTORY_MODE:
+            yield dirnames[dirindex] + basename, 'dir'
+        else:
+            yield dirnames[dirindex] + basename, 'file'
+
+
+def _format_file(filepath, file_type, indent):
+    type_attribute = '' if file_type == 'file' else ' type="{}"'.format(file_type)
+    return '{}<file{}>{}</file>\n'.format(indent, type_attribute, escape(filepath))
+
+
+def _is_primary_file(filepath):
+    return filepath.startswith(PRIMARY_FILE_PREFIXES) or 'bin/' in filepath or filepath in PRIMARY_FILE_NAMES
+
+
+def format_records(scan_result, basename, mtime):
+    """:param scan_result: as returned by scan_rpm
+    :returns: dict with the package element of each of primary.xml, filelists.xml and other.xml, and the rows of the
+              package in each of the sqlite databases"""
+    header, checksum = scan_result['header'], scan_result['checksum']
+    name, arch = _attribute(_first(header, NAME)), _attribute(_first(header, ARCH))
+    files = list(_iter_files(header))
+    entries = dict((element, _get_entries(header, *tags)) for element, tags in
+                   [('provides', (PROVIDENAME, PROVIDEFLAGS, PROVIDEVERSION)),
+                    ('requires', (REQUIRENAME, REQUIREFLAGS, REQUIREVERSION)),
+                    ('conflicts', (CONFLICTNAME, CONFLICTFLAGS, CONFLICTVERSION)),
+                    ('obsoletes', (OBSOLETENAME, OBSOLETEFLAGS, OBSOLETEVERSION))])
+    changelog = [list(item) for item in zip(header.get(CHANGELOGNAME, []), header.get(CHANGELOGTIME, []),
+                                            header.get(CHANGELOGTEXT, []))][:1]  # like createrepo --changelog-limit 1
+    primary = ['<package type="rpm">\n',
+               '  <name>{}</name>\n'.format(name),
+               '  <arch>{}</arch>\n'.format(arch),
+               '  {}\n'.format(_format_version(header)),
+               '  <checksum type="{}" pkgid="YES">{}</checksum>\n'.format(CHECKSUM_TYPE, checksum),
+               '  <summary>{}</summary>\n'.format(escape(_first(header, SUMMARY))),
+               '  <description>{}</description>\n'.format(escape(_first(header, DESCRIPTION))),
+               '  <packager>{}</packager>\n'.format(escape(_first(header, PACKAGER))),
+               '  <url>{}</url>\n'.format(escape(_first(header, URL))),
+               '  <time file="{}" build="{}"/>\n'.format(int(mtime), _first(header, BUILDTIME, 0)),
+               '  <size package="{}" installed="{}" archive="{}"/>\n'.format(scan_result['size'], _first(header, SIZE, 0),
+                                                                           _first(header, ARCHIVESIZE, 0)),
+               '  <location href="{}"/>\n'.format(_attribute(basename)),
+               '  <format>\n',
+               '    <rpm:license>{}</rpm:license>\n'.format(escape(_first(header, LICENSE))),
+               '    <rpm:vendor>{}</rpm:vendor>\n'.format(escape(_first(header, VENDOR))),
+               '    <rpm:group>{}</rpm:group>\n'.format(escape(_first(header, GROUP))),
+               '    <rpm:buildhost>{}</rpm:buildhost>\n'.format(escape(_first(header, BUILDHOST))),
+               '    <rpm:sourcerpm>{}</rpm:sourcerpm>\n'.format(escape(_first(header, SOURCERPM))),
+               '    <rpm:header-range start="{}" end="{}"/>\n'.format(scan_result['header_start'], scan_result['header_end']),
+               _format_entries('provides', entries['provides']),
+               _format_entries('requires', entries['requires']),
+               _format_entries('conflicts', entries['conflicts']),
+               _format_entries('obsoletes', entries['obsoletes'])]
+    primary += [_format_file(filepath, file_type, '    ') for filepath, file_type in files if _is_primary_file(filepath)]
+    primary += ['  </format>\n', '</package>\n']
+    package = '<package pkgid="{}" name="{}" arch="{}">\n  {}\n'.format(checksum, name, arch, _format_version(header))
+    filelists = [package] + [_format_file(filepath, file_type, '  ') for filepath, file_type in files] + ['</package>\n']
+    other = [package]
+    for author, date, text in changelog:
+        other.append('  <changelog author="{}" date="{}">{}</changelog>\n'.format(_attribute(author), date, escape(text)))
+    other.append('</package>\n')
+    package_row = [checksum, _first(header, NAME), _first(header, ARCH), _first(header, VERSION),
+                   str(_first(header, EPOCH, 0)), _first(header, RELEASE), _first(header, SUMMARY),
+                   _first(header, DESCRIPTION), _first(header, URL), int(mtime), _first(header, BUILDTIME, 0),
+                   _first(header, LICENSE), _first(header, VENDOR), _first(header, GROUP), _first(header, BUILDHOST),
+                   _first(header, SOURCERPM), scan_result['header_start'], scan_result['header_end'],
+                   _first(header, PACKAGER), scan_result['size'], _first(header, SIZE, 0),
+                   _first(header, ARCHIVESIZE, 0), basename, None, CHECKSUM_TYPE]
+    rows = dict(entries, package=package_row, changelog=changelog, filelist=_get_filelist(files),
+                files=[[filepath, file_type] for filepath, file_type in files if _is_primary_file(filepath)])
+    return dict(primary=''.join(primary), filelists=''.join(filelists), other=''.join(other), rows=rows)
+
+
+class HeaderCache(FileCache):
+    """The repodata records of the rpms of a directory, see format_records"""
+    EXCEPTIONS = (RpmParsingFailed, ValueError)
+
+    def compute(self, filepath, stat_result):
+        return format_records(scan_rpm(filepath), path.basename(filepath), stat_result.st_mtime)
+
+    def get_records(self, filepaths):
+        """:returns: 2-tuple (list of records, in the order of the file paths, list of the file paths that could not be
+                  parsed)"""
+        records, failures = self.get(filepaths)
+        return [records[filepath] for filepath in filepaths if filepath in records], failures
+
+
+@create_threadpool_executed_func
+def _write_compressed_file(filepath, chunks, compression):
+    """Streams the chunks into a gzip or a bzip2 file.
+
+    :returns: dict with the checksums and sizes repomd.xml lists"""
+    import bz2
+    import gzip
+    from os import path
+    open_checksum, open_size = sha1(), 0
+    with dict(gz=gzip.open, bz2=bz2.open)[compression](filepath, 'wb') as fd:
+        for chunk in chunks:
+            data = chunk.encode('utf-8') if not isinstance(chunk, bytes) else chunk
+            fd.write(data)
+            open_checksum.update(data)
+            open_size += len(data)
+    checksum = sha1()
+    for chunk in iter_file_chunks(filepath):
+        checksum.update(chunk)
+    return dict(checksum=checksum.hexdigest(), open_checksum=open_checksum.hexdigest(),
+                size=path.getsize(filepath), open_size=open_size)
+
+
+def _insert_rows(connection, repodata_type, rows):
+    package_columns = len(rows['package']) if repodata_type == 'primary' else 1
+    cursor = connection.execute('INSERT INTO packages VALUES (NULL, {})'.format(', '.join('?' * package_columns)),
+                                rows['package'][:package_columns])
+    key = cursor.lastrowid
+    if repodata_type == 'primary':
+        connection.executemany('INSERT INTO files VALUES (?, ?, ?)', [item + [key] for item in rows['files']])
+        connection.executemany('INSERT INTO requires VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               [item[:5] + [key, 'TRUE' if item[5] else 'FALSE'] for item in rows['requires']])
+        for element in ('provides', 'conflicts', 'obsoletes'):
+            connection.executemany('INSERT INTO {} VALUES (?, ?, ?, ?, ?, ?)'.format(element),
+                                   [item[:5] + [key] for item in rows[element]])
+    elif repodata_type == 'filelists':
+        connection.executemany('INSERT INTO filelist VALUES (?, ?, ?, ?)', [[key] + item for item in rows['filelist']])
+    else:
+        connection.executemany('INSERT INTO changelog VALUES (?, ?, ?, ?)',
+                               [[key] + item for item in rows['changelog']])
+
+
+@create_threadpool_executed_func
+def _update_database(filepath, repodata_type, records, checksum):
+    """Inserts the packages that are not in the database yet and deletes the ones that are gone, so the cost of an
+    update is that of the packages that changed
+
+    :param checksum: of the compressed xml file the database corresponds to"""
+    import sqlite3
+    connection = sqlite3.connect(filepath)
+    try:
+        if not connection.execute("SELECT name FROM sqlite_master WHERE name = 'db_info'").fetchone():
+            connection.executescript(SQLITE_SCHEMAS[repodata_type])
+        existing = dict(connection.execute('SELECT pkgId, pkgKey FROM packages'))
+        rows_by_pkgid = dict((record['rows']['package'][0], record['rows']) for record in records)
+        connection.executemany('DELETE FROM packages WHERE pkgKey = ?',
+                               [(existing[pkgid], ) for pkgid in set(existing).difference(rows_by_pkgid)])
+        for pkgid, rows in sorted(rows_by_pkgid.items()):
+            if pkgid not in existing:
+                _insert_rows(connection, repodata_type, rows)
+        connection.execute('DELETE FROM db_info')
+        connection.execute('INSERT INTO db_info VALUES (?, ?)', (SQLITE_DATABASE_VERSION, checksum))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def _write_and_rename(filepath, chunks, compression):
+    result = _write_compressed_file(filepath + '.tmp', chunks, compression)
+    rename(filepath + '.tmp', filepath)
+    return dict(result, basename=path.basename(filepath))
+
+
+def write_repodata(repodata_dirpath, records, databases_dirpath=None):
+    """Writes primary.xml.gz, filelists.xml.gz, other.xml.gz and then repomd.xml, each under a temporary name that is
+    renamed into place.
+
+    :param databases_dirpath: if given, the sqlite databases are kept updated there, and written compressed as well"""
+    from time import time
+    timestamp = int(time())
+    data = []
+    for repodata_type in REPODATA_TYPES:
+        chunks = [XML_DECLARATION, REPODATA_HEADERS[repodata_type].format(len(records))] + \
+                 [record[repodata_type] for record in records] + [REPODATA_FOOTERS[repodata_type]]
+        result = _write_and_rename(path.join(repodata_dirpath, '{}.xml.gz'.format(repodata_type)), chunks, 'gz')
+        data.append(REPOMD_DATA.format(type=repodata_type, checksum_type=CHECKSUM_TYPE, timestamp=timestamp,
+                                       database_version='', **result))
+        if databases_dirpath is None:
+            continue
+        database = path.join(databases_dirpath, '{}.sqlite'.format(repodata_type))
+        _update_database(database, repodata_type, records, result['checksum'])
+        result = _write_and_rename(path.join(repodata_dirpath, '{}.sqlite.bz2'.format(repodata_type)),
+                                   iter_file_chunks(database), 'bz2')
+        data.append(REPOMD_DATA.format(type=repodata_type + '_db', checksum_type=CHECKSUM_TYPE, timestamp=timestamp,
+                                       database_version='    <database_version>{}</database_version>\n'.format(
+                                           SQLITE_DATABASE_VERSION), **result))
+    repomd = path.join(repodata_dirpath, 'repomd.xml')
+    with fopen(repomd + '.tmp', 'w') as fd:
+        fd.write(XML_DECLARATION + REPOMD_HEADER + '  <revision>{}</revision>\n'.format(timestamp) + ''.join(data) +
+                 '</repomd>\n')
+    rename(repomd + '.tmp', repomd)
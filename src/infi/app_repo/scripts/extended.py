@@ -14,7 +14,12 @@ Usage:
     eapp_repo [options] service process-rejected-file <filepath> <platform> <arch>
     eapp_repo [options] service process-incoming <index>
     eapp_repo [options] service rebuild-index <index> [<index-type>]
+    eapp_repo [options] service rebuild-progress
+    eapp_repo [options] service reconcile-catalog <index>
     eapp_repo [options] service resign-packages
+    eapp_repo [options] service resign-progress
+    eapp_repo [options] service list-jobs [<index>]
+    eapp_repo [options] service job-status <job-id>
     eapp_repo [options] index list
     eapp_repo [options] index add <index>
     eapp_repo [options] index remove <index> [--yes]
@@ -150,8 +155,18 @@ def eapp_repo(argv=argv[1:]):
         return process_incoming(config, args['<index>'], args['--async'])
     elif args['service'] and args['rebuild-index']:
         return rebuild_index(config, args['<index>'], args['<index-type>'], args['--async'])
+    elif args['service'] and args['rebuild-progress']:
+        return show_rebuild_progress(config)
+    elif args['service'] and args['reconcile-catalog']:
+        return reconcile_catalog(config, args['<index>'], args['--async'])
     elif args['service'] and args['resign-packages']:
         return resign_packages(config, args['--async'])
+    elif args['service'] and args['resign-progress']:
+        return show_resign_progress(config)
+    elif args['service'] and args['list-jobs']:
+        return show_jobs(config, args['<index>'])
+    elif args['service'] and args['job-status']:
+        return show_job_status(config, args['<job-id>'])
     elif args['index'] and args['list']:
         print(' '.join(config.indexes))
     elif args['index'] and args['add']:
@@ -333,6 +348,7 @@ def delete_packages(config, should_delete, index, index_type, dry_run, quiet, no
     from infi.app_repo.service import get_client
     client = get_client(config)
     files_were_deleted = False
+    index_types_to_rebuild = set()
     artifacts = client.get_artifacts(index, index_type)
     files_to_remove = [filepath for filepath in artifacts if should_delete(filepath)]
     for filepath in files_to_remove:
@@ -345,18 +361,59 @@ def delete_packages(config, should_delete, index, index_type, dry_run, quiet, no
                 continue
         logger.info("deleting {} ".format(filepath_relative))
         files_were_deleted = True
-        client.delete_artifact(filepath)
-    # not rebuilding index if nothing was deleted
-    if files_were_deleted:
+        if not client.delete_artifact(filepath):
+            parts = path.relpath(filepath, path.join(config.packages_directory, index)).split(path.sep)
+            index_types_to_rebuild.add(index_type if parts[0] == path.pardir or len(parts) < 2 else parts[0])
+    # not rebuilding index if nothing was deleted, or if the indexers already removed the deleted files
+    if files_were_deleted and index_types_to_rebuild:
         if no_rebuild:
             logger.warn("do not forget to rebuild the index(es) after deleting all the packages that you wanted to delete")
         else:
-            rebuild_index(config, index, index_type, async_rpc)
+            if index_type is not None or None in index_types_to_rebuild:
+                rebuild_index(config, index, index_type, async_rpc)
+            else:
+                for item in sorted(index_types_to_rebuild):
+                    rebuild_index(config, index, item, async_rpc)
+
+
+def show_rebuild_progress(config):
+    from infi.app_repo.service import get_client
+    from infi.app_repo.utils import pretty_print
+    pretty_print(get_client(config).get_rebuild_progress())
+
+
+def reconcile_catalog(config, index, async_rpc=False):
+    from infi.app_repo.service import get_client
+    from infi.app_repo.utils import pretty_print
+    if async_rpc:
+        return get_client(config).reconcile_catalog(index, async_rpc=async_rpc)
+    pretty_print(get_client(config).reconcile_catalog(index))
 
 
 def resign_packages(config, async_rpc=False):
     from infi.app_repo.service import get_client
-    return get_client(config).resign_packages(async_rpc=async_rpc)
+    from infi.app_repo.utils import pretty_print
+    if async_rpc:
+        return get_client(config).resign_packages(async_rpc=async_rpc)
+    pretty_print(get_client(config).resign_packages())
+
+
+def show_resign_progress(config):
+    from infi.app_repo.service import get_client
+    from infi.app_repo.utils import pretty_print
+    pretty_print(get_client(config).get_resign_progress())
+
+
+def show_jobs(config, index=None):
+    from infi.app_repo.service import get_client
+    from infi.app_repo.utils import pretty_print
+    pretty_print(get_client(config).list_jobs(index))
+
+
+def show_job_status(config, job_id):
+    from infi.app_repo.service import get_client
+    from infi.app_repo.utils import pretty_print
+    pretty_print(get_client(config).get_job_status(job_id))
 
 
 def add_index(config, index_name, async_rpc=False):
@@ -1,11 +1,18 @@
 from __future__ import absolute_import
 
 from logging import getLogger
+from contextlib import ExitStack
 from infi.gevent_utils.os import remove, path
 from infi.gevent_utils.glob import glob
-from infi.rpc import ServiceWithSynchronized, rpc_call, synchronized
+from infi.rpc import ServiceBase, rpc_call
 from infi.rpc import AutoTimeoutClient, IPython_Mixin
+from infi.pyutils.contexts import contextmanager
+from gevent.lock import Semaphore
 from infi.app_repo import errors
+from infi.app_repo.locks import LockHierarchy
+from infi.app_repo.metrics import ingest_metrics, signing_metrics, stage
+from infi.app_repo.ingest_queue import IngestQueue, PENDING, RUNNING
+from infi.app_repo.resign import ResignJob
 from infi.app_repo.utils import hard_link_or_raise_exception, path
 
 logger = getLogger(__name__)
@@ -14,95 +21,283 @@ SUPPORTED_ARCHIVES = ['.msi', '.rpm', '.deb', '.tar.gz', '.zip', '.ova', '.img',
 IDLE_TIMEOUT = 5  # seconds
 
 
-def process_filepath(config, index, filepath, platform, arch):
-    indexers = [indexer for indexer in config.get_indexers(index) if
-                indexer.are_you_interested_in_file(filepath, platform, arch)]
+def get_lock_key(index, indexer, artifact=None):
+    target = None if artifact is None else indexer.get_lock_target_for_artifact(artifact)
+    return (index, indexer.INDEX_TYPE) if target is None else (index, indexer.INDEX_TYPE, target)
+
+
+@contextmanager
+def lock_context(locks, lock_keys):
+    """Holds the given keys of the lock hierarchy, if there is one, timing how long it took to get them"""
+    if locks is None:
+        yield
+        return
+    with ExitStack() as stack:
+        with stage('lock'):
+            stack.enter_context(locks.exclusive(*lock_keys))
+        yield
+
+
+def process_artifact(config, index, artifact, locks=None):
+    indexers = [indexer for indexer in config.get_indexers(index) if indexer.are_you_interested_in_artifact(artifact)]
     if not indexers:
-        raise errors.FileNeglectedByIndexers("all indexers are not interested in file {!r}".format(filepath))
-    for indexer in indexers:
+        raise errors.FileNeglectedByIndexers("all indexers are not interested in file {!r}".format(artifact.filepath))
+    lock_keys = [get_lock_key(index, indexer, artifact) for indexer in indexers]
+    with lock_context(locks, lock_keys):
+        for indexer in indexers:
+            try:
+                with stage('consume', indexer.INDEX_TYPE):
+                    indexer.consume_artifact(artifact)
+            except errors.FileAlreadyExists as error:
+                logger.warning("indexer {} says that file {!r} already exists, moving on".format(indexer, error))
+                continue
+
+
+def process_filepath(config, index, filepath, platform, arch, locks=None):
+    from .artifact import ParsedArtifact
+    with ingest_metrics.ingest(index, [filepath]):
+        with stage('parse'):
+            artifact = ParsedArtifact.from_filepath(filepath, platform, arch)
+        return process_artifact(config, index, artifact, locks)
+
+
+def process_filepath_by_name(config, index, filepath, locks=None):
+    from .artifact import ParsedArtifact
+    with ingest_metrics.ingest(index, [filepath]):
+        with stage('parse'):
+            artifact = ParsedArtifact.from_filepath(filepath)
+        return process_artifact(config, index, artifact, locks)
+
+
+def process_artifacts(config, index, artifacts, locks=None):
+    """Consumes a batch of files, letting every indexer regenerate each of its affected directories only once.
+
+    :returns: dict mapping each rejected file to the exception it was rejected with"""
+    failures = dict()
+    indexers = config.get_indexers(index)
+    artifacts_by_indexer = [(indexer, []) for indexer in indexers]
+    for artifact in artifacts:
         try:
-            indexer.consume_file(filepath, platform, arch)
-        except errors.FileAlreadyExists as error:
-            logger.warning("indexer {} says that file {!r} already exists, moving on".format(indexer, error))
+            interested = [indexer for indexer in indexers if indexer.are_you_interested_in_artifact(artifact)]
+        except Exception as error:
+            failures[artifact.filepath] = error
             continue
+        if not interested:
+            failures[artifact.filepath] = errors.FileNeglectedByIndexers("all indexers are not interested in file {!r}".format(artifact.filepath))
+        for indexer, indexer_artifacts in artifacts_by_indexer:
+            if indexer in interested:
+                indexer_artifacts.append(artifact)
+    lock_keys = [get_lock_key(index, indexer, artifact)
+                 for indexer, indexer_artifacts in artifacts_by_indexer for artifact in indexer_artifacts]
+    with lock_context(locks, lock_keys):
+        for indexer, indexer_artifacts in artifacts_by_indexer:
+            indexer_artifacts = [artifact for artifact in indexer_artifacts if artifact.filepath not in failures]
+            if not indexer_artifacts:
+                continue
+            with stage('consume', indexer.INDEX_TYPE):
+                indexer_failures = indexer.consume_artifacts(indexer_artifacts)
+            for filepath, error in indexer_failures.items():
+                if isinstance(error, errors.FileAlreadyExists):
+                    logger.warning("indexer {} says that file {!r} already exists, moving on".format(indexer, error))
+                    continue
+                failures[filepath] = error
+    return failures
 
 
-def process_filepath_by_name(config, index, filepath):
-    from .filename_parser import parse_filepath
-    package_name, package_version, platform_string, architecture, extension = parse_filepath(filepath)
-    return process_filepath(config, index, filepath, platform_string, architecture)
+def process_filepaths(config, index, items, locks=None):
+    """:param items: list of (filepath, platform, arch) tuples"""
+    from .artifact import ParsedArtifact
+    with ingest_metrics.ingest(index, [item[0] for item in items]):
+        with stage('parse'):
+            artifacts = [ParsedArtifact.from_filepath(*item) for item in items]
+        return process_artifacts(config, index, artifacts, locks)
 
 
-class AppRepoService(ServiceWithSynchronized):
+def process_filepaths_by_name(config, index, filepaths, locks=None):
+    from .artifact import ParsedArtifact
+    failures, artifacts = dict(), []
+    with ingest_metrics.ingest(index, filepaths):
+        with stage('parse'):
+            for filepath in filepaths:
+                try:
+                    artifacts.append(ParsedArtifact.from_filepath(filepath))
+                except errors.FilenameParsingFailed as error:
+                    failures[filepath] = error
+        failures.update(process_artifacts(config, index, artifacts, locks))
+    return failures
+
+
+class AppRepoService(ServiceBase):
     def __init__(self, config):
         super(AppRepoService, self).__init__()
         self.config = config
+        self.locks = LockHierarchy()
+        self.running_rebuilds = dict()  # (index, index type) -> indexer
+        self.ingest_queue = IngestQueue(config.ingest_queue_filepath, self._process_queued_filepath)
+        self.resign_job = ResignJob(config, self.locks)
+        self._resign_lock = Semaphore()  # one job at a time
+        if self.resign_job.is_interrupted():
+            from infi.gevent_utils.safe_greenlets import safe_spawn
+            logger.info("resuming the re-signing of the packages, which was interrupted")
+            safe_spawn(self.resign_packages)
 
     @rpc_call
-    @synchronized
     def reload_configuration_from_disk(self):
-        self.config = self.config.reload_configuration_from_disk()
+        with self.locks.exclusive(()):
+            self.config = self.config.reload_configuration_from_disk()
 
     @rpc_call
-    @synchronized
     def process_filepath(self, index, filepath, platform, arch):
         assert index in self.config.indexes
         self._try_except_finally_on_filepath(process_filepath, index, filepath, platform, arch)
 
     @rpc_call
-    @synchronized
     def process_filepath_by_name(self, index, filepath):
         assert index in self.config.indexes
         return self._try_except_finally_on_filepath(process_filepath_by_name, index, filepath)
 
+    def _reject_filepath(self, index, filepath):
+        try:
+            hard_link_or_raise_exception(filepath, path.join(self.config.rejected_directory, index))
+        except:
+            pass
+
     def _try_except_finally_on_filepath(self, func, index, filepath, *args, **kwargs): # TODO rejection needs a test
+        """:returns: True if the file was processed, False if it was rejected"""
         try:
-            func(self.config, index, filepath, *args, **kwargs)
+            func(self.config, index, filepath, *args, locks=self.locks, **kwargs)
+            return True
         except:
             logger.exception("processing source {} failed, moving it to {}".format(filepath, self.config.rejected_directory))
-            try:
-                hard_link_or_raise_exception(filepath, path.join(self.config.rejected_directory, index))
-            except:
-                pass
+            self._reject_filepath(index, filepath)
+            return False
         finally:
             remove(filepath)
 
+    def _process_queued_filepath(self, index, filepath):
+        return self._try_except_finally_on_filepath(process_filepath_by_name, index, filepath)
+
+    @rpc_call
+    def submit_filepath_by_name(self, index, filepath):
+        """Queues the file for processing and returns immediately"""
+        assert index in self.config.indexes
+        return self.ingest_queue.submit(index, filepath)
+
+    @rpc_call
+    def get_job_status(self, job_id):
+        return self.ingest_queue.get_job(job_id)
+
+    @rpc_call
+    def list_jobs(self, index=None, status=None):
+        return self.ingest_queue.list_jobs(index, status)
+
+    def _process_batch(self, index, filepaths):
+        try:
+            failures = process_filepaths_by_name(self.config, index, filepaths, self.locks)
+            for filepath, error in failures.items():
+                logger.error("processing source {} failed ({!r}), moving it to {}".format(filepath, error,
+                                                                                       self.config.rejected_directory))
+                self._reject_filepath(index, filepath)
+            return sorted(failures)
+        except:
+            logger.exception("processing batch {!r} failed, moving it to {}".format(filepaths, self.config.rejected_directory))
+            for filepath in filepaths:
+                self._reject_filepath(index, filepath)
+            return sorted(filepaths)
+        finally:
+            for filepath in filepaths:
+                if path.exists(filepath):
+                    remove(filepath)
+
+    @rpc_call
+    def process_filepaths_by_name(self, index, filepaths):
+        """:returns: list of the files that were rejected"""
+        assert index in self.config.indexes
+        return self._process_batch(index, filepaths)
+
     @rpc_call
-    @synchronized
     def process_incoming(self, index):
         assert index in self.config.indexes
-        for filepath in glob(path.join(self.config.incoming_directory, index, '*')):
-            self._try_except_finally_on_filepath(process_filepath_by_name, index, filepath)
+        queued = set(job['filepath'] for job in self.ingest_queue.list_jobs(index) if job['status'] in (PENDING, RUNNING))
+        filepaths = [filepath for filepath in glob(path.join(self.config.incoming_directory, index, '*')) if filepath not in queued]
+        return self._process_batch(index, sorted(filepaths))
+
+    @rpc_call
+    def get_ingest_metrics(self):
+        """:returns: histograms of the time each ingest stage took, a breakdown of the recent slow ingests, and the
+                  latency of the signing requests"""
+        return dict(ingest_metrics.to_dict(), signing=signing_metrics.to_dict())
 
     @rpc_call
-    @synchronized
     def rebuild_index(self, index, index_type=None):
         assert index in self.config.indexes
         for indexer in self.config.get_indexers(index):
             if index_type is None or index_type == indexer.INDEX_TYPE:
-                indexer.rebuild_index()
+                with self.locks.exclusive(get_lock_key(index, indexer)):
+                    self.running_rebuilds[(index, indexer.INDEX_TYPE)] = indexer
+                    try:
+                        indexer.rebuild_index()
+                    finally:
+                        del self.running_rebuilds[(index, indexer.INDEX_TYPE)]
+
+    @rpc_call
+    def get_rebuild_progress(self):
+        """:returns: list of the running rebuilds, with the number of done and total steps if the indexer counts them"""
+        return [dict(indexer.get_rebuild_progress(), index=index, index_type=index_type)
+                for (index, index_type), indexer in sorted(self.running_rebuilds.items())]
+
+    @rpc_call
+    def reconcile_catalog(self, index):
+        """:returns: the names of the packages whose catalog entries were out of sync with the disk, and were updated"""
+        assert index in self.config.indexes
+        for indexer in self.config.get_indexers(index):
+            if indexer.INDEX_TYPE == 'index':
+                with self.locks.exclusive(get_lock_key(index, indexer)):
+                    return indexer.reconcile()
 
     @rpc_call
-    @synchronized
     def get_artifacts(self, index, index_type=None):
         assert index in self.config.indexes
         all_files = []
         for indexer in self.config.get_indexers(index):
             if index_type is None or index_type == indexer.INDEX_TYPE:
-                all_files.extend(list(indexer.iter_files()))
+                with self.locks.shared(get_lock_key(index, indexer)):
+                    all_files.extend(list(indexer.iter_files()))
         return all_files
 
+    def _get_lock_key_for_artifact(self, filepath):
+        relative_path = path.relpath(path.abspath(filepath), self.config.packages_directory)
+        parts = relative_path.split(path.sep)
+        if parts[0] == path.pardir or len(parts) < 3:
+            return ()
+        return tuple(parts[:2])  # (index, index type)
+
     @rpc_call
-    @synchronized
     def delete_artifact(self, filepath):
-        if path.exists(filepath):
-            remove(filepath)
+        """:returns: True if the index was updated accordingly, False if it needs to be rebuilt"""
+        lock_key = self._get_lock_key_for_artifact(filepath)
+        with self.locks.exclusive(lock_key):
+            if len(lock_key) == 2:
+                index, index_type = lock_key
+                indexers = self.config.get_indexers(index) if index in self.config.indexes else []
+                for indexer in indexers:
+                    if indexer.INDEX_TYPE == index_type:
+                        return indexer.delete_artifact(filepath)
+            if path.exists(filepath):
+                remove(filepath)
+            return False
 
     @rpc_call
-    @synchronized
     def resign_packages(self):
-        from .install import sign_all_existing_deb_and_rpm_packages
-        sign_all_existing_deb_and_rpm_packages(self.config)
+        """Resumes the previous job if it was interrupted, see ResignJob.run"""
+        with self._resign_lock:
+            self.resign_job = ResignJob(self.config, self.locks)
+            return self.resign_job.run()
+
+    @rpc_call
+    def get_resign_progress(self):
+        """:returns: dict with whether re-signing is running, and the counts of the packages of every index"""
+        return self.resign_job.get_progress()
 
     @rpc_call
     def sign_rpm_package(self, rpm_filepath):
@@ -0,0 +1,165 @@
+"""Reads the ids of the OpenPGP keys rpms and debs are signed with, without forking gpg, rpm or dpkg-sig"""
+from __future__ import absolute_import
+from base64 import b64decode
+from binascii import hexlify, Error as BinasciiError
+from hashlib import sha1
+from struct import pack, unpack_from, error as StructError
+from infi.gevent_utils.os import path, fopen
+from logging import getLogger
+logger = getLogger(__name__)
+
+# packet tags
+SIGNATURE_PACKET, PUBLIC_KEY_PACKET, PUBLIC_SUBKEY_PACKET = 2, 6, 14
+# signature subpacket types
+ISSUER_SUBPACKET, ISSUER_FINGERPRINT_SUBPACKET = 16, 33
+
+
+class SignatureParsingFailed(Exception):
+    pass
+
+
+def _format_key_id(data):
+    return hexlify(bytes(data)).decode('ascii').upper()
+
+
+def _iter_packets(data):
+    """:returns: iterator of 2-tuples (tag, body)"""
+    data, offset = bytearray(data), 0
+    while offset < len(data):
+        octet = data[offset]
+        if not octet & 0x80:
+            raise SignatureParsingFailed("bad packet header at offset {}".format(offset))
+        if octet & 0x40:  # new format
+            tag, first = octet & 0x3f, data[offset + 1]
+            if first < 192:
+                size, offset = first, offset + 2
+            elif first < 224:
+                size, offset = ((first - 192) << 8) + data[offset + 2] + 192, offset + 3
+            elif first == 255:
+                size, offset = unpack_from('>I', data, offset + 2)[0], offset + 6
+            else:
+                raise SignatureParsingFailed("partial body lengths are not supported")
+        else:
+            tag, length_type = (octet >> 2) & 0xf, octet & 3
+            if length_type == 3:  # indeterminate, up to the end
+                size, offset = len(data) - offset - 1, offset + 1
+            else:
+                length_size = 1 << length_type
+                size = unpack_from('>' + 'BHI'[length_type], data, offset + 1)[0]
+                offset += 1 + length_size
+        if offset + size > len(data):
+            raise SignatureParsingFailed("truncated packet")
+        yield tag, data[offset:offset + size]
+        offset += size
+
+
+def _iter_subpackets(data):
+    """:returns: iterator of 2-tuples (type, body)"""
+    offset = 0
+    while offset < len(data):
+        first = data[offset]
+        if first < 192:
+            size, offset = first, offset + 1
+        elif first < 255:
+            size, offset = ((first - 192) << 8) + data[offset + 1] + 192, offset + 2
+        else:
+            size, offset = unpack_from('>I', data, offset + 1)[0], offset + 5
+        if not size or offset + size > len(data):
+            raise SignatureParsingFailed("truncated subpacket")
+        yield data[offset] & 0x7f, data[offset + 1:offset + size]
+        offset += size
+
+
+def _get_issuer_key_id(body):
+    """:returns: the id of the key that made the signature, or None if the signature does not say"""
+    version = body[0]
+    if version in (2, 3):
+        return _format_key_id(body[7:15])
+    if version != 4:
+        return None
+    hashed_size = unpack_from('>H', body, 4)[0]
+    unhashed_size = unpack_from('>H', body, 6 + hashed_size)[0]
+    subpackets = body[6:6 + hashed_size] + body[8 + hashed_size:8 + hashed_size + unhashed_size]
+    for subpacket_type, subpacket in _iter_subpackets(subpackets):
+        if subpacket_type == ISSUER_SUBPACKET:
+            return _format_key_id(subpacket)
+        if subpacket_type == ISSUER_FINGERPRINT_SUBPACKET:
+            return _format_key_id(subpacket[-8:])
+    return None
+
+
+def get_signature_key_ids(data):
+    """:param data: binary OpenPGP data
+    :returns: set of the ids of the keys that made the signatures in it"""
+    try:
+        key_ids = set(_get_issuer_key_id(body) for tag, body in _iter_packets(data) if tag == SIGNATURE_PACKET)
+    except (IndexError, StructError) as error:
+        raise SignatureParsingFailed("truncated signature: {!r}".format(error))
+    key_ids.discard(None)
+    return key_ids
+
+
+def get_public_key_ids(data):
+    """:param data: binary OpenPGP data, as `gpg --export` writes it
+    :returns: set of the ids of the primary key and of its subkeys, any of which may be the one that signs"""
+    key_ids = set()
+    try:
+        for tag, body in _iter_packets(data):
+            if tag in (PUBLIC_KEY_PACKET, PUBLIC_SUBKEY_PACKET) and body[0] == 4:
+                key_ids.add(_format_key_id(sha1(b'\x99' + pack('>H', len(body)) + bytes(body)).digest()[-8:]))
+    except (IndexError, StructError) as error:
+        raise SignatureParsingFailed("truncated key: {!r}".format(error))
+    return key_ids
+
+
+def dearmor(text, kind):
+    """:param kind: the kind of armored block, e.g. 'SIGNATURE' or 'PUBLIC KEY BLOCK'
+    :returns: the binary data of the first armored block of that kind in the text"""
+    lines = [line.strip() for line in text.splitlines()]
+    begin = next((index for index, line in enumerate(lines) if line == '-----BEGIN PGP {}-----'.format(kind)), None)
+    if begin is None:
+        raise SignatureParsingFailed("no armored {}".format(kind.lower()))
+    body = []
+    for line in lines[begin + 1:]:
+        if line.startswith('-----END PGP '):
+            break
+        if not line or ':' in line or (line.startswith('=') and len(line) == 5):  # headers and the crc
+            continue
+        body.append(line)
+    try:
+        return b64decode(''.join(body))
+    except (BinasciiError, TypeError, ValueError) as error:
+        raise SignatureParsingFailed("bad armor: {!r}".format(error))
+
+
+def read_public_key_ids(filepath):
+    """:returns: set of the key ids of the armored public key in the file, empty if there is no such file"""
+    if not path.exists(filepath):
+        return set()
+    with fopen(filepath) as fd:
+        return get_public_key_ids(dearmor(fd.read(), 'PUBLIC KEY BLOCK'))
+
+
+def get_package_key_ids(filepath):
+    """:returns: set of the ids of the keys the rpm or the .deb is signed with, empty if it is not signed"""
+    from .rpm import scan_rpm_signatures
+    from .deb import scan_deb_signatures
+    if filepath.endswith('.rpm'):
+        packets = scan_rpm_signatures(filepath)
+    else:
+        packets = [dearmor(member, 'SIGNATURE') for member in scan_deb_signatures(filepath)]
+    key_ids = set()
+    for packet in packets:
+        key_ids |= get_signature_key_ids(packet)
+    return key_ids
+
+
+def is_signed_by(filepath, key_ids):
+    """:returns: True if the package carries a signature of one of the keys; False if it does not, or cannot be read"""
+    from .rpm import RpmParsingFailed
+    from .deb import DebParsingFailed
+    try:
+        return bool(get_package_key_ids(filepath).intersection(key_ids))
+    except (RpmParsingFailed, DebParsingFailed, SignatureParsingFailed, IOError, OSError) as error:
+        logger.debug("failed to read the signatures of {}: {!r}".format(filepath, error))
+        return False
@@ -0,0 +1,150 @@
+"""Serves all the gpg signing of the process: detached and clear signatures of files, and signatures of packages"""
+from __future__ import absolute_import
+from logging import getLogger
+from time import time
+from gevent.event import AsyncResult
+from gevent.queue import Queue, Empty
+from infi.gevent_utils.os import path
+from infi.gevent_utils.safe_greenlets import safe_spawn
+from .metrics import signing_metrics
+from .utils import log_execute_assert_success
+logger = getLogger(__name__)
+
+DETACHED, CLEAR, RPM, DEB = 'detached', 'clear', 'rpm', 'deb'
+MAX_BATCH_SIZE = 50  # packages per rpm or dpkg-sig process
+
+
+def gpg(cmdline_arguments):
+    return log_execute_assert_success(['gpg'] + cmdline_arguments).get_stdout()
+
+
+def rpm_addsign(filepaths):
+    from os import environ
+    from six.moves import shlex_quote
+    env = environ.copy()
+    env['HOME'] = env.get('HOME', "/root")
+    env['GNUPGHOME'] = path.join(env.get('HOME', "/root"), ".gnupg")
+    command = 'echo | setsid rpm --addsign {}'.format(' '.join(shlex_quote(filepath) for filepath in filepaths))
+    log_execute_assert_success(command, env=env, shell=True)
+
+
+def dpkg_sig(filepaths):
+    log_execute_assert_success(['dpkg-sig', '--sign', 'builder'] + list(filepaths))
+
+
+def launch_gpg_agent():
+    try:
+        log_execute_assert_success(['gpgconf', '--launch', 'gpg-agent'], allow_to_fail=True)
+    except OSError:  # gpg 1 has no gpgconf, nor does it need an agent
+        pass
+
+
+class Signer(object):
+    """Queues the signing requests of the process and serves them with one worker greenlet, which is spawned when
+    there is work to do and exits when the queue is drained.
+
+    The gpg-agent is launched once and kept, so every gpg process, including the ones rpm and dpkg-sig fork, finds it
+    running with the key loaded. Package requests that queue up together are signed by one rpm or dpkg-sig process;
+    if that process fails, the packages are signed one by one, so only the bad ones fail."""
+
+    def __init__(self):
+        super(Signer, self).__init__()
+        self._queue = Queue()
+        self._worker = None
+        self._agent_launched = False
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.ready():
+            self._worker = safe_spawn(self._work)
+
+    def _submit(self, kind, *args):
+        result = AsyncResult()
+        self._queue.put((kind, args, time(), result))
+        self._ensure_worker()
+        return result.get()
+
+    def sign_detached(self, filepath, output):
+        """Writes an armored detached signature of the file"""
+        return self._submit(DETACHED, filepath, output)
+
+    def sign_clear(self, filepath, output, digest_algo='SHA256'):
+        """Writes the file, clearsigned"""
+        return self._submit(CLEAR, filepath, output, digest_algo)
+
+    def sign_rpm(self, filepath):
+        """Adds a signature to the rpm, in place"""
+        return self._submit(RPM, filepath)
+
+    def sign_deb(self, filepath):
+        """Adds a builder signature to the .deb, in place"""
+        return self._submit(DEB, filepath)
+
+    def _work(self):
+        while True:
+            requests = []
+            while True:
+                try:
+                    requests.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            if not requests:
+                return
+            try:
+                self._serve(requests)
+            except Exception as error:  # the requests are off the queue, their submitters must not wait forever
+                logger.exception("failed to serve {} signing requests".format(len(requests)))
+                self._agent_launched = False
+                for _, _, _, result in requests:
+                    if not result.ready():
+                        result.set_exception(error)
+
+    def _serve(self, requests):
+        if not self._agent_launched:
+            launch_gpg_agent()
+            self._agent_launched = True
+        for kind, func in ((RPM, rpm_addsign), (DEB, dpkg_sig)):
+            packages = [request for request in requests if request[0] == kind]
+            for index in range(0, len(packages), MAX_BATCH_SIZE):
+                self._sign_packages(kind, func, packages[index:index + MAX_BATCH_SIZE])
+        for request in requests:
+            if request[0] in (DETACHED, CLEAR):
+                self._sign_file(request)
+
+    def _sign_packages(self, kind, func, requests):
+        start = time()
+        try:
+            func([args[0] for _, args, _, _ in requests])
+        except Exception as error:
+            if len(requests) > 1:
+                logger.warning("failed to sign {} {} packages together, signing them one by one".format(len(requests), kind))
+                for request in requests:
+                    self._sign_packages(kind, func, [request])
+                return
+            requests[0][3].set_exception(error)
+            return
+        duration = time() - start
+        signing_metrics.observe_batch(kind, len(requests))
+        for _, _, submitted, result in requests:
+            signing_metrics.observe(kind, start - submitted, duration)
+            result.set(None)
+
+    def _sign_file(self, request):
+        kind, args, submitted, result = request
+        start = time()
+        try:
+            if kind == DETACHED:
+                filepath, output = args
+                gpg(['-a', '--detach-sign', '-o', output, filepath])
+            else:
+                filepath, output, digest_algo = args
+                gpg(['--clearsign', '--digest-algo', digest_algo, '-o', output, filepath])
+        except Exception as error:
+            self._agent_launched = False  # the agent may have gone away, launch it again before the next requests
+            result.set_exception(error)
+            return
+        signing_metrics.observe_batch(kind, 1)
+        signing_metrics.observe(kind, start - submitted, time() - start)
+        result.set(None)
+
+
+signer = Signer()
@@ -1,15 +1,24 @@
 from __future__ import print_function
 from logging import getLogger
-from infi.gevent_utils.os import path, walk, link, makedirs, remove, fopen, stat
+from infi.gevent_utils.os import path, walk, link, makedirs, remove, fopen, stat, rename, chmod
 from infi.gevent_utils.json_utils import encode, decode, DecodeError
 from infi.gevent_utils.deferred import create_threadpool_executed_func
-from infi.gevent_utils.shutil import copyfile, copyfileobj
 from infi.execute import execute_assert_success, ExecutionError
 from infi.pyutils.contexts import contextmanager
 from fnmatch import fnmatch
+from collections import OrderedDict
 from .errors import FileAlreadyExists
 logger = getLogger(__name__)
 
+READ_SIZE = 1024 * 1024
+
+
+def iter_file_chunks(filepath):
+    """Reads a file in chunks of READ_SIZE bytes, with the builtin open, as it is called in threads"""
+    with open(filepath, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(READ_SIZE), b''):
+            yield chunk
+
 
 def log_execute_assert_success(args, allow_to_fail=False, **kwargs):
     logger.info("Executing {}".format(' '.join(args) if isinstance(args, (list, tuple)) else args))
@@ -24,31 +33,73 @@ def log_execute_assert_success(args, allow_to_fail=False, **kwargs):
             raise
 
 
-def sign_rpm_package(filepath):
+FICLONE = 0x40049409  # from linux/fs.h
 
-    def _rpm_addsign_rewrites_the_file(filepath):
-        from os import environ
-        logger.info("Signing {!r}".format(filepath))
-        command = ['rpm', '--addsign', filepath]
-        env = environ.copy()
-        env['HOME'] = env.get('HOME', "/root")
-        env['GNUPGHOME'] = path.join(env.get('HOME', "/root"), ".gnupg")
-        log_execute_assert_success('echo | setsid rpm --addsign {}'.format(filepath), env=env, shell=True)
 
+@create_threadpool_executed_func
+def _copy_file_contents(src, dst):
+    """Writes the contents of src into dst, keeping the inode of dst if it exists.
+    The data is shared with a reflink where the filesystem supports it, and copied in the kernel otherwise"""
+    import os
+    from fcntl import ioctl
+    from shutil import copyfileobj
+    with open(src, 'rb') as src_fd, open(dst, 'wb') as dst_fd:
+        try:
+            ioctl(dst_fd.fileno(), FICLONE, src_fd.fileno())
+            return
+        except (IOError, OSError):
+            pass
+        if hasattr(os, 'copy_file_range'):
+            remaining = os.fstat(src_fd.fileno()).st_size
+            try:
+                while remaining:
+                    copied = os.copy_file_range(src_fd.fileno(), dst_fd.fileno(), remaining)
+                    if not copied:
+                        break
+                    remaining -= copied
+            except OSError:  # e.g. EXDEV, ENOSYS or EINVAL where the kernel or the filesystems do not support it
+                pass
+            else:
+                if not remaining:
+                    return
+            src_fd.seek(0)
+            dst_fd.seek(0)
+            dst_fd.truncate()
+        copyfileobj(src_fd, dst_fd)
+
+
+def _rpm_addsign(filepath):
+    from .signer import signer
+    logger.info("Signing {!r}".format(filepath))
+    signer.sign_rpm(filepath)
+
+
+def sign_rpm_package(filepath, hard_links=()):
+    """Signs a copy of the rpm next to it, and then renames the copy over it.
+
+    :param hard_links: the other paths of the file, they are linked to the signed file as well.
+                       If the file has other links, the signed contents are written back into it instead"""
     temp_filepath = filepath + '.signed'
-    copyfile(filepath, temp_filepath)
+    _copy_file_contents(filepath, temp_filepath)
     try:
-        _rpm_addsign_rewrites_the_file(temp_filepath)
-        with open(temp_filepath, 'rb') as src:
-            with open(filepath, 'wb') as dst:
-                copyfileobj(src, dst)
+        _rpm_addsign(temp_filepath)
+        if stat(filepath).st_nlink > 1 + len(hard_links):
+            _copy_file_contents(temp_filepath, filepath)
+            return
+        chmod(temp_filepath, stat(filepath).st_mode)
+        rename(temp_filepath, filepath)
+        for link_path in hard_links:
+            link(filepath, link_path + '.signed')
+            rename(link_path + '.signed', link_path)
     finally:
-        remove(temp_filepath)
+        if path.exists(temp_filepath):
+            remove(temp_filepath)
 
 
 def sign_deb_package(filepath):
+    from .signer import signer
     logger.info("Signing {!r}".format(filepath))
-    log_execute_assert_success(['dpkg-sig', '--sign', 'builder', filepath])
+    signer.sign_deb(filepath)
 
 
 def find_files(directory, pattern):
@@ -79,7 +130,9 @@ def chdir(path):
 
 
 @contextmanager
-def temporary_directory_context():
+def temporary_directory_context(change_directory=True):
+    """:param change_directory: the working directory is the process's, so the greenlets that may run concurrently with
+                                others in their own temporary directories must pass False"""
     from infi.gevent_utils.tempfile import mkdtemp
     from infi.gevent_utils.shutil import rmtree
     #tempdir = mkdtemp()
@@ -87,7 +140,10 @@ def temporary_directory_context():
     ensure_directory_exists("/opt/temp/")
     tempdir = mkdtemp(dir="/opt/temp/")
     try:
-        with chdir(tempdir):
+        if change_directory:
+            with chdir(tempdir):
+                yield tempdir
+        else:
             yield tempdir
     finally:
         rmtree(tempdir, ignore_errors=True)
@@ -173,9 +229,52 @@ def file_type_contains(filepath, output):
         logger.exception('failed to determine file type: {0}'.format(filepath))
         return False
 
+
+RPM_LEAD_MAGIC = b'\xed\xab\xee\xdb'
+AR_MAGIC = b'!<arch>\n'
+DEBIAN_BINARY_MEMBER_NAMES = (b'debian-binary', b'debian-binary/')
+PACKAGE_TYPE_CACHE_SIZE = 4096
+_package_type_cache = OrderedDict()
+
+
+def _sniff_package_type(header):
+    if header.startswith(RPM_LEAD_MAGIC):
+        return 'rpm'
+    # an ar archive whose first member is debian-binary; the member name is the first 16 bytes of the member header
+    if header.startswith(AR_MAGIC) and header[len(AR_MAGIC):len(AR_MAGIC) + 16].rstrip() in DEBIAN_BINARY_MEMBER_NAMES:
+        return 'deb'
+    return None
+
+
+def get_package_type(filepath):
+    """:returns: 'rpm', 'deb' or None, according to the file's magic bytes.
+
+    Verdicts are cached by (device, inode, size, mtime), so all the indexers that look at the same file during an
+    ingest share one read of its header, and rewriting the file (for example when signing it) invalidates the entry"""
+    try:
+        stat_result = stat(filepath)
+    except OSError:
+        logger.exception('failed to determine file type: {0}'.format(filepath))
+        return None
+    key = (stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime)
+    if key in _package_type_cache:
+        _package_type_cache.move_to_end(key)
+        return _package_type_cache[key]
+    try:
+        with fopen(filepath, 'rb') as fd:
+            package_type = _sniff_package_type(fd.read(len(AR_MAGIC) + 16))
+    except (OSError, IOError):
+        logger.exception('failed to determine file type: {0}'.format(filepath))
+        return None
+    _package_type_cache[key] = package_type
+    if len(_package_type_cache) > PACKAGE_TYPE_CACHE_SIZE:
+        _package_type_cache.popitem(last=False)
+    return package_type
+
+
 def is_really_rpm(filepath):
-    return file_type_contains(filepath, ": RPM")
+    return get_package_type(filepath) == 'rpm'
 
 
 def is_really_deb(filepath):
-    return file_type_contains(filepath, 'Debian binary package')
+    return get_package_type(filepath) == 'deb'
@@ -54,11 +54,20 @@ class FlaskApp(flask.Flask):
             self.route("/indexes")(indexes_tree)
             self.route("/")(default_homepage)
 
+        def _metrics():
+            self.route("/metrics")(ingest_metrics)
+
+        def _catalog():
+            self.route("/catalog/<index_name>")(catalog_packages)
+            self.route("/catalog/<index_name>/<package>")(catalog_releases)
+
         _directory_index()
         _setup_script()
         _download_script()
         _install_script()
         _homepage()
+        _metrics()
+        _catalog()
 
     def _register_counters(self):
         from infi.app_repo.persistent_dict import PersistentDict
@@ -168,6 +177,48 @@ def indexes_tree():
     return flask.Response(json.dumps(indexes), content_type='application/json')
 
 
+def ingest_metrics():
+    from infi.app_repo.service import get_client
+    from infi.app_repo.metrics import format_metrics
+    try:
+        metrics = get_client(flask.current_app.app_repo_config).get_ingest_metrics()
+    except:
+        logger.exception("failed to get the ingest metrics from the rpc server")
+        raise flask.abort(503)
+    return flask.Response(format_metrics(metrics), content_type='text/plain; version=0.0.4')
+
+
+def _get_catalog(index_name):
+    from infi.app_repo.catalog import Catalog
+    config = flask.current_app.app_repo_config
+    if index_name not in config.indexes:
+        raise flask.abort(404)
+    catalog = Catalog(path.join(config.packages_directory, index_name, 'index', 'catalog.sqlite'))
+    if not catalog.exists():
+        raise flask.abort(404)
+    return catalog
+
+
+def catalog_packages(index_name):
+    packages = [package for package in _get_catalog(index_name).get_packages() if not package['hidden']]
+    return flask.Response(json.dumps(packages), content_type='application/json')
+
+
+def catalog_releases(index_name, package):
+    from infi.app_repo.indexers.wget import get_distribution_relpath
+    url_prefix = '/packages/{}/index/'.format(index_name)
+    releases = []
+    for release in _get_catalog(index_name).get_releases(package):
+        distributions = [dict(distribution, url=url_prefix + get_distribution_relpath(distribution))
+                         for distribution in release['distributions'] if not distribution['hidden']]
+        if distributions and not release['hidden']:
+            releases.append(dict(release, distributions=distributions))
+    if not releases:
+        raise flask.abort(404)
+    releases.sort(key=lambda release: pkg_resources.parse_version(release['version']), reverse=True)
+    return flask.Response(json.dumps(releases), content_type='application/json')
+
+
 def default_homepage():
     default = flask.current_app.app_repo_config.webserver.default_index
     if default:
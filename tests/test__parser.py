@@ -1,5 +1,6 @@
 from infi.unittest import TestCase, parameters
-from infi.app_repo.filename_parser import parse_filepath
+from infi.app_repo.filename_parser import parse_filepath, parse_many, _parse_basename
+from infi.app_repo.platforms import KNOWN_PLATFORMS, KNOWN_DISTRIBUTIONS
 
 
 cases = [
@@ -137,3 +138,42 @@ class ParserTestCase(TestCase):
     def test_parser(self, case):
         actual = parse_filepath(case['basename'])
         self.assertEqual(actual, case['expected'])
+
+
+class ParseManyTestCase(TestCase):
+    def test_parse_many(self):
+        filepaths = ["/incoming/main-stable/" + case['basename'] for case in cases] + ["/incoming/main-stable/README"]
+        results, failures = parse_many(filepaths)
+        self.assertEqual(failures, ["/incoming/main-stable/README"])
+        for case in cases:
+            self.assertEqual(results["/incoming/main-stable/" + case['basename']], case['expected'])
+
+    def test_known_platforms_are_parsable(self):
+        basenames = ["foo-1.0-{}-{}.rpm".format(platform, arch)
+                     for platform, archs in KNOWN_PLATFORMS.items() for arch in archs]
+        basenames += ["foo-1.0-{}-{}-{}.deb".format(distribution, codename, arch)
+                      for distribution, codenames in KNOWN_DISTRIBUTIONS.items()
+                      for codename, archs in codenames.items() for arch in {'i386': 'x86', 'amd64': 'x64'}.values()]
+        results, failures = parse_many(basenames)
+        self.assertEqual(failures, [])
+
+    def test_benchmark(self):
+        from time import time
+        platforms = sorted(KNOWN_PLATFORMS) + ['windows', 'python', 'linux-ubuntu-focal', 'aix-7.1', 'solaris-11']
+        basenames = ["package-{}-1.{}.{}-{}-{}.{}".format(index % 50, index % 7, index, platforms[index % len(platforms)],
+                                                         ('x86', 'x64', 'ppc64le')[index % 3],
+                                                         ('rpm', 'deb', 'msi', 'tar.gz')[index % 4])
+                     for index in range(100000)]
+        _parse_basename.cache_clear()
+        start = time()
+        results, failures = parse_many(basenames)
+        first_pass = time() - start
+        recent = basenames[-10000:]
+        start = time()
+        parse_many(recent)
+        cached_pass = (time() - start) * len(basenames) / len(recent)
+        self.assertEqual(failures, [])
+        self.assertEqual(len(results), len(basenames))
+        self.assertLess(cached_pass, first_pass)
+        print("parsed {} file names: {:.0f}/s, {:.0f}/s cached".format(len(basenames), len(basenames) / first_pass,
+                                                                      len(basenames) / cached_pass))
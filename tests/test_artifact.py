@@ -0,0 +1,56 @@
+from .test_case import TestCase
+from infi.app_repo.artifact import ParsedArtifact
+from infi.app_repo.errors import FilenameParsingFailed
+from infi.app_repo.utils import temporary_directory_context, fopen, path
+from mock import patch
+
+
+class ParsedArtifactTestCase(TestCase):
+    def test_from_filepath(self):
+        with temporary_directory_context():
+            with fopen('my-app-0.1-linux-ubuntu-xenial-x64.deb', 'wb') as fd:
+                fd.write(b'!<arch>\ndebian-binary   ')
+            artifact = ParsedArtifact.from_filepath(path.abspath('my-app-0.1-linux-ubuntu-xenial-x64.deb'))
+            self.assertEqual((artifact.package_name, artifact.package_version, artifact.platform, artifact.arch,
+                              artifact.extension, artifact.size, artifact.package_type),
+                             ('my-app', '0.1', 'linux-ubuntu-xenial', 'x64', 'deb', 24, 'deb'))
+            self.assertIsNotNone(artifact.inode)
+            self.assertEqual(artifact, ParsedArtifact.from_filepath(path.abspath('my-app-0.1-linux-ubuntu-xenial-x64.deb')))
+
+    def test_immutable(self):
+        artifact = ParsedArtifact(filepath='foo')
+        with self.assertRaises(AttributeError):
+            artifact.filepath = 'bar'
+        with self.assertRaises(AttributeError):
+            artifact.something_else = 'bar'
+        with self.assertRaises(TypeError):
+            ParsedArtifact(something_else='bar')
+
+    def test_unparsable_file_name(self):
+        with self.assertRaises(FilenameParsingFailed):
+            ParsedArtifact.from_filepath('does-not-exist')
+        artifact = ParsedArtifact.from_filepath('does-not-exist', 'linux-redhat-7', 'x64')
+        self.assertFalse(artifact.is_parsed)
+        self.assertEqual((artifact.platform, artifact.arch, artifact.size, artifact.package_type),
+                         ('linux-redhat-7', 'x64', None, None))
+        with self.assertRaises(FilenameParsingFailed):
+            artifact.assert_parsed()
+
+    def test_file_is_parsed_and_sniffed_once_per_ingest(self):
+        from infi.app_repo import artifact, service
+        from infi.app_repo.config import Configuration
+        from infi.app_repo.indexers import get_indexers
+        with self.temporary_base_directory_context():
+            config = Configuration.from_disk(None)
+            indexers = [indexer for indexer in get_indexers(config, 'main-stable') if indexer.INDEX_TYPE in ('index', 'pypi', 'ova')]
+            config.get_indexers = lambda name: indexers
+            for indexer in indexers:
+                indexer.initialise()
+            filepath = path.join(config.base_directory, 'my-app-0.1-windows-x64.msi')
+            with fopen(filepath, 'w'):
+                pass
+            with patch.object(artifact, 'parse_filepath', wraps=artifact.parse_filepath) as parse_filepath, \
+                 patch.object(artifact, 'get_package_type', wraps=artifact.get_package_type) as get_package_type:
+                service.process_filepath_by_name(config, 'main-stable', filepath)
+            self.assertEqual(parse_filepath.call_count, 1)
+            self.assertEqual(get_package_type.call_count, 1)
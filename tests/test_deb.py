@@ -0,0 +1,106 @@
+from .test_case import TestCase
+from infi.app_repo import deb
+from infi.app_repo.utils import path, fopen, write_file, ensure_directory_exists, log_execute_assert_success
+from mock import patch
+
+CONTROL = """Package: hello
+Version: 1.0
+Architecture: amd64
+Maintainer: Infinidat <info@infinidat.com>
+Section: utils
+Priority: optional
+Homepage: http://www.infinidat.com
+X-Custom-Field: yes
+Description: Some description
+ with a long description.
+ .
+ and a second paragraph.
+"""
+
+EXPECTED_STANZA = """Package: hello
+Architecture: amd64
+Version: 1.0
+Priority: optional
+Section: utils
+Maintainer: Infinidat <info@infinidat.com>
+Filename: dists/focal/main/binary-amd64/hello.deb
+Size: {size}
+MD5sum: {md5}
+SHA1: {sha1}
+SHA256: {sha256}
+SHA512: {sha512}
+Homepage: http://www.infinidat.com
+Description: Some description
+ with a long description.
+ .
+ and a second paragraph.
+X-Custom-Field: yes
+
+"""
+
+
+class DebTestCase(TestCase):
+    def _build_deb(self, compression='gzip', basename='hello.deb'):
+        source = path.abspath('hello-source')
+        ensure_directory_exists(path.join(source, 'DEBIAN'))
+        ensure_directory_exists(path.join(source, 'usr', 'share', 'hello'))
+        write_file(path.join(source, 'DEBIAN', 'control'), CONTROL)
+        write_file(path.join(source, 'usr', 'share', 'hello', 'README'), 'hello\n' * 1000)
+        filepath = path.abspath(basename)
+        log_execute_assert_success(['dpkg-deb', '-Z' + compression, '--root-owner-group', '--build', source, filepath])
+        return filepath
+
+    def _get_expected_stanza(self, filepath):
+        from hashlib import md5, sha1, sha256, sha512
+        with fopen(filepath, 'rb') as fd:
+            contents = fd.read()
+        return EXPECTED_STANZA.format(size=len(contents), md5=md5(contents).hexdigest(), sha1=sha1(contents).hexdigest(),
+                                      sha256=sha256(contents).hexdigest(), sha512=sha512(contents).hexdigest())
+
+    def test_format_stanza(self):
+        with self.temporary_base_directory_context():
+            for compression in ('gzip', 'xz'):
+                filepath = self._build_deb(compression)
+                stanza = deb.format_stanza(deb.scan_deb(filepath), 'dists/focal/main/binary-amd64/hello.deb')
+                self.assertEqual(stanza, self._get_expected_stanza(filepath))
+
+    def test_format_stanza_matches_apt_ftparchive(self):
+        from distutils.spawn import find_executable
+        if not find_executable('apt-ftparchive'):
+            self.skipTest("apt-ftparchive is not installed")
+        with self.temporary_base_directory_context() as tempdir:
+            ensure_directory_exists(path.join(tempdir, 'dists', 'focal', 'main', 'binary-amd64'))
+            for compression in ('gzip', 'xz'):
+                filepath = self._build_deb(compression, 'dists/focal/main/binary-amd64/hello.deb')
+                expected = log_execute_assert_success(['apt-ftparchive', 'packages', 'dists/focal/main/binary-amd64'],
+                                                      cwd=tempdir).get_stdout()
+                stanza = deb.format_stanza(deb.scan_deb(filepath), 'dists/focal/main/binary-amd64/hello.deb')
+                self.assertEqual(stanza.encode('utf-8'), expected)
+
+    def test_not_a_deb(self):
+        with self.temporary_base_directory_context():
+            write_file('empty.deb', '')
+            with self.assertRaises(deb.DebParsingFailed):
+                deb.scan_deb(path.abspath('empty.deb'))
+
+    def test_stanza_cache(self):
+        with self.temporary_base_directory_context():
+            filepath = self._build_deb()
+            write_file('empty.deb', '')
+            items = [(filepath, 'dists/focal/main/binary-amd64/hello.deb'), (path.abspath('empty.deb'), 'empty.deb')]
+            cache = deb.StanzaCache(path.abspath('cache.msgpack'))
+            stanzas, failures = cache.get_stanzas(items)
+            self.assertEqual(stanzas, [self._get_expected_stanza(filepath)])
+            self.assertEqual(failures, [path.abspath('empty.deb')])
+
+            with patch.object(deb, 'scan_deb', side_effect=AssertionError("should be cached")):
+                stanzas, failures = deb.StanzaCache(path.abspath('cache.msgpack')).get_stanzas(items[:1])
+            self.assertEqual(stanzas, [self._get_expected_stanza(filepath)])
+
+            filepath = self._build_deb('xz')  # same path, different contents
+            stanzas, failures = deb.StanzaCache(path.abspath('cache.msgpack')).get_stanzas(items[:1])
+            self.assertEqual(stanzas, [self._get_expected_stanza(filepath)])
+
+            cache = deb.StanzaCache(path.abspath('cache.msgpack'))
+            cache.prune([])
+            self.assertEqual(list(deb.StanzaCache(path.abspath('cache.msgpack'))._entries.keys()), [])
@@ -48,7 +48,7 @@ class FtpWithRpcTestCase(TemporaryBaseDirectoryTestCase):
         ensure_directory_exists(path.join(self.config.incoming_directory, 'main-stable'))
         self.test_succeded = Event()
 
-    def mark_success(self, config, index, filepath):
+    def mark_success(self, config, index, filepath, locks=None):
         self.test_succeded.set()
 
     def test_upload(self):
@@ -3,8 +3,10 @@ from infi.app_repo.indexers import get_indexers
 from infi.app_repo.config import Configuration
 from infi.app_repo.install import setup_gpg, ensure_incoming_and_rejected_directories_exist_for_all_indexers, destroy_all
 from infi.app_repo.mock import patch_all
-from infi.app_repo.utils import path, fopen, decode
+from infi.app_repo.utils import path, fopen, decode, ensure_directory_exists, hard_link_or_raise_exception, write_file
 from infi.pyutils.contexts import contextmanager
+from mock import patch
+from glob import glob
 
 
 def read_json_file(filepath):
@@ -69,6 +71,413 @@ class IndexersTestCase(TestCase):
             self.assertFalse(indexer.are_you_interested_in_file('foo.deb', 'linux-redhat-7', 'x64'))
             indexer.consume_file(filepath, 'linux-redhat-7', 'x64')
 
+    def test_yum_consume_files_updates_each_directory_once(self):
+        from infi.app_repo.indexers import yum
+        with self._setup_context() as config:
+            indexer = yum.YumIndexer(config, 'main-stable')
+            indexer.initialise()
+            items = [(self.write_new_package_in_incoming_directory(config, package_basename='package-%s' % i, extension='rpm'),
+                      platform, 'x64') for i, platform in enumerate(['linux-redhat-7', 'linux-redhat-7', 'linux-centos-7'])]
+            yum.createrepo_update.reset_mock()
+            self.assertEqual(indexer.consume_files(items), {})
+            self.assertEqual(yum.createrepo_update.call_count, 2)
+            self.assertTrue(path.exists(path.join(indexer.base_directory, 'linux-redhat-7-x86_64', 'package-1.rpm')))
+
+    def test_yum_repodata_is_written_natively(self):
+        from infi.app_repo.indexers import yum
+        from infi.app_repo import rpm
+        from .test_rpm import build_rpm
+        import gzip
+        with self._setup_context() as config:
+            indexer = yum.YumIndexer(config, 'main-stable')
+            indexer.initialise()
+            yum.createrepo.reset_mock()
+            yum.createrepo_update.reset_mock()
+            dirpath = path.join(indexer.base_directory, 'linux-redhat-7-x86_64')
+            for basename in ('hello-1.0-1.el7.x86_64.rpm', 'hello-1.1-1.el7.x86_64.rpm'):
+                filepath = path.join(config.incoming_directory, 'main-stable', basename)
+                build_rpm(filepath)
+                with patch.object(rpm, 'scan_rpm', wraps=rpm.scan_rpm) as scan_rpm:
+                    indexer.consume_file(filepath, 'linux-redhat-7', 'x64')
+                scan_rpm.assert_called_once_with(path.join(dirpath, basename))  # the first one is cached
+            self.assertFalse(yum.createrepo.called or yum.createrepo_update.called)
+            with gzip.open(path.join(dirpath, 'repodata', 'primary.xml.gz'), 'rb') as fd:
+                primary = fd.read().decode()
+            self.assertIn('packages="2"', primary)
+            self.assertIn('<location href="hello-1.0-1.el7.x86_64.rpm"/>', primary)
+            self.assertIn('<location href="hello-1.1-1.el7.x86_64.rpm"/>', primary)
+            self.assertFalse(path.exists(path.join(dirpath, 'repodata', 'primary.sqlite.bz2')))
+
+            config.sqlite_repodata_indexes = ['main-stable']
+            indexer.rebuild_index()
+            self.assertTrue(path.exists(path.join(dirpath, 'repodata', 'primary.sqlite.bz2')))
+            self.assertTrue(path.exists(path.join(indexer.cachedir, 'sqlite', 'linux-redhat-7-x86_64', 'primary.sqlite')))
+
+            # an rpm that cannot be parsed falls back to createrepo
+            filepath = self.write_new_package_in_incoming_directory(config, extension='rpm')
+            indexer.consume_file(filepath, 'linux-redhat-7', 'x64')
+            self.assertEqual(yum.createrepo_update.call_count, 1)
+
+    def test_yum_rebuild_index_swaps_repodata_atomically(self):
+        from infi.app_repo.indexers import yum
+        from .test_rpm import build_rpm
+        with self._setup_context() as config:
+            indexer = yum.YumIndexer(config, 'main-stable')
+            indexer.initialise()
+            dirpath = path.join(indexer.base_directory, 'linux-redhat-7-x86_64')
+            filepath = path.join(config.incoming_directory, 'main-stable', 'hello-1.0-1.el7.x86_64.rpm')
+            build_rpm(filepath)
+            indexer.consume_file(filepath, 'linux-redhat-7', 'x64')
+            repomd = path.join(dirpath, 'repodata', 'repomd.xml')
+
+            def sign_repomd(dirpath, repodata_dirname='repodata'):
+                self.assertEqual(repodata_dirname, 'repodata.new')
+                self.assertTrue(path.exists(repomd))  # the current repodata is served until the new one is swapped in
+
+            for _ in range(3):
+                with patch.object(yum, 'sign_repomd', side_effect=sign_repomd):
+                    indexer.rebuild_index()
+                self.assertTrue(path.islink(path.join(dirpath, 'repodata')))
+                with fopen(repomd) as fd:
+                    self.assertIn('<data type="primary">', fd.read())
+                self.assertTrue(path.exists(path.join(dirpath, 'repodata', 'primary.xml.gz')))
+                self.assertTrue(path.exists(path.join(dirpath, 'repodata', 'repomd.xml.key')))
+            self.assertFalse(path.exists(path.join(dirpath, 'repodata.new')))
+            self.assertEqual(len(glob(path.join(dirpath, 'repodata.*'))), 2)  # the current and the previous generations
+
+            # unparsable rpms are handled by createrepo, into the staging directory as well
+            filepath = self.write_new_package_in_incoming_directory(config, extension='rpm')
+            hard_link_or_raise_exception(filepath, dirpath)
+            yum.createrepo.reset_mock()
+            indexer.rebuild_index()
+            self.assertTrue(yum.createrepo.called)
+            self.assertTrue(path.islink(path.join(dirpath, 'repodata')))
+
+    def test_yum_consume_file_swaps_repodata_atomically(self):
+        from infi.app_repo.indexers import yum
+        from .test_rpm import build_rpm
+        with self._setup_context() as config:
+            config.rebuild_workers = 4
+            indexer = yum.YumIndexer(config, 'main-stable')
+            indexer.initialise()
+            dirpath = path.join(indexer.base_directory, 'linux-redhat-7-x86_64')
+            repomd = path.join(dirpath, 'repodata', 'repomd.xml')
+            filepath = path.join(config.incoming_directory, 'main-stable', 'hello-1.0-1.el7.x86_64.rpm')
+            build_rpm(filepath)
+            indexer.consume_file(filepath, 'linux-redhat-7', 'x64')
+            self.assertTrue(path.islink(path.join(dirpath, 'repodata')))
+            self.assertTrue(path.exists(path.join(dirpath, 'repodata.0')))  # the directory initialise created
+
+            def createrepo_update(dirpath, cachedir=None, workers=1, outputdir=None):
+                self.assertNotEqual(outputdir, None)  # createrepo works on a copy of the current repodata
+                self.assertEqual(workers, 1)  # only the new rpms are parsed
+                self.assertTrue(path.exists(path.join(outputdir, 'repodata', 'repomd.xml')))
+                self.assertTrue(path.exists(repomd))
+
+            # an rpm that cannot be parsed falls back to createrepo
+            filepath = self.write_new_package_in_incoming_directory(config, extension='rpm')
+            with patch.object(yum, 'createrepo_update', side_effect=createrepo_update) as createrepo_update_mock:
+                indexer.consume_file(filepath, 'linux-redhat-7', 'x64')
+            self.assertTrue(createrepo_update_mock.called)
+            self.assertTrue(path.islink(path.join(dirpath, 'repodata')))
+            self.assertFalse(path.exists(path.join(dirpath, 'repodata.new')))
+
+    def test_yum_signs_before_the_pretty_copy_is_linked(self):
+        from infi.app_repo import service, utils
+        from infi.app_repo.indexers.wget import PrettyIndexer
+        from infi.app_repo.indexers.yum import YumIndexer
+        from infi.app_repo.utils import find_files
+        from os import rename, stat
+        sign_rpm_package = utils.sign_rpm_package  # patch_all replaces it
+
+        def rpm_addsign(filepath):  # like rpm, writes the signed package aside and renames it over the original
+            with fopen(filepath + '.tmp', 'w') as fd:
+                fd.write('signed')
+            rename(filepath + '.tmp', filepath)
+
+        with self._setup_context() as config:
+            for indexer in get_indexers(config, 'main-stable'):
+                indexer.initialise()
+            filepath = self.write_new_package_in_incoming_directory(
+                config, package_basename='some-package-1.0-linux-redhat-7-x64', extension='rpm')
+            with patch.object(utils, 'sign_rpm_package', new=sign_rpm_package), \
+                 patch.object(utils, '_rpm_addsign', side_effect=rpm_addsign), \
+                 patch.object(utils, '_copy_file_contents', wraps=utils._copy_file_contents) as copy_file_contents:
+                service.process_filepath_by_name(config, 'main-stable', filepath)
+            self.assertEqual(copy_file_contents.call_count, 1)  # the signed copy is renamed, not copied back
+            yum_filepaths = sorted(find_files(YumIndexer(config, 'main-stable').base_directory, '*.rpm'))
+            pretty_filepaths = sorted(find_files(PrettyIndexer(config, 'main-stable').base_directory, '*.rpm'))
+            self.assertEqual(len(yum_filepaths), 1)
+            self.assertEqual(len(pretty_filepaths), 1)
+            self.assertEqual(stat(filepath).st_nlink, 3)
+            for linked_filepath in yum_filepaths + pretty_filepaths:
+                self.assertEqual(stat(linked_filepath).st_ino, stat(filepath).st_ino)
+                with fopen(linked_filepath) as fd:
+                    self.assertEqual(fd.read(), 'signed')
+
+    def test_yum_sign_repomd_replaces_the_signature(self):
+        from infi.app_repo.indexers import yum
+        with self.temporary_base_directory_context() as tempdir:
+            ensure_directory_exists(path.join(tempdir, 'repodata'))
+            repomd = path.join(tempdir, 'repodata', 'repomd.xml')
+            write_file(repomd, '')
+            write_file(repomd + '.asc', 'old')
+
+            def sign_detached(filepath, signature_filepath):
+                self.assertTrue(path.exists(repomd + '.asc'))  # the previous signature is served meanwhile
+                write_file(signature_filepath, 'new')
+
+            with patch.object(yum.signer, 'sign_detached', side_effect=sign_detached):
+                yum.sign_repomd(tempdir)
+            with fopen(repomd + '.asc') as fd:
+                self.assertEqual(fd.read(), 'new')
+            self.assertFalse(path.exists(repomd + '.asc.tmp'))
+
+    def test_yum_rebuild_index_runs_directories_concurrently(self):
+        from infi.app_repo.indexers import yum
+        from infi.app_repo.errors import IndexRebuildFailed
+        import gevent
+        with self._setup_context() as config:
+            config.rebuild_workers = 4
+            indexer = yum.YumIndexer(config, 'main-stable')
+            indexer.initialise()
+            running, calls = [], []
+
+            def _rebuild_repodata(dirpath, createrepo_workers=1):
+                calls.append((path.basename(dirpath), createrepo_workers, len(running)))
+                running.append(dirpath)
+                gevent.sleep(0.01)
+                running.remove(dirpath)
+                if path.basename(dirpath) == 'linux-redhat-7-x86_64':
+                    raise RuntimeError("createrepo failed")
+
+            with patch.object(indexer, '_rebuild_repodata', side_effect=_rebuild_repodata):
+                with self.assertRaises(IndexRebuildFailed) as context:
+                    indexer.rebuild_index()
+            self.assertIn("linux-redhat-7-x86_64: RuntimeError", str(context.exception))
+            dirpaths = glob(path.join(indexer.base_directory, '*'))
+            self.assertEqual(len(calls), len(dirpaths))
+            self.assertEqual(max(count for _, _, count in calls), 3)  # 4 directories at a time
+            self.assertEqual(set(workers for _, workers, _ in calls), set([1]))
+            progress = indexer.get_rebuild_progress()
+            self.assertEqual(progress['done'], progress['total'])
+            self.assertEqual([name for name, result in progress['directories'].items() if result['error']],
+                             ['linux-redhat-7-x86_64'])
+
+    def test_apt_consume_files(self):
+        from infi.app_repo.indexers import apt
+        from infi.app_repo import signer
+        with self._setup_context() as config:
+            indexer = apt.AptIndexer(config, 'main-stable')
+            indexer.initialise()
+            items = [(self.write_new_package_in_incoming_directory(config, package_basename='package-%s' % i, extension='deb'),
+                      'linux-ubuntu-xenial', arch) for i, arch in enumerate(['x86', 'x86', 'x64'])]
+            apt.apt_ftparchive.reset_mock()
+            signer.gpg.reset_mock()
+            self.assertEqual(indexer.consume_files(items), {})
+            commands = [call[0][0][0] for call in apt.apt_ftparchive.call_args_list]
+            self.assertEqual(sorted(commands), ['packages', 'packages'])
+            self.assertEqual(signer.gpg.call_count, 2)  # one release file for both architectures
+            packages_file = path.join(indexer.base_directory, 'linux-ubuntu', 'dists', 'xenial', 'main', 'binary-i386', 'Packages')
+            with fopen(packages_file) as fd:
+                packages_contents = fd.read()
+            self.assertIn("Filename: dists/xenial/main/binary-i386/package-0.deb", packages_contents)
+            self.assertIn("Filename: dists/xenial/main/binary-i386/package-1.deb", packages_contents)
+
+    def test_apt_release_file(self):
+        from infi.app_repo.indexers import apt
+        from hashlib import sha256
+        with self._setup_context() as config:
+            indexer = apt.AptIndexer(config, 'main-stable')
+            indexer.initialise()
+            filepath = self.write_new_package_in_incoming_directory(config, extension='deb')
+            indexer.consume_file(filepath, 'linux-ubuntu-xenial', 'x86')
+            dirpath = path.join(indexer.base_directory, 'linux-ubuntu', 'dists', 'xenial')
+            with fopen(path.join(dirpath, 'Release')) as fd:
+                release = fd.read()
+            with fopen(path.join(dirpath, 'main', 'binary-i386', 'Packages'), 'rb') as fd:
+                packages = fd.read()
+            self.assertTrue(release.startswith("Codename: xenial\nArchitectures: amd64 i386\nComponents: main\nDate: "))
+            self.assertIn("\nSHA256:\n", release)
+            self.assertIn(" {} {:>16} main/binary-i386/Packages\n".format(sha256(packages).hexdigest(), len(packages)), release)
+            self.assertIn(" main/binary-amd64/Packages.xz\n", release)
+            self.assertNotIn(".deb", release)
+            for basename in ('InRelease', 'Release.gpg'):
+                self.assertTrue(path.exists(path.join(dirpath, basename)))
+                self.assertFalse(path.exists(path.join(dirpath, basename + '.tmp')))
+
+            # only the files of the architecture that changed are rehashed
+            filepath = self.write_new_package_in_incoming_directory(config, package_basename='another-package', extension='deb')
+            with patch.object(apt, '_hash_file', wraps=apt._hash_file) as hash_file:
+                indexer.consume_file(filepath, 'linux-ubuntu-xenial', 'x86')
+            self.assertEqual(sorted(path.basename(call[0][0]) for call in hash_file.call_args_list),
+                             ['Packages', 'Packages.gz', 'Packages.xz'])
+            self.assertTrue(all('binary-i386' in call[0][0] for call in hash_file.call_args_list))
+
+    def test_apt_rebuild_index(self):
+        from infi.app_repo.indexers import apt
+        with self._setup_context() as config:
+            indexer = apt.AptIndexer(config, 'main-stable')
+            indexer.initialise()
+            items = [(self.write_new_package_in_incoming_directory(config, package_basename='package-%s' % i, extension='deb'),
+                      platform, 'x64') for i, platform in enumerate(['linux-ubuntu-xenial', 'linux-ubuntu-focal'])]
+            self.assertEqual(indexer.consume_files(items), {})
+            stale_cache = path.join(indexer.base_directory, 'stanza_cache', 'linux-ubuntu', 'dists', 'gone.msgpack')
+            write_file(stale_cache, '')
+            events = []
+            rebuild_packages_file = indexer._rebuild_packages_file
+            generate_release_file = indexer.generate_release_file_for_specific_distribution_and_version
+
+            def _rebuild_packages_file(distribution_name, codename, arch):
+                events.append(('packages', codename))
+                return rebuild_packages_file(distribution_name, codename, arch)
+
+            def _generate_release_file(distribution_name, codename, force=True):
+                events.append(('release', codename))
+                return generate_release_file(distribution_name, codename, force)
+
+            with patch.object(indexer, '_rebuild_packages_file', _rebuild_packages_file), \
+                 patch.object(indexer, 'generate_release_file_for_specific_distribution_and_version', _generate_release_file):
+                indexer.rebuild_index()
+            for codename, architectures in apt.KNOWN_DISTRIBUTIONS['linux-ubuntu'].items():
+                packages_indexes = [i for i, event in enumerate(events) if event == ('packages', codename)]
+                self.assertEqual(len(packages_indexes), len(architectures))
+                self.assertLess(max(packages_indexes), events.index(('release', codename)))
+            progress = indexer.get_rebuild_progress()
+            self.assertEqual(progress['done'], progress['total'])
+            self.assertFalse(path.exists(stale_cache))
+            packages_file = path.join(indexer.base_directory, 'linux-ubuntu', 'dists', 'focal', 'main', 'binary-amd64', 'Packages')
+            with fopen(packages_file) as fd:
+                self.assertIn("Filename: dists/focal/main/binary-amd64/package-1.deb", fd.read())
+
+    def test_apt_delete_artifact(self):
+        from infi.app_repo.indexers import apt
+        import gzip
+        with self._setup_context() as config:
+            indexer = apt.AptIndexer(config, 'main-stable')
+            indexer.initialise()
+            items = [(self.write_new_package_in_incoming_directory(config, package_basename='package-%s' % i, extension='deb'),
+                      'linux-ubuntu-focal', 'x64') for i in range(2)]
+            self.assertEqual(indexer.consume_files(items), {})
+            dirpath = path.join(indexer.base_directory, 'linux-ubuntu', 'dists', 'focal', 'main', 'binary-amd64')
+            with patch.object(indexer, 'rebuild_index', side_effect=AssertionError("should not rebuild")), \
+                 patch.object(indexer, 'generate_release_file_for_specific_distribution_and_version') as generate_release_file:
+                self.assertTrue(indexer.delete_artifact(path.join(dirpath, 'package-0.deb')))
+            generate_release_file.assert_called_once_with('linux-ubuntu', 'focal')
+            self.assertFalse(path.exists(path.join(dirpath, 'package-0.deb')))
+            with fopen(path.join(dirpath, 'Packages')) as fd:
+                packages = fd.read()
+            self.assertNotIn("package-0.deb", packages)
+            self.assertIn("Filename: dists/focal/main/binary-amd64/package-1.deb", packages)
+            self.assertEqual(packages.count("Filename: "), 1)
+            with gzip.open(path.join(dirpath, 'Packages.gz'), 'rb') as fd:
+                self.assertEqual(fd.read().decode(), packages)
+            # a deb without a stanza leaves the index to be rebuilt
+            with patch.object(indexer, 'generate_release_file_for_specific_distribution_and_version') as generate_release_file:
+                self.assertFalse(indexer.delete_artifact(path.join(dirpath, 'package-0.deb')))
+            self.assertFalse(generate_release_file.called)
+
+    def test_apt_pool_layout(self):
+        from infi.app_repo.indexers import apt
+        from infi.app_repo.errors import IndexRebuildFailed
+        with self._setup_context() as config:
+            config.apt_pool_layout = True
+            indexer = apt.AptIndexer(config, 'main-stable')
+            indexer.initialise()
+            # the packages are empty files, so they are content-identical
+            items = [(self.write_new_package_in_incoming_directory(config, package_basename='package-%s' % codename, extension='deb'),
+                      'linux-ubuntu-%s' % codename, 'x64') for codename in ('xenial', 'focal')]
+            with patch("infi.app_repo.utils.sign_deb_package") as sign_deb_package:
+                self.assertEqual(indexer.consume_files(items), {})
+            pool_filepath = path.join(indexer.base_directory, 'linux-ubuntu', 'pool', 'main', 'p', 'package-xenial.deb')
+            sign_deb_package.assert_called_once_with(pool_filepath)
+            # the pool is shared by the codenames, so are the lock and the pool index
+            self.assertEqual(set(indexer.get_lock_target(filepath, platform, arch) for filepath, platform, arch in items),
+                             set(['linux-ubuntu']))
+            self.assertTrue(path.exists(path.join(indexer.base_directory, 'linux-ubuntu', 'pool_index.msgpack')))
+            self.assertEqual(len(list(indexer.iter_files())), 2)
+            for codename in ('xenial', 'focal'):
+                dirpath = path.join(indexer.base_directory, 'linux-ubuntu', 'dists', codename, 'main', 'binary-amd64')
+                self.assertTrue(path.samefile(path.join(dirpath, 'package-%s.deb' % codename), pool_filepath))
+                with fopen(path.join(dirpath, 'Packages')) as fd:
+                    self.assertIn("Filename: pool/main/p/package-xenial.deb", fd.read())
+
+            focal_filepath = path.join(indexer.base_directory, 'linux-ubuntu', 'dists', 'focal', 'main', 'binary-amd64',
+                                       'package-focal.deb')
+            self.assertTrue(indexer.delete_artifact(focal_filepath))
+            self.assertTrue(path.exists(pool_filepath))
+            indexer.rebuild_index()
+            xenial_dirpath = path.join(indexer.base_directory, 'linux-ubuntu', 'dists', 'xenial', 'main', 'binary-amd64')
+            with fopen(path.join(xenial_dirpath, 'Packages')) as fd:
+                packages = fd.read()
+            self.assertIn("Filename: pool/main/p/package-xenial.deb", packages)
+            # a stanza written before the pool layout was turned on lists the deb in its binary directory
+            apt.write_to_packages_file(xenial_dirpath, packages.replace(
+                "Filename: pool/main/p/package-xenial.deb", "Filename: dists/xenial/main/binary-amd64/package-xenial.deb"), 'w')
+            self.assertTrue(indexer.delete_artifact(path.join(xenial_dirpath, 'package-xenial.deb')))
+            with fopen(path.join(xenial_dirpath, 'Packages')) as fd:
+                self.assertNotIn("package-xenial.deb", fd.read())
+            self.assertFalse(path.exists(pool_filepath))
+
+            config.apt_rebuild_mode = 'apt-ftparchive-generate'
+            with self.assertRaises(IndexRebuildFailed):
+                indexer.rebuild_index()
+
+    def test_apt_pool_layout_signs_the_pretty_copy(self):
+        from infi.app_repo import service
+        from infi.app_repo.indexers.wget import PrettyIndexer
+        from infi.app_repo.utils import find_files
+
+        def sign_deb_package(filepath):  # in place, like dpkg-sig
+            with fopen(filepath, 'a') as fd:
+                fd.write('signed')
+
+        with self._setup_context() as config:
+            config.apt_pool_layout = True
+            for indexer in get_indexers(config, 'main-stable'):
+                indexer.initialise()
+            # the packages are empty files, so the one to focal is already in the pool when it is ingested
+            with patch("infi.app_repo.utils.sign_deb_package", side_effect=sign_deb_package) as sign:
+                for codename in ('xenial', 'focal'):
+                    filepath = self.write_new_package_in_incoming_directory(
+                        config, package_basename='some-package-1.0-linux-ubuntu-%s-x64' % codename, extension='deb')
+                    service.process_filepath_by_name(config, 'main-stable', filepath)
+            self.assertEqual(sign.call_count, 1)
+            pretty_filepaths = sorted(find_files(PrettyIndexer(config, 'main-stable').base_directory, '*.deb'))
+            self.assertEqual(len(pretty_filepaths), 2)
+            for filepath in pretty_filepaths:
+                with fopen(filepath) as fd:
+                    self.assertEqual(fd.read(), 'signed')
+
+    def test_apt_rebuild_index_with_apt_ftparchive_generate(self):
+        from infi.app_repo.indexers import apt
+        with self._setup_context() as config:
+            config.apt_rebuild_mode = 'apt-ftparchive-generate'
+            indexer = apt.AptIndexer(config, 'main-stable')
+            indexer.initialise()
+            filepath = self.write_new_package_in_incoming_directory(config, extension='deb')
+            indexer.consume_file(filepath, 'linux-ubuntu-focal', 'x64')
+            stale_cache = path.join(indexer.base_directory, 'stanza_cache', 'linux-ubuntu', 'dists', 'gone.msgpack')
+            write_file(stale_cache, '')
+            apt.apt_ftparchive.reset_mock()
+            with patch.object(indexer, '_rebuild_packages_file', side_effect=AssertionError("should not be called")), \
+                 patch.object(indexer, '_prune_stanza_caches', wraps=indexer._prune_stanza_caches) as prune_stanza_caches:
+                indexer.rebuild_index()
+            dirpath = indexer.deduce_dirname('linux-ubuntu', 'focal', 'x64')
+            prune_stanza_caches.assert_called_once_with(set([path.join(dirpath, path.basename(filepath))]))
+            self.assertFalse(path.exists(stale_cache))
+            self.assertEqual(apt.apt_ftparchive.call_count, len(apt.KNOWN_DISTRIBUTIONS))
+            config_filepath = path.join(indexer.base_directory, 'linux-ubuntu', 'apt-ftparchive.conf')
+            apt.apt_ftparchive.assert_called_with(['generate', config_filepath])
+            with fopen(config_filepath) as fd:
+                contents = fd.read()
+            self.assertIn('ArchiveDir "{}";'.format(path.join(indexer.base_directory, 'linux-ubuntu')), contents)
+            self.assertIn('BinDirectory "dists/xenial/main/binary-i386" { Packages "dists/xenial/main/binary-i386/Packages"; '
+                          'Contents "dists/xenial/main/Contents-i386"; BinCacheDB "apt_cache.db"; };', contents)
+            self.assertEqual(contents.count('BinDirectory'), 7)
+            progress = indexer.get_rebuild_progress()
+            self.assertEqual(progress['done'], progress['total'])
+
     def test_wget_consume_file(self):
         from infi.app_repo.indexers.wget import PrettyIndexer
         with self._setup_context() as config:
@@ -88,6 +497,109 @@ class IndexersTestCase(TestCase):
             self.assertIsInstance(packages, list)
             self.assertGreater(len(packages), 0)
 
+    def test_wget_consume_file_updates_only_the_consumed_package(self):
+        from infi.app_repo.indexers.wget import PrettyIndexer
+        from infi.app_repo.utils import ensure_directory_exists, write_file
+        with self._setup_context() as config:
+            indexer = PrettyIndexer(config, 'main-stable')
+            indexer.initialise()
+            filepath = self.write_new_package_in_incoming_directory(config, package_basename='my-app-0.1-linux-ubuntu-xenial-x64', extension='deb')
+            indexer.consume_file(filepath, 'linux-ubuntu-xenial', 'x64')
+            # a package that was added behind the indexer's back is picked up only by a full rebuild
+            other_dirpath = path.join(indexer.base_directory, 'packages', 'other-app', 'releases', '1.0', 'distributions',
+                                      'windows', 'architectures', 'x64', 'extensions', 'msi')
+            ensure_directory_exists(other_dirpath)
+            write_file(path.join(other_dirpath, 'other-app-1.0-windows-x64.msi'), '')
+
+            filepath = self.write_new_package_in_incoming_directory(config, package_basename='my-app-0.2-linux-ubuntu-xenial-x64', extension='deb')
+            indexer.consume_files([(filepath, 'linux-ubuntu-xenial', 'x64')])
+            packages = read_json_file(path.join(indexer.base_directory, 'packages.json'))
+            self.assertEqual([package['name'] for package in packages], ['my-app'])
+            self.assertEqual(packages[0]['latest_version'], '0.2')
+            releases = read_json_file(path.join(indexer.base_directory, 'packages', 'my-app', 'releases.json'))
+            self.assertEqual([release['version'] for release in releases], ['0.2', '0.1'])
+            with fopen(path.join(indexer.base_directory, 'packages', 'my-app', 'latest_release.txt')) as fd:
+                self.assertEqual(fd.read(), '0.2')
+
+            indexer.rebuild_index()
+            packages = read_json_file(path.join(indexer.base_directory, 'packages.json'))
+            self.assertEqual([package['name'] for package in packages], ['my-app', 'other-app'])
+
+    def test_wget_catalog(self):
+        from infi.app_repo.indexers.wget import PrettyIndexer
+        from infi.app_repo.utils import write_file, remove
+        with self._setup_context() as config:
+            indexer = PrettyIndexer(config, 'main-stable')
+            indexer.initialise()
+            for version in ('0.1', '0.2'):
+                filepath = self.write_new_package_in_incoming_directory(config, package_basename='my-app-{}-linux-ubuntu-xenial-x64'.format(version), extension='deb')
+                indexer.consume_file(filepath, 'linux-ubuntu-xenial', 'x64')
+            release_dirpath = path.join(indexer.base_directory, 'packages', 'my-app', 'releases', '0.2')
+            filepath = path.join(release_dirpath, 'distributions', 'linux-ubuntu-xenial', 'architectures', 'x64',
+                                 'extensions', 'deb', 'my-app-0.2-linux-ubuntu-xenial-x64.deb')
+            self.assertEqual(sorted(PrettyIndexer(config, 'main-stable').iter_files()),
+                             [filepath.replace('0.2', '0.1'), filepath])
+
+            self.assertTrue(indexer.delete_artifact(filepath))
+            self.assertFalse(path.exists(filepath))
+            self.assertEqual(list(indexer.iter_files()), [filepath.replace('0.2', '0.1')])
+            releases = read_json_file(path.join(indexer.base_directory, 'packages', 'my-app', 'releases.json'))
+            self.assertEqual([release['version'] for release in releases], ['0.1'])
+
+            # changes made by hand are picked up by reconcile
+            self.assertEqual(indexer.reconcile(), [])
+            write_file(path.join(indexer.base_directory, 'packages', 'my-app', 'releases', '0.1', 'hidden'), '')
+            other_dirpath = path.join(indexer.base_directory, 'packages', 'other-app', 'releases', '1.0', 'distributions',
+                                      'windows', 'architectures', 'x64', 'extensions', 'msi')
+            ensure_directory_exists(other_dirpath)
+            write_file(path.join(other_dirpath, 'other-app-1.0-windows-x64.msi'), '')
+            self.assertEqual(indexer.reconcile(), ['my-app', 'other-app'])
+            packages = read_json_file(path.join(indexer.base_directory, 'packages.json'))
+            self.assertEqual([package['name'] for package in packages], ['my-app', 'other-app'])
+            releases = read_json_file(path.join(indexer.base_directory, 'packages', 'my-app', 'releases.json'))
+            self.assertTrue(releases[0]['hidden'])
+
+            # an index that was built before it had a catalog gets one from the disk
+            for suffix in ('', '-wal', '-shm'):
+                if path.exists(path.join(indexer.base_directory, 'catalog.sqlite' + suffix)):
+                    remove(path.join(indexer.base_directory, 'catalog.sqlite' + suffix))
+            self.assertEqual(len(list(PrettyIndexer(config, 'main-stable').iter_files())), 2)
+
+            # the release and the package leave the catalog with their last distribution
+            self.assertTrue(indexer.delete_artifact(filepath.replace('0.2', '0.1')))
+            catalog = PrettyIndexer(config, 'main-stable')._get_catalog()
+            self.assertEqual([package['name'] for package in catalog.get_packages()], ['other-app'])
+            self.assertEqual(catalog.get_releases('my-app'), [])
+            self.assertEqual(indexer.reconcile(), [])
+
+    def test_wget_rebuild_index_walks_the_tree_once(self):
+        from infi.app_repo.indexers.wget import PrettyIndexer
+        from infi.app_repo.utils import write_file
+        with self._setup_context() as config:
+            indexer = PrettyIndexer(config, 'main-stable')
+            indexer.initialise()
+            release_dirpath = path.join(indexer.base_directory, 'packages', 'my-app', 'releases', '1.0')
+            arch_dirpath = path.join(release_dirpath, 'distributions', 'windows', 'architectures', 'x64')
+            for arch in ('x64', 'x86'):
+                dirpath = path.join(arch_dirpath.replace('x64', arch), 'extensions', 'msi')
+                ensure_directory_exists(dirpath)
+                write_file(path.join(dirpath, 'my-app-1.0-windows-{}.msi'.format(arch)), 'msi')
+            write_file(path.join(arch_dirpath, 'hidden'), '')
+            write_file(path.join(indexer.base_directory, 'packages', 'my-app', 'product_name'), 'My Application')
+            write_file(path.join(release_dirpath, 'release_date'), '2020-01-02')
+            empty_dirpath = path.join(indexer.base_directory, 'packages', 'empty-app', 'releases', '1.0', 'distributions')
+            ensure_directory_exists(empty_dirpath)
+
+            indexer.rebuild_index()
+            self.assertFalse(path.exists(path.join(indexer.base_directory, 'packages', 'empty-app')))
+            packages = read_json_file(path.join(indexer.base_directory, 'packages.json'))
+            self.assertEqual([(package['name'], package['product_name']) for package in packages], [('my-app', 'My Application')])
+            [release] = read_json_file(path.join(indexer.base_directory, 'packages', 'my-app', 'releases.json'))
+            self.assertEqual(release['release_date'], '2020-01-02')
+            self.assertEqual([(distribution['architecture'], distribution['hidden'], distribution['filesize'])
+                              for distribution in release['distributions']], [('x64', True, 3), ('x86', False, 3)])
+            self.assertEqual(indexer.reconcile(), [])
+
     def test_wget_consumes_ova(self):
         from infi.app_repo.indexers.wget import PrettyIndexer
         with self._setup_context() as config:
@@ -117,3 +629,150 @@ class IndexersTestCase(TestCase):
             indexer.consume_file(filepath, 'linux-oracle-7', 'x64')
             print(filepath)
             self.assertTrue(path.exists(path.join(indexer.base_directory, 'python-v2.7.8.13-linux-oracle-7-x64.tar.gz')))
+
+
+class PackagesFileTestCase(TestCase):
+    STANZA = "Package: package-{0}\nVersion: 1.0\nArchitecture: amd64\nFilename: dists/focal/main/binary-amd64/package-{0}.deb\n" \
+             "Size: 1000\nSHA256: {1}\nDescription: some package\n\n"
+
+    def _read_compressed_files(self, dirpath):
+        import gzip
+        import lzma
+        with gzip.open(path.join(dirpath, 'Packages.gz'), 'rb') as fd:
+            gz_contents = fd.read().decode()
+        with lzma.open(path.join(dirpath, 'Packages.xz'), 'rb') as fd:
+            xz_contents = fd.read().decode()
+        return gz_contents, xz_contents
+
+    def test_appends_and_compaction(self):
+        from infi.app_repo.indexers import apt
+        with self.temporary_base_directory_context() as tempdir:
+            apt.write_to_packages_file(tempdir, '', 'w')
+            expected = ''
+            for index in range(apt.COMPACTION_INTERVAL + 1):
+                stanza = self.STANZA.format(index, '0' * 64)
+                apt.write_to_packages_file(tempdir, stanza, 'a')
+                expected += stanza
+                if index in (0, apt.COMPACTION_INTERVAL - 2, apt.COMPACTION_INTERVAL - 1):
+                    self.assertEqual(self._read_compressed_files(tempdir), (expected, expected))
+            self.assertEqual(self._read_compressed_files(tempdir), (expected, expected))
+            with fopen(path.join(tempdir, 'Packages')) as fd:
+                self.assertEqual(fd.read(), expected)
+
+    def test_append_writes_only_the_new_members(self):
+        import gzip
+        import lzma
+        from infi.app_repo.indexers import apt
+
+        def read_compressed_files(dirpath):
+            with fopen(path.join(dirpath, 'Packages.gz'), 'rb') as gz_fd:
+                with fopen(path.join(dirpath, 'Packages.xz'), 'rb') as xz_fd:
+                    return gz_fd.read(), xz_fd.read()
+
+        with self.temporary_base_directory_context() as tempdir:
+            contents = ''.join(self.STANZA.format(index, '%064x' % index) for index in range(4999))
+            apt.write_to_packages_file(tempdir, contents, 'w')
+            before = read_compressed_files(tempdir)
+            stanza = self.STANZA.format(4999, '0' * 64)
+            apt.write_to_packages_file(tempdir, stanza, 'a')
+            after = read_compressed_files(tempdir)
+        # the 4999 existing stanzas are left as they are, the 5000th is written as a member of its own
+        for previous, current, decompress in zip(before, after, (gzip.decompress, lzma.decompress)):
+            self.assertEqual(current[:len(previous)], previous)
+            self.assertEqual(decompress(current[len(previous):]), stanza.encode())
+
+
+class AptFtparchiveGenerateBenchmarkTestCase(TestCase):
+    PACKAGES = 2000
+
+    def _build_deb(self, dirpath):
+        from infi.app_repo.utils import write_file, log_execute_assert_success
+        source = path.join(dirpath, 'source')
+        ensure_directory_exists(path.join(source, 'DEBIAN'))
+        write_file(path.join(source, 'DEBIAN', 'control'),
+                   "Package: hello\nVersion: 1.0\nArchitecture: amd64\nMaintainer: Infinidat\nDescription: hello\n")
+        filepath = path.join(dirpath, 'hello.deb')
+        log_execute_assert_success(['dpkg-deb', '--root-owner-group', '--build', source, filepath])
+        return filepath
+
+    def _read_filenames(self, indexer):
+        filenames = []
+        for filepath in indexer.iter_files():
+            with fopen(path.join(path.dirname(filepath), 'Packages')) as fd:
+                filenames.extend(line for line in fd.read().splitlines() if line.startswith('Filename: '))
+            break
+        return sorted(set(filenames))
+
+    def test_benchmark_native_versus_apt_ftparchive_generate(self):
+        from infi.app_repo import signer
+        from infi.app_repo.indexers import apt
+        from infi.app_repo.mock import gpg_side_effect
+        from distutils.spawn import find_executable
+        from shutil import copyfile
+        from time import time
+        if not find_executable('apt-ftparchive'):
+            self.skipTest("apt-ftparchive is not installed")
+        with self.temporary_base_directory_context() as tempdir, patch.object(signer, 'gpg', side_effect=gpg_side_effect):
+            config = Configuration.from_disk(None)
+            indexer = apt.AptIndexer(config, 'main-stable')
+            indexer.initialise()
+            source = self._build_deb(tempdir)
+            dirpaths = [indexer.deduce_dirname('linux-ubuntu', codename, arch)
+                        for codename, architectures in apt.KNOWN_DISTRIBUTIONS['linux-ubuntu'].items()
+                        for arch in architectures]
+            for index in range(self.PACKAGES):
+                copyfile(source, path.join(dirpaths[index % len(dirpaths)], 'hello-%s.deb' % index))
+            timings = dict()
+            filenames = dict()
+            for mode in ('native', 'apt-ftparchive-generate'):
+                config.apt_rebuild_mode = mode
+                start = time()
+                indexer.rebuild_index()
+                timings[mode] = time() - start
+                filenames[mode] = self._read_filenames(indexer)
+        print("rebuilding {} packages: native {:.3f}s, apt-ftparchive generate {:.3f}s".format(
+              self.PACKAGES, timings['native'], timings['apt-ftparchive-generate']))
+        self.assertEqual(filenames['native'], filenames['apt-ftparchive-generate'])
+
+
+class PrettyIndexerBenchmarkTestCase(TestCase):
+    PACKAGES, RELEASES = 250, 40
+    DISTRIBUTIONS = [('linux-redhat-7', 'x64', 'rpm'), ('linux-redhat-8', 'x64', 'rpm'),
+                     ('linux-ubuntu-xenial', 'x64', 'deb'), ('windows', 'x64', 'msi'), ('windows', 'x86', 'msi')]
+
+    def _build_tree(self, base_directory):
+        from os import makedirs
+        for package_index in range(self.PACKAGES):
+            package_name = 'package-{}'.format(package_index)
+            for release_index in range(self.RELEASES):
+                version = '1.{}'.format(release_index)
+                for platform, arch, extension in self.DISTRIBUTIONS:
+                    dirpath = path.join(base_directory, 'packages', package_name, 'releases', version, 'distributions',
+                                        platform, 'architectures', arch, 'extensions', extension)
+                    makedirs(dirpath)
+                    with open(path.join(dirpath, '{}-{}-{}-{}.{}'.format(package_name, version, platform, arch, extension)), 'w') as fd:
+                        fd.write(package_name)
+            # directories that the rebuild removes
+            makedirs(path.join(base_directory, 'packages', package_name, 'releases', '0.1', 'distributions'))
+        return self.PACKAGES * self.RELEASES * len(self.DISTRIBUTIONS)
+
+    def setUp(self):
+        from os import environ
+        if not environ.get('APP_REPO_BENCHMARKS'):
+            self.skipTest("set APP_REPO_BENCHMARKS=1 to run the benchmarks")
+
+    def test_rebuild_index_of_50k_artifacts(self):
+        from infi.app_repo.indexers.wget import PrettyIndexer, walk_packages
+        with self.temporary_base_directory_context():
+            config = Configuration.from_disk(None)
+            indexer = PrettyIndexer(config, 'main-stable')
+            indexer.initialise()
+            artifacts = self._build_tree(indexer.base_directory)
+            indexer.rebuild_index()
+            packages, releases, distributions = walk_packages(indexer.base_directory)
+            self.assertEqual((len(packages), len(releases), len(distributions)),
+                             (self.PACKAGES, self.PACKAGES * self.RELEASES, artifacts))
+            self.assertEqual(len(list(indexer.iter_files())), artifacts)
+            for package_index in range(self.PACKAGES):
+                self.assertFalse(path.exists(path.join(indexer.base_directory, 'packages', 'package-{}'.format(package_index),
+                                                       'releases', '0.1')))
@@ -0,0 +1,93 @@
+from .test_case import TemporaryBaseDirectoryTestCase
+from infi.app_repo.ingest_queue import IngestQueue, PENDING, RUNNING, DONE, REJECTED
+from infi.app_repo.persistent_dict import PersistentDict
+from infi.app_repo.utils import path, write_file
+
+
+class IngestQueueTestCase(TemporaryBaseDirectoryTestCase):
+    def setUp(self):
+        super(IngestQueueTestCase, self).setUp()
+        from infi.app_repo.config import Configuration
+        self.journal = path.join(Configuration().base_directory, 'queue.msgpack')
+        self.processed = []
+
+    def _process(self, index, filepath):
+        self.processed.append((index, path.basename(filepath)))
+        return 'bad' not in filepath
+
+    def _write_file(self, basename):
+        filepath = path.join(path.dirname(self.journal), basename)
+        write_file(filepath, '')
+        return filepath
+
+    def test_submit_returns_immediately_and_processes_in_order(self):
+        queue = IngestQueue(self.journal, self._process)
+        job_ids = [queue.submit('main-stable', self._write_file('a'))]
+        self.assertEqual(self.processed, [])
+        self.assertEqual(queue.get_job(job_ids[0])['status'], PENDING)
+        job_ids += [queue.submit('main-stable', self._write_file(basename)) for basename in ('bad', 'c')]
+        self.assertEqual(job_ids, sorted(job_ids))
+        queue.join()
+        self.assertEqual(self.processed, [('main-stable', 'a'), ('main-stable', 'bad'), ('main-stable', 'c')])
+        self.assertEqual([job['status'] for job in queue.list_jobs()], [DONE, REJECTED, DONE])
+        self.assertEqual(queue.list_jobs(status=REJECTED)[0]['job_id'], job_ids[1])
+        self.assertEqual(queue.list_jobs(index='other'), [])
+
+    def test_missing_file_is_rejected(self):
+        queue = IngestQueue(self.journal, self._process)
+        job_id = queue.submit('main-stable', path.join(path.dirname(self.journal), 'missing'))
+        queue.join()
+        self.assertEqual(queue.get_job(job_id)['status'], REJECTED)
+        self.assertEqual(self.processed, [])
+
+    def test_pending_jobs_resume_after_restart(self):
+        queue = IngestQueue(self.journal, self._process)
+        queue._ensure_worker = lambda index: None  # simulate going down before the worker got to run
+        for basename in ('a', 'b'):
+            queue.submit('main-stable', self._write_file(basename))
+        first_job_id = queue.list_jobs()[0]['job_id']
+        queue._update_job(first_job_id, status=RUNNING)
+
+        journal = PersistentDict(self.journal)
+        journal.load()
+        self.assertEqual(len(journal), 2)
+
+        queue = IngestQueue(self.journal, self._process)
+        queue.join()
+        self.assertEqual(self.processed, [('main-stable', 'a'), ('main-stable', 'b')])
+        self.assertEqual([job['status'] for job in queue.list_jobs()], [DONE, DONE])
+        self.assertGreater(queue.submit('main-stable', self._write_file('c')), first_job_id)
+        queue.join()
+
+    def test_indexes_are_processed_concurrently(self):
+        from gevent import sleep
+
+        def process(index, filepath):
+            self.processed.append(('start', index, path.basename(filepath)))
+            sleep(0.02)
+            self.processed.append(('end', index, path.basename(filepath)))
+            return True
+
+        queue = IngestQueue(self.journal, process)
+        for index, basename in (('main-stable', 'a'), ('main-unstable', 'b'), ('main-stable', 'c')):
+            queue.submit(index, self._write_file(basename))
+        queue.join()
+        self.assertEqual(self.processed[:2], [('start', 'main-stable', 'a'), ('start', 'main-unstable', 'b')])
+        stable = [item for item in self.processed if item[1] == 'main-stable']
+        self.assertEqual(stable, [('start', 'main-stable', 'a'), ('end', 'main-stable', 'a'),
+                                  ('start', 'main-stable', 'c'), ('end', 'main-stable', 'c')])
+
+    def test_unreadable_journal_is_moved_aside(self):
+        from infi.app_repo.utils import fopen
+        from msgpack import packb
+        with fopen(self.journal, 'wb') as fd:
+            fd.write(packb(dict(job=dict(status=PENDING)))[:-3])  # torn by a crash in the middle of a write
+        queue = IngestQueue(self.journal, self._process)
+        self.assertEqual(queue.list_jobs(), [])
+        self.assertTrue(path.exists(self.journal + '.corrupt'))
+        queue.submit('main-stable', self._write_file('a'))
+        queue.join()
+        self.assertEqual(self.processed, [('main-stable', 'a')])
+        journal = PersistentDict(self.journal)
+        journal.load()
+        self.assertEqual(len(journal), 1)
@@ -0,0 +1,44 @@
+from .test_case import TestCase
+from infi.app_repo.locks import LockHierarchy
+from gevent import spawn, sleep
+
+
+class LockHierarchyTestCase(TestCase):
+    def _hold(self, locks, key, events, name, mode='exclusive'):
+        with getattr(locks, mode)(key):
+            events.append(name)
+            sleep(0.05)
+
+    def _run_while_holding(self, held_key, other_key, held_mode='exclusive', other_mode='exclusive'):
+        locks = LockHierarchy()
+        events = []
+        with getattr(locks, held_mode)(held_key):
+            greenlet = spawn(self._hold, locks, other_key, events, 'other', other_mode)
+            sleep(0.01)
+            events.append('holder')
+        greenlet.join()
+        return events
+
+    def test_siblings_do_not_block_each_other(self):
+        self.assertEqual(self._run_while_holding(('main', 'apt', 'linux-ubuntu-xenial'), ('main', 'apt', 'linux-ubuntu-focal')),
+                         ['other', 'holder'])
+        self.assertEqual(self._run_while_holding(('main', 'apt'), ('other', 'apt')), ['other', 'holder'])
+
+    def test_ancestors_and_descendants_block_each_other(self):
+        self.assertEqual(self._run_while_holding(('main', 'apt'), ('main', 'apt', 'linux-ubuntu-xenial')), ['holder', 'other'])
+        self.assertEqual(self._run_while_holding(('main', 'apt', 'linux-ubuntu-xenial'), ('main', 'apt')), ['holder', 'other'])
+        self.assertEqual(self._run_while_holding(('main', 'yum'), ()), ['holder', 'other'])
+
+    def test_shared_keys(self):
+        xenial = ('main', 'apt', 'linux-ubuntu-xenial')
+        self.assertEqual(self._run_while_holding(xenial, ('main', 'apt'), other_mode='shared'), ['other', 'holder'])
+        self.assertEqual(self._run_while_holding(('main', 'apt'), xenial, held_mode='shared'), ['other', 'holder'])
+        self.assertEqual(self._run_while_holding(('main', 'apt'), ('main', 'apt'), other_mode='shared'), ['holder', 'other'])
+        self.assertEqual(self._run_while_holding(('main', 'apt'), ('main', 'apt'), held_mode='shared'), ['holder', 'other'])
+
+    def test_several_keys_at_once(self):
+        locks = LockHierarchy()
+        with locks.exclusive(('main', 'apt', 'linux-ubuntu-xenial'), ('main', 'index')):
+            pass
+        with locks.exclusive(('main', 'apt'), ('main', 'apt', 'linux-ubuntu-xenial')):
+            pass
@@ -0,0 +1,86 @@
+from .test_case import TestCase
+from infi.app_repo import metrics, service
+from infi.app_repo.config import Configuration
+from infi.app_repo.install import ensure_incoming_and_rejected_directories_exist_for_all_indexers
+from infi.app_repo.utils import log_execute_assert_success
+from infi.app_repo.indexers.base import Indexer
+from mock import patch
+
+
+class StagedIndexer(Indexer):
+    INDEX_TYPE = 'staged'
+
+    def are_you_interested_in_file(self, filepath, platform, arch):
+        return True
+
+    def consume_file(self, filepath, platform, arch):
+        with metrics.stage('sign'):
+            pass
+
+
+class IngestMetricsTestCase(TestCase):
+    def test_stages_are_recorded_per_index_and_index_type(self):
+        ingest_metrics = metrics.IngestMetrics()
+        with ingest_metrics.ingest('main-stable', ['a.rpm']):
+            with ingest_metrics.stage('parse'):
+                pass
+            with ingest_metrics.stage('consume', 'yum'):
+                with ingest_metrics.stage('createrepo'):
+                    pass
+        with ingest_metrics.stage('createrepo'):
+            pass  # not in an ingest
+        self.assertEqual(sorted(ingest_metrics.histograms),
+                         [('main-stable', '', 'parse'), ('main-stable', '', 'total'),
+                          ('main-stable', 'yum', 'consume'), ('main-stable', 'yum', 'createrepo')])
+        self.assertEqual(ingest_metrics.histograms[('main-stable', 'yum', 'createrepo')].count, 1)
+        self.assertEqual(ingest_metrics.to_dict()['slow_ingests'], [])
+
+    def test_slow_ingests_are_kept_in_a_ring_buffer(self):
+        with patch.object(metrics, 'SLOW_INGEST_THRESHOLD', 0), patch.object(metrics, 'MAX_SLOW_INGESTS', 2):
+            ingest_metrics = metrics.IngestMetrics()
+            for filepath in ['a.rpm', 'b.rpm', 'c.rpm']:
+                with ingest_metrics.ingest('main-stable', [filepath]):
+                    with ingest_metrics.stage('consume', 'yum'):
+                        pass
+        slow_ingests = ingest_metrics.to_dict()['slow_ingests']
+        self.assertEqual([ingest['filepaths'] for ingest in slow_ingests], [['b.rpm'], ['c.rpm']])
+        self.assertEqual([(stage['index_type'], stage['name']) for stage in slow_ingests[0]['stages']],
+                         [('yum', 'consume')])
+
+    def test_format_metrics(self):
+        histogram = metrics.Histogram()
+        histogram.observe(0.02)
+        histogram.observe(1000)
+        text = metrics.format_metrics(dict(histograms=[dict(index='main-stable', index_type='yum', stage='createrepo',
+                                                            **histogram.to_dict())],
+                                           slow_ingests=[]))
+        labels = 'index="main-stable",index_type="yum",stage="createrepo"'
+        self.assertIn('app_repo_ingest_stage_seconds_bucket{%s,le="0.01"} 0' % labels, text)
+        self.assertIn('app_repo_ingest_stage_seconds_bucket{%s,le="0.05"} 1' % labels, text)
+        self.assertIn('app_repo_ingest_stage_seconds_bucket{%s,le="+Inf"} 2' % labels, text)
+        self.assertIn('app_repo_ingest_stage_seconds_count{%s} 2' % labels, text)
+
+    def test_process_filepath_by_name(self):
+        with self.temporary_base_directory_context():
+            config = Configuration.from_disk(None)
+            ensure_incoming_and_rejected_directories_exist_for_all_indexers(config)
+            filepath = self.write_new_package_in_incoming_directory(config, package_basename='some-package-1.0-linux-redhat-7-x64', extension='rpm')
+            indexer = StagedIndexer(config, 'main-stable')
+            config.get_indexers = lambda name: [indexer]
+            with patch.object(service, 'ingest_metrics', metrics.IngestMetrics()) as ingest_metrics, \
+                 patch.object(metrics, 'stage', ingest_metrics.stage), patch.object(service, 'stage', ingest_metrics.stage):
+                service.process_filepath_by_name(config, 'main-stable', filepath)
+            self.assertEqual(sorted(key[1:] for key in ingest_metrics.histograms),
+                             [('', 'parse'), ('', 'total'), ('staged', 'consume'), ('staged', 'sign')])
+
+
+class MetricsEndpointTestCase(TestCase):
+    def test_metrics_endpoint(self):
+        with self.temporary_base_directory_context():
+            config = self._get_config_for_test()
+            with self.rpc_server_context(config), self.web_server_context(config):
+                with metrics.ingest_metrics.ingest('main-stable', ['a.rpm']):
+                    pass
+                url = "http://127.0.0.1:{}/metrics".format(config.webserver.port)
+                text = log_execute_assert_success(["curl", "--fail", url]).get_stdout().decode()
+            self.assertIn('app_repo_ingest_stage_seconds_count{index="main-stable",index_type="",stage="total"}', text)
@@ -0,0 +1,83 @@
+from .test_case import TestCase
+from infi.app_repo import resign
+from infi.app_repo.config import Configuration
+from infi.app_repo.errors import ResignFailed
+from infi.app_repo.utils import path, ensure_directory_exists, hard_link_or_raise_exception
+from .test_rpm import build_rpm
+from mock import patch
+
+
+class ResignJobTestCase(TestCase):
+    def _build_packages(self, config):
+        filepaths = []
+        for index in config.indexes:
+            dirpath = path.join(config.packages_directory, index, 'yum', 'linux-redhat-7-x86_64')
+            ensure_directory_exists(dirpath)
+            for name in ('a', 'b', 'c'):
+                filepaths.append(path.join(dirpath, '{}.rpm'.format(name)))
+                build_rpm(filepaths[-1])
+        return filepaths
+
+    def test_interrupted_job_resumes(self):
+        with self.temporary_base_directory_context() as tempdir:
+            config = Configuration.from_disk(None)
+            config.resign_workers = 2
+            filepaths = self._build_packages(config)
+            failing = filepaths[1]
+            with patch.object(resign, 'sign_rpm_package', side_effect=lambda filepath: filepath == failing and 1 / 0), \
+                 patch.object(resign.path, 'expanduser', return_value=tempdir):
+                job = resign.ResignJob(config)
+                with self.assertRaises(ResignFailed):
+                    job.run()
+            self.assertTrue(resign.ResignJob(config).is_interrupted())
+            self.assertEqual(sorted(resign.ResignJob(config).checkpoint['done']), sorted(set(filepaths) - set([failing])))
+
+            with patch.object(resign, 'sign_rpm_package') as sign_rpm_package, \
+                 patch.object(resign.path, 'expanduser', return_value=tempdir):
+                report = resign.ResignJob(config).run()
+            sign_rpm_package.assert_called_once_with(failing)
+            self.assertEqual(report['signed'], len(filepaths))
+            self.assertEqual(report['failed'], 0)
+            self.assertEqual([(item['index'], item['total'], item['signed']) for item in report['indexes']],
+                             [('main-stable', 3, 3), ('main-unstable', 3, 3)])
+            self.assertFalse(resign.ResignJob(config).is_interrupted())
+            self.assertFalse(path.exists(config.resign_checkpoint_filepath))
+
+    def test_hard_linked_packages_are_signed_once(self):
+        with self.temporary_base_directory_context() as tempdir:
+            config = Configuration.from_disk(None)
+            config.indexes = ['main-stable']
+            filepath = self._build_packages(config)[0]
+            hard_link_or_raise_exception(filepath, path.join(path.dirname(filepath), 'linked.rpm'))
+            with patch.object(resign, 'sign_rpm_package') as sign_rpm_package, \
+                 patch.object(resign.path, 'expanduser', return_value=tempdir):
+                report = resign.ResignJob(config).run()
+            self.assertEqual(sign_rpm_package.call_count, 3)
+            self.assertEqual(report['total'], 3)
+
+    def test_files_are_signed_under_their_index_type_lock(self):
+        from infi.app_repo.locks import LockHierarchy
+        from gevent import spawn, sleep
+        with self.temporary_base_directory_context() as tempdir:
+            config = Configuration.from_disk(None)
+            self._build_packages(config)
+            locks, signed = LockHierarchy(), []
+            with patch.object(resign, 'sign_rpm_package', side_effect=signed.append), \
+                 patch.object(resign.path, 'expanduser', return_value=tempdir):
+                with locks.exclusive(('main-stable', 'yum', 'linux-redhat-7-x86_64')):  # an ingest
+                    job = spawn(resign.ResignJob(config, locks).run)
+                    sleep(0.1)
+                    self.assertEqual(set(filepath.split(path.sep)[-4] for filepath in signed), set(['main-unstable']))
+                job.get()
+            self.assertEqual(len(signed), 6)
+
+    def test_io_budget(self):
+        from time import time
+        budget = resign.IoBudget(100000)
+        start = time()
+        for _ in range(3):
+            budget.consume(10000)
+        self.assertGreaterEqual(time() - start, 0.19)
+        start = time()
+        resign.IoBudget().consume(10 ** 12)
+        self.assertLess(time() - start, 0.1)
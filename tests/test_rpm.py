@@ -0,0 +1,303 @@
+from .test_case import TestCase
+from infi.app_repo import rpm
+from infi.app_repo.utils import path, fopen, write_file, ensure_directory_exists
+from mock import patch
+from glob import glob
+from struct import pack
+import gzip
+
+HEADER_ENTRIES = [
+    (rpm.NAME, rpm.STRING, 'hello'),
+    (rpm.VERSION, rpm.STRING, '1.0'),
+    (rpm.RELEASE, rpm.STRING, '1.el7'),
+    (rpm.SUMMARY, rpm.I18NSTRING, ['Says hello']),
+    (rpm.DESCRIPTION, rpm.I18NSTRING, ['Says hello & goodbye']),
+    (rpm.BUILDTIME, rpm.INT32, [1600000000]),
+    (rpm.BUILDHOST, rpm.STRING, 'builder'),
+    (rpm.SIZE, rpm.INT32, [1234]),
+    (rpm.VENDOR, rpm.STRING, 'Infinidat'),
+    (rpm.LICENSE, rpm.STRING, 'PSF'),
+    (rpm.PACKAGER, rpm.STRING, 'Infinidat <info@infinidat.com>'),
+    (rpm.GROUP, rpm.I18NSTRING, ['Unspecified']),
+    (rpm.URL, rpm.STRING, 'http://www.infinidat.com'),
+    (rpm.ARCH, rpm.STRING, 'x86_64'),
+    (rpm.FILEMODES, rpm.INT16, [0o40755, 0o100755, 0o100644]),
+    (rpm.FILEFLAGS, rpm.INT32, [0, 0, rpm.FILE_GHOST]),
+    (rpm.SOURCERPM, rpm.STRING, 'hello-1.0-1.el7.src.rpm'),
+    (rpm.PROVIDENAME, rpm.STRING_ARRAY, ['hello', 'hello(x86-64)']),
+    (rpm.PROVIDEFLAGS, rpm.INT32, [8, 8]),
+    (rpm.PROVIDEVERSION, rpm.STRING_ARRAY, ['1.0-1.el7', '1.0-1.el7']),
+    (rpm.REQUIRENAME, rpm.STRING_ARRAY, ['/bin/sh', 'python', 'rpmlib(CompressedFileNames)']),
+    (rpm.REQUIREFLAGS, rpm.INT32, [512, 12, 16777226]),
+    (rpm.REQUIREVERSION, rpm.STRING_ARRAY, ['', '1:2.7', '3.0.4-1']),
+    (rpm.CHANGELOGTIME, rpm.INT32, [1500000000, 1400000000]),
+    (rpm.CHANGELOGNAME, rpm.STRING_ARRAY, ['Infinidat - 1.0-1', 'Infinidat - 0.9-1']),
+    (rpm.CHANGELOGTEXT, rpm.STRING_ARRAY, ['- new <version>', '- old version']),
+    (rpm.DIRINDEXES, rpm.INT32, [0, 1, 2]),
+    (rpm.BASENAMES, rpm.STRING_ARRAY, ['hello', 'hello', 'hello.log']),
+    (rpm.DIRNAMES, rpm.STRING_ARRAY, ['/usr/share/', '/usr/bin/', '/var/log/']),
+]
+
+EXPECTED_PRIMARY = """<package type="rpm">
+  <name>hello</name>
+  <arch>x86_64</arch>
+  <version epoch="0" ver="1.0" rel="1.el7"/>
+  <checksum type="sha" pkgid="YES">{checksum}</checksum>
+  <summary>Says hello</summary>
+  <description>Says hello &amp; goodbye</description>
+  <packager>Infinidat &lt;info@infinidat.com&gt;</packager>
+  <url>http://www.infinidat.com</url>
+  <time file="1700000000" build="1600000000"/>
+  <size package="{size}" installed="1234" archive="4096"/>
+  <location href="hello-1.0-1.el7.x86_64.rpm"/>
+  <format>
+    <rpm:license>PSF</rpm:license>
+    <rpm:vendor>Infinidat</rpm:vendor>
+    <rpm:group>Unspecified</rpm:group>
+    <rpm:buildhost>builder</rpm:buildhost>
+    <rpm:sourcerpm>hello-1.0-1.el7.src.rpm</rpm:sourcerpm>
+    <rpm:header-range start="{header_start}" end="{header_end}"/>
+    <rpm:provides>
+      <rpm:entry name="hello" flags="EQ" epoch="0" ver="1.0" rel="1.el7"/>
+      <rpm:entry name="hello(x86-64)" flags="EQ" epoch="0" ver="1.0" rel="1.el7"/>
+    </rpm:provides>
+    <rpm:requires>
+      <rpm:entry name="/bin/sh" pre="1"/>
+      <rpm:entry name="python" flags="GE" epoch="1" ver="2.7"/>
+    </rpm:requires>
+    <file>/usr/bin/hello</file>
+  </format>
+</package>
+"""
+
+EXPECTED_FILELISTS = """<package pkgid="{checksum}" name="hello" arch="x86_64">
+  <version epoch="0" ver="1.0" rel="1.el7"/>
+  <file type="dir">/usr/share/hello</file>
+  <file>/usr/bin/hello</file>
+  <file type="ghost">/var/log/hello.log</file>
+</package>
+"""
+
+EXPECTED_OTHER = """<package pkgid="{checksum}" name="hello" arch="x86_64">
+  <version epoch="0" ver="1.0" rel="1.el7"/>
+  <changelog author="Infinidat - 1.0-1" date="1500000000">- new &lt;version&gt;</changelog>
+</package>
+"""
+
+
+def _build_header(entries):
+    index, store = b'', b''
+    alignments = {rpm.INT16: 2, rpm.INT32: 4, rpm.INT64: 8}
+    for tag, value_type, value in entries:
+        store += b'\0' * ((-len(store)) % alignments.get(value_type, 1))
+        if value_type in rpm.INTEGER_FORMATS:
+            data, count = pack('>{}{}'.format(len(value), rpm.INTEGER_FORMATS[value_type]), *value), len(value)
+        elif value_type == rpm.STRING:
+            data, count = value.encode() + b'\0', 1
+        elif value_type == rpm.BIN:
+            data, count = value, len(value)
+        else:
+            data, count = b''.join(item.encode() + b'\0' for item in value), len(value)
+        index += pack('>iiii', tag, value_type, len(store), count)
+        store += data
+    return rpm.HEADER_MAGIC + b'\0' * 4 + pack('>II', len(entries), len(store)) + index + store
+
+
+def build_rpm(filepath, entries=HEADER_ENTRIES, payload=b'payload' * 100, signature_entries=()):
+    """Writes a minimal rpm: a lead, a signature header, the header and a payload"""
+    lead = rpm.LEAD_MAGIC + b'\x03\x00' + b'\0' * 4 + b'hello'.ljust(66, b'\0') + b'\x00\x01\x00\x05' + b'\0' * 16
+    signature = _build_header([(rpm.SIGNATURE_PAYLOADSIZE, rpm.INT32, [4096])] + list(signature_entries))
+    signature += b'\0' * ((-len(signature)) % 8)
+    with fopen(filepath, 'wb') as fd:
+        fd.write(lead + signature + _build_header(entries) + payload)
+    return len(lead) + len(signature)
+
+
+class RpmTestCase(TestCase):
+    def _get_expected_records(self, filepath, header_start):
+        from hashlib import sha1
+        with fopen(filepath, 'rb') as fd:
+            contents = fd.read()
+        header_end = header_start + len(_build_header(HEADER_ENTRIES))
+        kwargs = dict(checksum=sha1(contents).hexdigest(), size=len(contents), header_start=header_start,
+                      header_end=header_end)
+        return dict(primary=EXPECTED_PRIMARY.format(**kwargs), filelists=EXPECTED_FILELISTS.format(**kwargs),
+                    other=EXPECTED_OTHER.format(**kwargs), checksum=kwargs['checksum'])
+
+    def test_format_records(self):
+        with self.temporary_base_directory_context():
+            filepath = path.abspath('hello-1.0-1.el7.x86_64.rpm')
+            header_start = build_rpm(filepath)
+            records = rpm.format_records(rpm.scan_rpm(filepath), path.basename(filepath), 1700000000.5)
+            expected = self._get_expected_records(filepath, header_start)
+            rows = records.pop('rows')
+            self.assertEqual(records, dict((key, expected[key]) for key in rpm.REPODATA_TYPES))
+            self.assertEqual(rows['package'][:3], [expected['checksum'], 'hello', 'x86_64'])
+            self.assertEqual(rows['requires'], [['/bin/sh', None, None, None, None, True],
+                                                ['python', 'GE', '1', '2.7', None, False]])
+            self.assertEqual(rows['files'], [['/usr/bin/hello', 'file']])
+            self.assertEqual(rows['filelist'], [['/usr/share', 'hello', 'd'], ['/usr/bin', 'hello', 'f'],
+                                                ['/var/log', 'hello.log', 'g']])
+            self.assertEqual(rows['changelog'], [['Infinidat - 1.0-1', 1500000000, '- new <version>']])
+
+    def test_not_an_rpm(self):
+        with self.temporary_base_directory_context():
+            write_file('empty.rpm', '')
+            with self.assertRaises(rpm.RpmParsingFailed):
+                rpm.scan_rpm(path.abspath('empty.rpm'))
+
+    def test_header_cache(self):
+        with self.temporary_base_directory_context():
+            filepath = path.abspath('hello-1.0-1.el7.x86_64.rpm')
+            build_rpm(filepath)
+            write_file('empty.rpm', '')
+            cache = rpm.HeaderCache(path.abspath('cache.msgpack'))
+            records, failures = cache.get_records([filepath, path.abspath('empty.rpm')])
+            self.assertEqual(len(records), 1)
+            self.assertEqual(failures, [path.abspath('empty.rpm')])
+
+            with patch.object(rpm, 'scan_rpm', side_effect=AssertionError("should be cached")):
+                cached_records, _ = rpm.HeaderCache(path.abspath('cache.msgpack')).get_records([filepath])
+            self.assertEqual([record['primary'] for record in cached_records], [records[0]['primary']])
+
+            cache = rpm.HeaderCache(path.abspath('cache.msgpack'))
+            cache.prune([])
+            self.assertEqual(list(rpm.HeaderCache(path.abspath('cache.msgpack'))._entries.keys()), [])
+
+    def test_unreadable_header_cache_is_empty(self):
+        with self.temporary_base_directory_context():
+            filepath = path.abspath('hello-1.0-1.el7.x86_64.rpm')
+            build_rpm(filepath)
+            write_file('cache.msgpack', 'not msgpack')
+            records, failures = rpm.HeaderCache(path.abspath('cache.msgpack')).get_records([filepath])
+            self.assertEqual((len(records), failures), (1, []))
+            self.assertEqual(list(rpm.HeaderCache(path.abspath('cache.msgpack'))._entries.keys()), [filepath])
+
+    def test_write_repodata(self):
+        from hashlib import sha1
+        from xml.etree import ElementTree
+        with self.temporary_base_directory_context() as tempdir:
+            filepath = path.abspath('hello-1.0-1.el7.x86_64.rpm')
+            build_rpm(filepath)
+            records, _ = rpm.HeaderCache(path.abspath('cache.msgpack')).get_records([filepath])
+            rpm.write_repodata(tempdir, records)
+            repomd = ElementTree.parse(path.join(tempdir, 'repomd.xml')).getroot()
+            namespace = '{http://linux.duke.edu/metadata/repo}'
+            data = repomd.findall(namespace + 'data')
+            self.assertEqual([item.get('type') for item in data], ['primary', 'filelists', 'other'])
+            for item in data:
+                filepath = path.join(tempdir, path.basename(item.find(namespace + 'location').get('href')))
+                with fopen(filepath, 'rb') as fd:
+                    self.assertEqual(sha1(fd.read()).hexdigest(), item.find(namespace + 'checksum').text)
+                with gzip.open(filepath, 'rb') as fd:
+                    contents = fd.read()
+                self.assertEqual(sha1(contents).hexdigest(), item.find(namespace + 'open-checksum').text)
+                root = ElementTree.fromstring(contents)
+                self.assertEqual(root.get('packages'), '1')
+                self.assertEqual(len(list(root)), 1)
+            self.assertEqual(glob(path.join(tempdir, '*.tmp')), [])
+
+    def test_write_repodata_with_sqlite_databases(self):
+        import bz2
+        import sqlite3
+        from xml.etree import ElementTree
+        with self.temporary_base_directory_context() as tempdir:
+            databases = path.abspath('sqlite')
+            ensure_directory_exists(databases)
+            filepaths = [path.abspath('hello-1.0-1.el7.x86_64.rpm'), path.abspath('hello-1.1-1.el7.x86_64.rpm')]
+            for index, filepath in enumerate(filepaths):
+                build_rpm(filepath, payload=b'payload' * index)
+            cache = rpm.HeaderCache(path.abspath('cache.msgpack'))
+
+            def get_packages(repodata_type):
+                with fopen(path.join(tempdir, '{}.sqlite.bz2'.format(repodata_type)), 'rb') as fd:
+                    contents = bz2.decompress(fd.read())
+                with fopen('extracted.sqlite', 'wb') as fd:
+                    fd.write(contents)
+                connection = sqlite3.connect(path.abspath('extracted.sqlite'))
+                try:
+                    return sorted(connection.execute('SELECT pkgKey, pkgId FROM packages'))
+                finally:
+                    connection.close()
+
+            rpm.write_repodata(tempdir, cache.get_records(filepaths[:1])[0], databases)
+            first = get_packages('primary')
+            self.assertEqual(len(first), 1)
+            rpm.write_repodata(tempdir, cache.get_records(filepaths)[0], databases)
+            self.assertEqual(get_packages('primary')[0], first[0])  # the existing package was kept, not re-inserted
+            self.assertEqual(len(get_packages('filelists')), 2)
+            rpm.write_repodata(tempdir, cache.get_records(filepaths[1:])[0], databases)
+            self.assertEqual([item[1] for item in get_packages('other')], [get_packages('primary')[0][1]])
+            self.assertNotEqual(get_packages('primary')[0], first[0])
+
+            connection = sqlite3.connect(path.join(databases, 'primary.sqlite'))
+            try:
+                self.assertEqual(connection.execute('SELECT count(*) FROM files').fetchone(), (1, ))
+                self.assertEqual(connection.execute('SELECT dbversion FROM db_info').fetchone(),
+                                 (rpm.SQLITE_DATABASE_VERSION, ))
+            finally:
+                connection.close()
+            namespace = '{http://linux.duke.edu/metadata/repo}'
+            data = ElementTree.parse(path.join(tempdir, 'repomd.xml')).getroot().findall(namespace + 'data')
+            self.assertEqual([item.get('type') for item in data],
+                             ['primary', 'primary_db', 'filelists', 'filelists_db', 'other', 'other_db'])
+            self.assertEqual(data[1].find(namespace + 'database_version').text, str(rpm.SQLITE_DATABASE_VERSION))
+
+    def _get_xml_packages(self, filepath):
+        from xml.etree import ElementTree
+
+        def canonical(element):
+            return (element.tag, sorted(element.attrib.items()), (element.text or '').strip(),
+                    [canonical(child) for child in element])
+        with gzip.open(filepath, 'rb') as fd:
+            return sorted(canonical(element) for element in ElementTree.fromstring(fd.read()))
+
+    def _get_sqlite_rows(self, filepath):
+        """:returns: dict mapping the tables to their rows, with the pkgKey of each row replaced by its pkgId"""
+        import bz2
+        import sqlite3
+        with fopen(filepath, 'rb') as fd:
+            contents = bz2.decompress(fd.read())
+        with fopen(filepath[:-len('.bz2')], 'wb') as fd:
+            fd.write(contents)
+        connection = sqlite3.connect(filepath[:-len('.bz2')])
+        try:
+            pkgids = dict(connection.execute('SELECT pkgKey, pkgId FROM packages'))
+            tables = dict(db_info=[row[:1] for row in connection.execute('SELECT * FROM db_info')])
+            for table, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'db_info'"):
+                columns = [column[1] for column in connection.execute('PRAGMA table_info({})'.format(table))]
+                rows = [dict(zip(columns, row)) for row in connection.execute('SELECT * FROM {}'.format(table))]
+                for row in rows:
+                    row['pkgKey'] = pkgids[row['pkgKey']]
+                tables[table] = sorted((sorted(row.items()) for row in rows), key=repr)  # the values may be NULL
+            return tables
+        finally:
+            connection.close()
+
+    def test_write_repodata_matches_createrepo(self):
+        from distutils.spawn import find_executable
+        from infi.app_repo.indexers.yum import CREATEREPO_ARGUMENTS
+        from infi.app_repo.utils import log_execute_assert_success
+        if not find_executable('createrepo'):
+            self.skipTest("createrepo is not installed")
+        with self.temporary_base_directory_context() as tempdir:
+            dirpath = path.join(tempdir, 'linux-redhat-7-x86_64')
+            ensure_directory_exists(dirpath)
+            filepaths = [path.join(dirpath, 'hello-1.0-1.el7.x86_64.rpm'), path.join(dirpath, 'hello-1.1-1.el7.x86_64.rpm')]
+            for index, filepath in enumerate(filepaths):
+                build_rpm(filepath, payload=b'payload' * index)
+            expected = path.join(tempdir, 'expected')
+            ensure_directory_exists(expected)
+            arguments = [argument for argument in CREATEREPO_ARGUMENTS if argument != '--no-database']
+            log_execute_assert_success(arguments + ['--database', '--outputdir', expected, dirpath])
+            actual, databases = path.join(tempdir, 'actual'), path.join(tempdir, 'sqlite')
+            ensure_directory_exists(actual)
+            ensure_directory_exists(databases)
+            rpm.write_repodata(actual, rpm.HeaderCache(path.abspath('cache.msgpack')).get_records(filepaths)[0], databases)
+            for repodata_type in rpm.REPODATA_TYPES:
+                basename = '{}.xml.gz'.format(repodata_type)
+                self.assertEqual(self._get_xml_packages(path.join(actual, basename)),
+                                 self._get_xml_packages(path.join(expected, 'repodata', basename)))
+                basename = '{}.sqlite.bz2'.format(repodata_type)
+                self.assertEqual(self._get_sqlite_rows(path.join(actual, basename)),
+                                 self._get_sqlite_rows(path.join(expected, 'repodata', basename)))
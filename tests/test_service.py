@@ -29,6 +29,68 @@ class ServiceTestCase(TestCase):
             self.assertTrue(indexer.consumed)
 
 
+class BatchIndexer(Indexer):
+    INDEX_TYPE = 'batch'
+
+    def __init__(self, *args, **kwargs):
+        super(BatchIndexer, self).__init__(*args, **kwargs)
+        self.batches = []
+
+    def are_you_interested_in_file(self, filepath, platform, arch):
+        return not filepath.endswith('.msi')
+
+    def consume_files(self, items):
+        self.batches.append(items)
+        return {filepath: ValueError(filepath) for filepath, platform, arch in items if 'broken' in filepath}
+
+
+class BatchTestCase(TestCase):
+    def test_process_incoming_in_one_batch(self):
+        with self.temporary_base_directory_context():
+            config = Configuration.from_disk(None)
+            ensure_incoming_and_rejected_directories_exist_for_all_indexers(config)
+            indexer = BatchIndexer(config, 'main-stable')
+            config.get_indexers = lambda name: [indexer]
+            basenames = ['some-package-1.0-linux-redhat-7-x64', 'some-package-1.1-linux-redhat-7-x64',
+                         'broken-package-1.0-linux-redhat-7-x64', 'neglected-package-1.0-windows-x64']
+            extensions = ['rpm', 'rpm', 'rpm', 'msi']
+            filepaths = [self.write_new_package_in_incoming_directory(config, package_basename=basename, extension=extension)
+                         for basename, extension in zip(basenames, extensions)]
+            filepaths.append(self.write_new_package_in_incoming_directory(config, package_basename='unparsable'))
+            rejected = service.AppRepoService(config).process_incoming('main-stable')
+
+            self.assertEqual(len(indexer.batches), 1)
+            self.assertEqual(sorted(item[0] for item in indexer.batches[0]), sorted(filepaths[:3]))
+            self.assertEqual(rejected, sorted(filepaths[2:]))
+            for filepath in filepaths:
+                self.assertFalse(service.path.exists(filepath))
+            for filepath in filepaths[2:]:
+                self.assertTrue(service.path.exists(service.path.join(config.rejected_directory, 'main-stable',
+                                                                      service.path.basename(filepath))))
+            for filepath in filepaths[:2]:
+                self.assertFalse(service.path.exists(service.path.join(config.rejected_directory, 'main-stable',
+                                                                       service.path.basename(filepath))))
+
+
+class IngestQueueServiceTestCase(TestCase):
+    def test_submit_filepath_by_name(self):
+        with self.temporary_base_directory_context():
+            config = Configuration.from_disk(None)
+            ensure_incoming_and_rejected_directories_exist_for_all_indexers(config)
+            filepath = self.write_new_package_in_incoming_directory(config, package_basename='some-package-1.0-linux-redhat-7-x64', extension='rpm')
+            indexer = DummyIndexer(config, 'main-stable')
+            config.get_indexers = lambda name: [indexer]
+            app_repo_service = service.AppRepoService(config)
+            job_id = app_repo_service.submit_filepath_by_name('main-stable', filepath)
+            self.assertFalse(indexer.consumed)
+            self.assertEqual(app_repo_service.process_incoming('main-stable'), [])
+            self.assertFalse(indexer.consumed)
+            app_repo_service.ingest_queue.join()
+            self.assertTrue(indexer.consumed)
+            self.assertEqual(app_repo_service.get_job_status(job_id)['status'], 'done')
+            self.assertEqual([job['job_id'] for job in app_repo_service.list_jobs('main-stable')], [job_id])
+
+
 class RpcTestCase(TestCase):
     def test_reload_configuration_from_disk(self):
         with self.temporary_base_directory_context():
@@ -38,3 +100,133 @@ class RpcTestCase(TestCase):
                 client = service.get_client(config)
                 client.reload_configuration_from_disk()
                 client.reload_configuration_from_disk()
+
+
+class SlowIndexer(Indexer):
+    INDEX_TYPE = 'slow'
+    DELAY = 0.2
+
+    def are_you_interested_in_file(self, filepath, platform, arch):
+        return True
+
+    def get_lock_target(self, filepath, platform, arch):
+        return platform
+
+    def consume_file(self, filepath, platform, arch):
+        from gevent import sleep
+        sleep(self.DELAY)
+
+
+class ConcurrentIngestTestCase(TestCase):
+    INDEXES = ['index-a', 'index-b', 'index-c', 'index-d']
+
+    def _ingest(self, app_repo_service, config, items):
+        from gevent import spawn, joinall
+        greenlets = []
+        for index, platform in items:
+            filepath = self.write_new_package_in_incoming_directory(config, index, 'package-%s' % len(greenlets))
+            greenlets.append(spawn(app_repo_service.process_filepath, index, filepath, platform, 'x64'))
+        joinall(greenlets, raise_error=True)
+
+    def _service_context(self):
+        config = Configuration.from_disk(None)
+        config.indexes = self.INDEXES
+        ensure_incoming_and_rejected_directories_exist_for_all_indexers(config)
+        config.get_indexers = lambda index: [SlowIndexer(config, index)]
+        return config, service.AppRepoService(config)
+
+    def _get_lock_keys(self, config, filepath):
+        from infi.app_repo.artifact import ParsedArtifact
+        artifact = ParsedArtifact.from_filepath(filepath)
+        return [service.get_lock_key('main-stable', indexer, artifact) for indexer in config.get_indexers('main-stable')
+                if indexer.are_you_interested_in_artifact(artifact)]
+
+    def test_ingests_wait_only_for_ingests_into_the_same_targets(self):
+        from gevent import spawn, joinall
+        from infi.app_repo.mock import patch_all
+        from infi.app_repo.install import setup_gpg
+        from infi.app_repo.utils import path, read_file, decode
+        with self.temporary_base_directory_context(), patch_all():
+            config = Configuration.from_disk(None)
+            ensure_incoming_and_rejected_directories_exist_for_all_indexers(config)
+            setup_gpg(config)
+            for indexer in config.get_indexers('main-stable'):
+                indexer.initialise()
+            app_repo_service = service.AppRepoService(config)
+            basenames = dict(held='package-a-1.0-linux-redhat-7-x64', other='package-b-1.0-linux-centos-7-x64',
+                             same_package='package-a-1.1-linux-centos-7-x64',
+                             same_directory='package-c-1.0-linux-redhat-7-x64')
+            filepaths = dict((name, self.write_new_package_in_incoming_directory(config, package_basename=basename,
+                                                                                 extension='rpm'))
+                             for name, basename in basenames.items())
+            self.assertIn(('main-stable', 'index', 'package-a'), self._get_lock_keys(config, filepaths['held']))
+            with app_repo_service.locks.exclusive(*self._get_lock_keys(config, filepaths['held'])):
+                greenlets = dict((name, spawn(app_repo_service.process_filepath_by_name, 'main-stable', filepaths[name]))
+                                 for name in ('other', 'same_package', 'same_directory'))
+                greenlets['other'].get(timeout=30)  # a safety net, it does not wait for the held keys
+                self.assertFalse(greenlets['same_package'].ready())  # waits for the pretty index of package-a
+                self.assertFalse(greenlets['same_directory'].ready())  # waits for the linux-redhat-7-x86_64 yum directory
+            joinall(list(greenlets.values()), raise_error=True)
+            # the ingests of package-a and package-c ran together, and both updated packages.json
+            pretty_indexer = [indexer for indexer in config.get_indexers('main-stable') if indexer.INDEX_TYPE == 'index'][0]
+            packages = decode(read_file(path.join(pretty_indexer.base_directory, 'packages.json')))
+            self.assertEqual(sorted(package['name'] for package in packages), ['package-a', 'package-b', 'package-c'])
+
+    def test_rebuild_waits_for_ingests_of_the_same_index(self):
+        from gevent import spawn, sleep
+        with self.temporary_base_directory_context():
+            config, app_repo_service = self._service_context()
+            events = []
+
+            class RecordingIndexer(SlowIndexer):
+                def consume_file(self, filepath, platform, arch):
+                    super(RecordingIndexer, self).consume_file(filepath, platform, arch)
+                    events.append(('consume', self.index_name))
+
+                def rebuild_index(self):
+                    events.append(('rebuild', self.index_name))
+
+            config.get_indexers = lambda index: [RecordingIndexer(config, index)]
+            ingest = spawn(self._ingest, app_repo_service, config, [('index-a', 'linux-redhat-7')])
+            sleep(0.01)
+            app_repo_service.rebuild_index('index-b')
+            app_repo_service.rebuild_index('index-a')
+            ingest.join()
+            self.assertEqual(events, [('rebuild', 'index-b'), ('consume', 'index-a'), ('rebuild', 'index-a')])
+
+    def test_rebuild_progress(self):
+        from gevent import spawn, sleep
+        with self.temporary_base_directory_context():
+            config, app_repo_service = self._service_context()
+
+            class ProgressIndexer(SlowIndexer):
+                def rebuild_index(self):
+                    sleep(self.DELAY)
+
+                def get_rebuild_progress(self):
+                    return dict(done=1, total=2)
+
+            config.get_indexers = lambda index: [ProgressIndexer(config, index)]
+            self.assertEqual(app_repo_service.get_rebuild_progress(), [])
+            rebuild = spawn(app_repo_service.rebuild_index, 'index-a')
+            sleep(0.01)
+            self.assertEqual(app_repo_service.get_rebuild_progress(),
+                             [dict(index='index-a', index_type='slow', done=1, total=2)])
+            rebuild.get()
+            self.assertEqual(app_repo_service.get_rebuild_progress(), [])
+
+
+class ResignServiceTestCase(TestCase):
+    def test_interrupted_resign_job_resumes_on_startup(self):
+        from gevent import sleep
+        from infi.app_repo import resign
+        from mock import patch
+        with self.temporary_base_directory_context():
+            config = Configuration.from_disk(None)
+            job = resign.ResignJob(config)
+            job.checkpoint.update(key_ids=[], done=dict())
+            with patch.object(resign.ResignJob, 'run', return_value=dict()) as run:
+                app_repo_service = service.AppRepoService(config)
+                sleep(0.01)
+            run.assert_called_once_with()
+            self.assertEqual(app_repo_service.get_resign_progress(), dict(running=False, indexes=[]))
@@ -0,0 +1,114 @@
+from .test_case import TestCase
+from infi.app_repo import signatures, rpm
+from infi.app_repo.utils import path, fopen, write_file, ensure_directory_exists
+from .test_rpm import build_rpm
+from base64 import b64encode
+from struct import pack
+from mock import patch
+
+PUBLIC_KEY = b'\x04' + pack('>I', 1600000000) + b'\x01' + b'\x00\x08\xff' + b'\x00\x02\x03'
+PUBLIC_SUBKEY = b'\x04' + pack('>I', 1600000000) + b'\x01' + b'\x00\x08\xfe' + b'\x00\x02\x03'
+
+
+def _packet(tag, body):
+    return pack('>BB', 0xc0 | tag, len(body)) + body
+
+
+def _old_format_packet(tag, body):
+    return pack('>BH', 0x80 | (tag << 2) | 1, len(body)) + body
+
+
+def _v4_signature(key_id):
+    hashed = pack('>BB', 5, 2) + pack('>I', 1600000000)  # signature creation time
+    unhashed = pack('>BB', 9, signatures.ISSUER_SUBPACKET) + bytes(bytearray.fromhex(key_id))
+    body = b'\x04\x00\x01\x08' + pack('>H', len(hashed)) + hashed + pack('>H', len(unhashed)) + unhashed + b'\xab\xcd'
+    return _packet(signatures.SIGNATURE_PACKET, body)
+
+
+def _v3_signature(key_id):
+    body = b'\x03\x05\x00' + pack('>I', 1600000000) + bytes(bytearray.fromhex(key_id)) + b'\x01\x08\xab\xcd'
+    return _old_format_packet(signatures.SIGNATURE_PACKET, body)
+
+
+def _armor(kind, data):
+    encoded = b64encode(data).decode('ascii')
+    lines = [encoded[index:index + 64] for index in range(0, len(encoded), 64)]
+    return '-----BEGIN PGP {0}-----\nVersion: GnuPG v1\n\n{1}\n=abcd\n-----END PGP {0}-----\n'.format(kind, '\n'.join(lines))
+
+
+class SignaturesTestCase(TestCase):
+    def _get_key_ids(self):
+        from hashlib import sha1
+        return [sha1(b'\x99' + pack('>H', len(body)) + body).hexdigest().upper()[-16:]
+                for body in (PUBLIC_KEY, PUBLIC_SUBKEY)]
+
+    def _write_public_key(self, filepath):
+        data = _packet(signatures.PUBLIC_KEY_PACKET, PUBLIC_KEY) + _packet(13, b'app_repo') + \
+               _packet(signatures.PUBLIC_SUBKEY_PACKET, PUBLIC_SUBKEY)
+        write_file(filepath, _armor('PUBLIC KEY BLOCK', data))
+
+    def _build_signed_deb(self, filepath, key_id):
+        from infi.app_repo.utils import log_execute_assert_success
+        source = path.abspath('hello-source')
+        ensure_directory_exists(path.join(source, 'DEBIAN'))
+        write_file(path.join(source, 'DEBIAN', 'control'), 'Package: hello\nVersion: 1.0\nArchitecture: all\n'
+                                                            'Maintainer: Infinidat\nDescription: hello\n')
+        log_execute_assert_success(['dpkg-deb', '--build', source, filepath])
+        if key_id is None:
+            return
+        contents = ('-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA1\n\nVersion: 4\nRole: builder\n' +
+                    _armor('SIGNATURE', _v4_signature(key_id))).encode('ascii')
+        with fopen(filepath, 'ab') as fd:
+            fd.write('_gpgbuilder/'.ljust(16).encode('ascii') + '0'.ljust(12).encode('ascii') +
+                     b'0     0     100644  ' + str(len(contents)).ljust(10).encode('ascii') + b'`\n' + contents)
+            fd.write(b'\n' * (len(contents) % 2))
+
+    def test_public_key_ids(self):
+        with self.temporary_base_directory_context():
+            self._write_public_key('gpg.key')
+            self.assertEqual(signatures.read_public_key_ids(path.abspath('gpg.key')), set(self._get_key_ids()))
+            self.assertEqual(signatures.read_public_key_ids(path.abspath('missing.key')), set())
+
+    def test_package_key_ids(self):
+        key_id, other_key_id = self._get_key_ids()[0], '0123456789ABCDEF'
+        with self.temporary_base_directory_context():
+            build_rpm(path.abspath('v4.rpm'), signature_entries=[(rpm.SIGNATURE_RSAHEADER, rpm.BIN, _v4_signature(key_id))])
+            build_rpm(path.abspath('v3.rpm'), signature_entries=[(rpm.SIGNATURE_GPG, rpm.BIN, _v3_signature(other_key_id))])
+            build_rpm(path.abspath('unsigned.rpm'))
+            self._build_signed_deb(path.abspath('signed.deb'), key_id)
+            self._build_signed_deb(path.abspath('unsigned.deb'), None)
+            write_file('empty.rpm', '')
+            self.assertEqual(signatures.get_package_key_ids(path.abspath('v4.rpm')), set([key_id]))
+            self.assertEqual(signatures.get_package_key_ids(path.abspath('v3.rpm')), set([other_key_id]))
+            self.assertEqual(signatures.get_package_key_ids(path.abspath('unsigned.rpm')), set())
+            self.assertEqual(signatures.get_package_key_ids(path.abspath('signed.deb')), set([key_id]))
+            self.assertEqual(signatures.get_package_key_ids(path.abspath('unsigned.deb')), set())
+            self.assertTrue(signatures.is_signed_by(path.abspath('v4.rpm'), self._get_key_ids()))
+            self.assertFalse(signatures.is_signed_by(path.abspath('v3.rpm'), self._get_key_ids()))
+            self.assertFalse(signatures.is_signed_by(path.abspath('empty.rpm'), self._get_key_ids()))
+
+    def test_sign_all_existing_packages_skips_the_ones_signed_with_the_current_key(self):
+        from infi.app_repo import install, resign
+        from infi.app_repo.config import Configuration
+        key_id = self._get_key_ids()[1]
+        with self.temporary_base_directory_context() as tempdir:
+            config = Configuration.from_disk(None)
+            yum = path.join(config.packages_directory, 'main-stable', 'yum', 'linux-redhat-7-x86_64')
+            apt = path.join(config.packages_directory, 'main-stable', 'apt', 'linux-ubuntu', 'dists', 'xenial')
+            ensure_directory_exists(yum)
+            ensure_directory_exists(apt)
+            build_rpm(path.join(yum, 'signed.rpm'), signature_entries=[(rpm.SIGNATURE_RSAHEADER, rpm.BIN, _v4_signature(key_id))])
+            build_rpm(path.join(yum, 'stale.rpm'), signature_entries=[(rpm.SIGNATURE_RSAHEADER, rpm.BIN, _v4_signature('0123456789ABCDEF'))])
+            self._build_signed_deb(path.join(apt, 'signed.deb'), key_id)
+            self._build_signed_deb(path.join(apt, 'unsigned.deb'), None)
+            self._write_public_key(path.join(tempdir, 'gpg.key'))
+            with patch.object(resign, 'sign_rpm_package') as sign_rpm_package, \
+                 patch.object(resign, 'sign_deb_package') as sign_deb_package, \
+                 patch.object(resign.path, 'expanduser', return_value=tempdir):
+                report = install.sign_all_existing_deb_and_rpm_packages(config)
+            sign_rpm_package.assert_called_once_with(path.join(yum, 'stale.rpm'))
+            sign_deb_package.assert_called_once_with(path.join(apt, 'unsigned.deb'))
+            self.assertEqual(report['signed'], 2)
+            self.assertEqual(report['skipped'], 2)
+            self.assertEqual(report['skipped_bytes'], path.getsize(path.join(yum, 'signed.rpm')) +
+                                                      path.getsize(path.join(apt, 'signed.deb')))
@@ -0,0 +1,88 @@
+from .test_case import TestCase
+from infi.app_repo import signer, metrics
+from infi.app_repo.utils import path, write_file, log_execute_assert_success, temporary_directory_context
+from infi.execute import ExecutionError
+from infi.pyutils.contexts import contextmanager
+from mock import patch
+
+
+class SignerTestCase(TestCase):
+    @contextmanager
+    def _signer_context(self):
+        signing_metrics = metrics.SigningMetrics()
+        with patch.object(signer, 'signing_metrics', signing_metrics), patch.object(signer, 'launch_gpg_agent'):
+            yield signer.Signer(), signing_metrics
+
+    def test_package_requests_that_queue_together_are_batched(self):
+        from gevent import spawn, joinall
+        calls = []
+        with self._signer_context() as (instance, signing_metrics), \
+             patch.object(signer, 'rpm_addsign', side_effect=lambda filepaths: calls.append(list(filepaths))):
+            joinall([spawn(instance.sign_rpm, 'package-{}.rpm'.format(index)) for index in range(3)], raise_error=True)
+            instance.sign_rpm('package-3.rpm')
+        self.assertEqual(calls, [['package-0.rpm', 'package-1.rpm', 'package-2.rpm'], ['package-3.rpm']])
+        self.assertEqual(signing_metrics.to_dict()['batches'], [dict(kind='rpm', batches=2, requests=4)])
+        self.assertEqual([(item['kind'], item['phase'], item['count']) for item in signing_metrics.to_dict()['histograms']],
+                         [('rpm', 'sign', 4), ('rpm', 'wait', 4)])
+
+    def test_a_failing_batch_is_signed_one_by_one(self):
+        from gevent import spawn, joinall
+
+        def dpkg_sig(filepaths):
+            if 'bad.deb' in filepaths:
+                raise RuntimeError("dpkg-sig failed")
+
+        with self._signer_context() as (instance, _), patch.object(signer, 'dpkg_sig', side_effect=dpkg_sig) as mock:
+            greenlets = [spawn(instance.sign_deb, basename) for basename in ('good.deb', 'bad.deb')]
+            joinall(greenlets)
+        self.assertTrue(greenlets[0].successful())
+        self.assertIsInstance(greenlets[1].exception, RuntimeError)
+        self.assertEqual(mock.call_count, 3)
+
+    def test_every_outstanding_request_fails_when_serving_fails(self):
+        from gevent import spawn, joinall
+        signed = []
+        with self._signer_context() as (instance, signing_metrics), \
+             patch.object(signer, 'rpm_addsign', side_effect=signed.extend):
+            signer.launch_gpg_agent.side_effect = RuntimeError("gpg-agent failed")
+            greenlets = [spawn(instance.sign_rpm, 'package-{}.rpm'.format(index)) for index in range(2)]
+            joinall(greenlets)
+            signer.launch_gpg_agent.side_effect = None
+            for greenlet in greenlets:
+                self.assertIsInstance(greenlet.exception, RuntimeError)
+            with patch.object(signing_metrics, 'observe_batch', side_effect=RuntimeError("metrics failed")):
+                greenlets = [spawn(instance.sign_rpm, 'package-2.rpm'), spawn(instance.sign_deb, 'package.deb')]
+                with patch.object(signer, 'dpkg_sig') as dpkg_sig:
+                    joinall(greenlets)
+            self.assertEqual(signed, ['package-2.rpm'])
+            self.assertFalse(dpkg_sig.called)  # the rpm batch failed first
+            for greenlet in greenlets:
+                self.assertIsInstance(greenlet.exception, RuntimeError)
+            instance.sign_rpm('package-3.rpm')  # the worker serves the next requests
+        self.assertEqual(signed, ['package-2.rpm', 'package-3.rpm'])
+
+    def test_detached_and_clear_signatures_with_a_local_keyring(self):
+        from os import environ
+        with temporary_directory_context() as tempdir, patch.dict(environ, GNUPGHOME=tempdir):
+            try:
+                log_execute_assert_success(['gpg', '--batch', '--passphrase', '', '--quick-gen-key', 'app_repo-test',
+                                            'rsa1024', 'sign', 'never'])
+            except (ExecutionError, OSError):
+                raise self.skipTest("failed to generate a gpg key")
+            write_file('Release', 'Origin: app_repo\n')
+            with patch.object(signer, 'signing_metrics', metrics.SigningMetrics()):
+                instance = signer.Signer()
+                instance.sign_detached(path.abspath('Release'), path.abspath('Release.gpg'))
+                instance.sign_clear(path.abspath('Release'), path.abspath('InRelease'))
+            log_execute_assert_success(['gpg', '--verify', 'Release.gpg', 'Release'])
+            log_execute_assert_success(['gpg', '--verify', 'InRelease'])
+            log_execute_assert_success(['gpgconf', '--kill', 'gpg-agent'], allow_to_fail=True)
+
+    def test_format_metrics(self):
+        signing_metrics = metrics.SigningMetrics()
+        signing_metrics.observe('rpm', 0.02, 1.5)
+        signing_metrics.observe_batch('rpm', 3)
+        text = metrics.format_metrics(dict(histograms=[], slow_ingests=[], signing=signing_metrics.to_dict()))
+        self.assertIn('app_repo_signing_seconds_bucket{kind="rpm",phase="wait",le="0.05"} 1', text)
+        self.assertIn('app_repo_signing_seconds_count{kind="rpm",phase="sign"} 1', text)
+        self.assertIn('app_repo_signing_requests_total{kind="rpm"} 3', text)
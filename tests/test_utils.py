@@ -1,5 +1,6 @@
 from .test_case import TestCase
 from infi.app_repo.utils import hard_link_or_raise_exception, temporary_directory_context, path, FileAlreadyExists, fopen
+from os import chmod, listdir, rename, stat
 
 
 class HardLinkTestCase(TestCase):
@@ -14,4 +15,142 @@ class HardLinkTestCase(TestCase):
                 hard_link_or_raise_exception('src', 'dst')
 
 
+class TemporaryDirectoryTestCase(TestCase):
+    def test_temporary_directory_context_without_changing_directory(self):
+        from os import getcwd
+        cwd = getcwd()
+        with temporary_directory_context(change_directory=False) as tempdir:
+            self.assertEqual(getcwd(), cwd)
+            self.assertTrue(path.isdir(tempdir))
+        self.assertFalse(path.exists(tempdir))
+        with temporary_directory_context() as tempdir:
+            self.assertEqual(getcwd(), path.realpath(tempdir))
+        self.assertEqual(getcwd(), cwd)
 
+
+class SignRpmPackageTestCase(TestCase):
+    def _rpm_addsign(self, filepath):
+        # like rpm, writes the signed package aside and renames it over the original
+        with fopen(filepath, 'rb') as fd:
+            contents = fd.read()
+        with fopen(filepath + '.tmp', 'wb') as fd:
+            fd.write(b'signed ' + contents)
+        rename(filepath + '.tmp', filepath)
+
+    def _read(self, filepath):
+        with fopen(filepath, 'rb') as fd:
+            return fd.read()
+
+    def test_sign_rpm_package(self):
+        from infi.app_repo import utils
+        from mock import patch
+        with temporary_directory_context(), patch.object(utils, '_rpm_addsign', side_effect=self._rpm_addsign):
+            with fopen('package.rpm', 'wb') as fd:
+                fd.write(b'rpm')
+            chmod('package.rpm', 0o600)
+            hard_link_or_raise_exception('package.rpm', 'indexed.rpm')
+            utils.sign_rpm_package(path.abspath('package.rpm'), [path.abspath('indexed.rpm')])
+            self.assertEqual(self._read('package.rpm'), b'signed rpm')
+            self.assertEqual(stat('package.rpm').st_ino, stat('indexed.rpm').st_ino)
+            self.assertEqual(stat('package.rpm').st_mode & 0o777, 0o600)
+            self.assertEqual(sorted(listdir('.')), ['indexed.rpm', 'package.rpm'])
+
+            # links that were not passed keep seeing the file, so it is signed in place
+            hard_link_or_raise_exception('package.rpm', 'unknown.rpm')
+            inode = stat('package.rpm').st_ino
+            utils.sign_rpm_package(path.abspath('package.rpm'), [path.abspath('indexed.rpm')])
+            self.assertEqual(self._read('unknown.rpm'), b'signed signed rpm')
+            self.assertEqual(stat('package.rpm').st_ino, inode)
+            self.assertEqual(sorted(listdir('.')), ['indexed.rpm', 'package.rpm', 'unknown.rpm'])
+
+    def test_sign_rpm_package_with_every_link_passed(self):
+        from infi.app_repo import utils
+        from mock import patch
+        with temporary_directory_context(), patch.object(utils, '_rpm_addsign', side_effect=self._rpm_addsign), \
+             patch.object(utils, '_copy_file_contents', wraps=utils._copy_file_contents) as copy_file_contents:
+            with fopen('package.rpm', 'wb') as fd:
+                fd.write(b'rpm')
+            hard_link_or_raise_exception('package.rpm', 'yum.rpm')
+            hard_link_or_raise_exception('package.rpm', 'pretty.rpm')
+            inode = stat('package.rpm').st_ino
+            utils.sign_rpm_package(path.abspath('package.rpm'), [path.abspath('yum.rpm'), path.abspath('pretty.rpm')])
+            self.assertEqual(copy_file_contents.call_count, 1)  # the signed copy is renamed, not copied back
+            self.assertNotEqual(stat('package.rpm').st_ino, inode)
+            self.assertEqual(stat('package.rpm').st_nlink, 3)
+            for basename in ('package.rpm', 'yum.rpm', 'pretty.rpm'):
+                self.assertEqual(stat(basename).st_ino, stat('package.rpm').st_ino)
+                self.assertEqual(self._read(basename), b'signed rpm')
+            self.assertEqual(sorted(listdir('.')), ['package.rpm', 'pretty.rpm', 'yum.rpm'])
+
+    def test_copy_falls_back_when_copy_file_range_fails(self):
+        from infi.app_repo import utils
+        from mock import patch
+        from errno import EXDEV
+        with temporary_directory_context():
+            with fopen('src', 'wb') as fd:
+                fd.write(b'rpm' * 1000)
+            with fopen('dst', 'wb') as fd:
+                fd.write(b'previous contents')
+            inode = stat('dst').st_ino
+            with patch('fcntl.ioctl', side_effect=OSError()), \
+                 patch('os.copy_file_range', side_effect=OSError(EXDEV, "Invalid cross-device link"),
+                       create=True) as copy_file_range:
+                utils._copy_file_contents(path.abspath('src'), path.abspath('dst'))
+            self.assertTrue(copy_file_range.called)
+            self.assertEqual(self._read('dst'), b'rpm' * 1000)
+            self.assertEqual(stat('dst').st_ino, inode)
+
+
+class PackageTypeTestCase(TestCase):
+    RPM_HEADER = b'\xed\xab\xee\xdb\x03\x00\x00\x00\x00\x01' + b'\x00' * 86
+    DEB_HEADER = b'!<arch>\ndebian-binary   1342943816  0     0     100644  4         `\n2.0\n'
+
+    def _write(self, basename, contents):
+        with fopen(basename, 'wb') as fd:
+            fd.write(contents)
+        return path.abspath(basename)
+
+    def test_sniffing(self):
+        from infi.app_repo.utils import get_package_type, is_really_rpm, is_really_deb
+        with temporary_directory_context():
+            rpm = self._write('package.rpm', self.RPM_HEADER)
+            deb = self._write('package.deb', self.DEB_HEADER)
+            ar = self._write('library.a', b'!<arch>\n/               0           0     0     0       4         `\n')
+            text = self._write('text.deb', b'hello world')
+            empty = self._write('empty.rpm', b'')
+            self.assertEqual([get_package_type(filepath) for filepath in (rpm, deb, ar, text, empty)],
+                             ['rpm', 'deb', None, None, None])
+            self.assertTrue(is_really_rpm(rpm))
+            self.assertFalse(is_really_deb(rpm))
+            self.assertTrue(is_really_deb(deb))
+            self.assertFalse(is_really_rpm('does-not-exist.rpm'))
+
+    def test_verdict_is_cached_until_the_file_changes(self):
+        from infi.app_repo import utils
+        from mock import patch
+        with temporary_directory_context():
+            filepath = self._write('package.deb', self.DEB_HEADER)
+            with patch.object(utils, '_sniff_package_type', wraps=utils._sniff_package_type) as sniff:
+                for _ in range(3):
+                    self.assertTrue(utils.is_really_deb(filepath))
+                self.assertEqual(sniff.call_count, 1)
+                with fopen(filepath, 'wb') as fd:
+                    fd.write(self.RPM_HEADER + b'\x00')
+                self.assertTrue(utils.is_really_rpm(filepath))
+                self.assertEqual(sniff.call_count, 2)
+
+    def test_benchmark_against_file_command(self):
+        from infi.app_repo import utils
+        from time import time
+        with temporary_directory_context():
+            filepaths = [self._write('package-%s.deb' % index, self.DEB_HEADER + b'%d' % index) for index in range(20)]
+            start = time()
+            for filepath in filepaths:
+                self.assertTrue(utils.file_type_contains(filepath, 'Debian binary package'))
+            subprocess_duration = time() - start
+            start = time()
+            for filepath in filepaths:
+                self.assertTrue(utils.is_really_deb(filepath))
+            in_process_duration = time() - start
+            print("file(1): {:.6f}s, in-process: {:.6f}s for {} files".format(subprocess_duration, in_process_duration, len(filepaths)))
+            self.assertLess(in_process_duration, subprocess_duration)